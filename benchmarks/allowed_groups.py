@@ -0,0 +1,82 @@
+#!/bin/env python
+"""Microbenchmark of the allowed_groups check in SLACAuth._authenticate.
+
+Compares logins/second of the old check (one BASE search per allowed group,
+until one matches) with SLACAuth._inAllowedGroups, against the local LDAP
+stand-in in ldapmock.py. Every user is in the last allowed group. Time spent
+evaluating filters inside the mock is excluded; --latency models the server.
+
+    python benchmarks/allowed_groups.py --allowed 30 --latency 0.002
+"""
+import argparse
+import logging
+import time
+
+import ldap3
+
+import ldapmock
+
+
+def legacy_in_allowed_groups(self, conn, userdn, username):
+    for group in self.allowed_groups:
+        group_filter = (
+            '(|'
+            '(member={userdn})'
+            '(uniqueMember={userdn})'
+            '(memberUid={uid})'
+            ')'
+        ).format(userdn=userdn, uid=username)
+        if conn.search(group, search_scope=ldap3.BASE, search_filter=group_filter,
+                       attributes=['member', 'uniqueMember', 'memberUid']):
+            return True
+    return False
+
+
+def run(auth, logins, users):
+    """Return (logins/s, round trips/login), not counting time spent inside the mock."""
+    start = time.monotonic()
+    trips = ldapmock.LatencyConnection.round_trips
+    server_time = ldapmock.LatencyConnection.server_time
+    for i in range(logins):
+        u = i % users
+        conn, is_bound, name = auth._authenticate(None, {
+            'username': ldapmock.username(u),
+            'password': ldapmock.password(u),
+        })
+        assert is_bound and name == ldapmock.username(u)
+    elapsed = time.monotonic() - start - (ldapmock.LatencyConnection.server_time - server_time)
+    return logins / elapsed, (ldapmock.LatencyConnection.round_trips - trips) / logins
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--logins', type=int, default=500)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--allowed', type=int, default=30, help='number of allowed groups')
+    parser.add_argument('--latency', type=float, default=0.002, help='seconds per LDAP round trip')
+    parser.add_argument('--mirror', action='store_true', help='answer from the posixGroup mirror')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    ns = ldapmock.load_config('10-authenticator.py')
+    server, allowed = ldapmock.make_directory(users=args.users, allowed=args.allowed)
+    MockAuth = ldapmock.mock_authenticator(ns['SLACAuth'], server, args.latency)
+
+    class LegacyAuth(MockAuth):
+        _inAllowedGroups = legacy_in_allowed_groups
+
+    results = []
+    for label, cls in (('before', LegacyAuth), ('after', MockAuth)):
+        auth = cls(config=ns['c'])
+        auth.allowed_groups = allowed
+        if args.mirror and label == 'after':
+            auth.group_mirror_enabled = True
+            auth.group_mirror.load()
+        rate, trips = run(auth, args.logins, args.users)
+        results.append(rate)
+        print('%-7s %8.1f logins/s  %5.1f LDAP round trips/login' % (label, rate, trips))
+    print('speedup %.1fx with %d allowed groups' % (results[1] / results[0], args.allowed))
+
+
+if __name__ == '__main__':
+    main()
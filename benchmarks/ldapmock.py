@@ -0,0 +1,131 @@
+"""Local LDAP stand-in for benchmarking the hub configuration.
+
+Builds an ldap3 MOCK_SYNC directory shaped like SLAC's (ou=Accounts with
+posixAccounts, ou=Group with posixGroups) and connections that sleep for a
+configurable latency on every bind and search, so that round trips cost
+roughly what they cost against ldap01. The mock evaluates every filter
+against every entry in Python, which an indexed directory server does not,
+so the time spent inside the mock is tallied in `server_time` and can be
+subtracted from measurements; the sleep stands in for the real server.
+
+The jupyterhub_config.d files are not importable modules; load_config()
+executes one the way JupyterHub's load_subconfig does and returns its
+namespace, so benchmarks can use SLACAuth / SLACSpawner directly.
+"""
+import os
+import random
+import time
+
+import ldap3
+from traitlets.config import Config
+
+BASE = 'dc=slac,dc=stanford,dc=edu'
+ACCOUNTS = 'ou=Accounts,' + BASE
+GROUPS = 'ou=Group,' + BASE
+CONFIG_D = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config', 'jupyterhub_config.d')
+
+
+def load_config(name, c=None):
+    """Execute config/jupyterhub_config.d/<name> against Config c, return its namespace."""
+    path = os.path.join(CONFIG_D, name)
+    namespace = {
+        'c': c if c is not None else Config(),
+        'load_subconfig': lambda f: None,
+        'get_config': lambda: namespace['c'],
+        '__file__': path,
+    }
+    with open(path) as f:
+        exec(compile(f.read(), path, 'exec'), namespace)
+    return namespace
+
+
+class LatencyConnection(ldap3.Connection):
+    """Mock connection that sleeps `latency` seconds per bind and search."""
+
+    latency = 0.0
+    round_trips = 0
+    server_time = 0.0
+
+    def _round_trip(self, op, *args, **kwargs):
+        time.sleep(self.latency)
+        start = time.monotonic()
+        try:
+            return op(*args, **kwargs)
+        finally:
+            LatencyConnection.round_trips += 1
+            LatencyConnection.server_time += time.monotonic() - start
+
+    def bind(self, *args, **kwargs):
+        return self._round_trip(super().bind, *args, **kwargs)
+
+    def search(self, *args, **kwargs):
+        return self._round_trip(super().search, *args, **kwargs)
+
+
+def username(i):
+    return 'user%04d' % i
+
+
+def password(i):
+    return 'pw-%s' % username(i)
+
+
+def make_directory(users=200, groups=300, allowed=30, groups_per_user=4, seed=0, experiments=()):
+    """Return (server, allowed group DNs) for a populated mock directory.
+
+    Group 0 is everybody's primary group, `allowed` lsst-* groups are the ones an
+    allowed_groups list would name, the rest are unrelated experiment groups.
+    Every user is a memberUid of the last allowed group, the worst case for a
+    sequential allowed_groups check. If `experiments` names groups (say the
+    gnames of node-selectors.yaml), every user also joins one of them.
+    """
+    rnd = random.Random(seed)
+    server = ldap3.Server('mock', get_info=ldap3.OFFLINE_SLAPD_2_4)
+    conn = ldap3.Connection(server, client_strategy=ldap3.MOCK_SYNC)
+    names = ['users'] + ['lsst-%02d' % i for i in range(allowed)]
+    names += [n for n in experiments if n not in names]
+    names += ['exp-%03d' % i for i in range(groups - len(names))]
+    members = dict((n, set()) for n in names)
+    for i in range(users):
+        members[names[allowed]].add(username(i))
+        if experiments:
+            members[rnd.choice(experiments)].add(username(i))
+        for n in rnd.sample(names[allowed + 1:] or names, min(groups_per_user, len(names))):
+            members[n].add(username(i))
+        conn.strategy.add_entry('uid=%s,%s' % (username(i), ACCOUNTS), {
+            'objectClass': ['posixAccount', 'inetOrgPerson'],
+            'uid': username(i),
+            'uidNumber': 10000 + i,
+            'gidNumber': 1000,
+            'cn': username(i),
+            'sn': username(i),
+            'mail': '%s@slac.stanford.edu' % username(i),
+            'userPassword': password(i),
+        })
+    for gid, n in enumerate(names):
+        attrs = {'objectClass': ['posixGroup'], 'cn': n, 'gidNumber': 1000 + gid}
+        if members[n]:
+            attrs['memberUid'] = sorted(members[n])
+        conn.strategy.add_entry('cn=%s,%s' % (n, GROUPS), attrs)
+    allowed_dns = ['cn=%s,%s' % (n, GROUPS) for n in names[1:allowed + 1]]
+    return server, allowed_dns
+
+
+def mock_authenticator(auth_class, server, latency=0.0):
+    """Subclass of auth_class whose user binds and pooled connections go to server."""
+
+    class MockAuth(auth_class):
+
+        def get_connection(self, userdn, password):
+            conn = LatencyConnection(server, user=userdn, password=password,
+                                     client_strategy=ldap3.MOCK_SYNC)
+            conn.latency = latency
+            return conn
+
+        def _pool_connection(self):
+            conn = LatencyConnection(server, client_strategy=ldap3.MOCK_SYNC)
+            conn.latency = latency
+            conn.bind()
+            return conn
+
+    return MockAuth
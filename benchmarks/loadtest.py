@@ -0,0 +1,303 @@
+#!/bin/env python
+"""End-to-end login and spawn load test of the hub configuration.
+
+Drives --users simulated users, --concurrency at a time, through the code
+paths a real login and spawn take, all on one IOLoop as in the hub:
+
+    login            SLACAuth.authenticate
+    options_form     SLACSpawner.get_options_form
+    pre_spawn_start  SLACAuth.pre_spawn_start
+    pod_manifest     SLACSpawner.get_pod_manifest
+
+LDAP is the stand-in of ldapmock.py, with --latency per round trip and a
+group tree in which every user also belongs to one of the experiments named
+in node-selectors.yaml. Kubernetes is a fake CoreV1Api listing --nodes nodes
+per node selector rule, each holding some of the catalog images, and the
+registry is a local HTTP server answering digest lookups after
+--registry-latency. Spawners are KubeSpawner mocks (_mock=True), so nothing
+is sent to a cluster; starting pods is not measured.
+
+Each user spawns a random one of the images their options form offers,
+i.e. that the node selector rules allow for their groups.
+
+Reports spawns/s, p50/p99 per phase and how late the event loop ran a
+10ms timer (event-loop lag); failed spawns are listed apart from the load
+test's own assertion errors. Unlike allowed_groups.py, time the mock spends
+evaluating filters is included: it runs in the LDAP executor threads, and
+competes for the GIL like a slow client library would.
+
+    python benchmarks/loadtest.py --users 500 --concurrency 50 --latency 0.005
+"""
+import argparse
+import glob
+import hashlib
+import logging
+import os
+import random
+import socket
+import time
+
+import yaml
+from kubernetes import client
+from tornado import gen, web
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.locks import Semaphore
+
+import ldapmock
+
+CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config')
+PHASES = ('login', 'options_form', 'pre_spawn_start', 'pod_manifest', 'total')
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+class FakeUser(object):
+    """What SLACAuth and SLACSpawner use of a jupyterhub User."""
+
+    def __init__(self, name, id):
+        self.name = name
+        self.id = id
+        self.url = '/user/%s/' % name
+        self.auth_state = None
+
+    @gen.coroutine
+    def get_auth_state(self):
+        return self.auth_state
+
+    @gen.coroutine
+    def save_auth_state(self, auth_state):
+        self.auth_state = auth_state
+
+    def __str__(self):
+        return '<User(%s 0/1 running)>' % self.name
+
+
+class FakeCoreV1Api(object):
+    """Lists a fixed set of nodes and no pods, the only calls the watchers make before watching."""
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def list_node(self, **kwargs):
+        return client.V1NodeList(items=self.nodes, metadata=client.V1ListMeta(resource_version='1'))
+
+    def list_pod_for_all_namespaces(self, **kwargs):
+        return client.V1PodList(items=[], metadata=client.V1ListMeta(resource_version='1'))
+
+
+def catalog_images(images_d):
+    images = []
+    for path in sorted(glob.glob(os.path.join(images_d, '*.yaml'))):
+        with open(path) as f:
+            images += [i['image'] for i in (yaml.safe_load(f) or {}).get('images') or ()]
+    return images
+
+
+def selector_groups(path):
+    """Every group name a node selector rule filters on."""
+    with open(path) as f:
+        conf = yaml.safe_load(f) or {}
+    names = []
+    for item in conf.get('node_selectors') or ():
+        for name in (item.get('filter') or {}).get('gnames') or ():
+            if name not in names:
+                names.append(name)
+    return names
+
+
+def make_nodes(path, images, per_rule, seed=0):
+    """per_rule nodes for the spawn_on labels of every rule and of node_defaults."""
+    rnd = random.Random(seed)
+    with open(path) as f:
+        conf = yaml.safe_load(f) or {}
+    selectors = [(conf.get('node_defaults') or {}).get('spawn_on', {})]
+    selectors += [item.get('spawn_on', {}) for item in conf.get('node_selectors') or ()]
+    nodes = []
+    for i, spawn_on in enumerate(selectors):
+        for j in range(per_rule):
+            name = 'node-%02d-%02d' % (i, j)
+            labels = dict((k, str(v)) for k, v in spawn_on.items())
+            labels['kubernetes.io/hostname'] = name
+            held = rnd.sample(images, len(images) // 2)
+            nodes.append(client.V1Node(
+                metadata=client.V1ObjectMeta(name=name, labels=labels),
+                status=client.V1NodeStatus(
+                    images=[client.V1ContainerImage(names=['docker.io/' + i]) for i in held],
+                    allocatable={'cpu': '32', 'memory': '256Gi', 'nvidia.com/gpu': '4'},
+                    conditions=[client.V1NodeCondition(type='Ready', status='True')])))
+    return nodes
+
+
+class ManifestHandler(web.RequestHandler):
+    """HEAD /v2/<repository>/manifests/<tag> of a registry, after a delay."""
+
+    def initialize(self, latency):
+        self.latency = latency
+
+    @gen.coroutine
+    def head(self, repository, tag):
+        yield gen.sleep(self.latency)
+        digest = hashlib.sha256(('%s:%s' % (repository, tag)).encode()).hexdigest()
+        self.set_header('Docker-Content-Digest', 'sha256:' + digest)
+
+
+def start_registry(latency):
+    """Serve ManifestHandler on a free local port; returns its base URL."""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    app = web.Application([(r'/v2/(.+)/manifests/([^/]+)', ManifestHandler, {'latency': latency})])
+    HTTPServer(app).listen(port, '127.0.0.1')
+    return 'http://127.0.0.1:%d' % port
+
+
+@gen.coroutine
+def loop_lag(interval, lags, running):
+    """Record how late a timer of `interval` seconds fires while running[0] is true."""
+    while running[0]:
+        start = time.monotonic()
+        yield gen.sleep(interval)
+        lags.append(time.monotonic() - start - interval)
+
+
+@gen.coroutine
+def simulate(auth, spawner_class, config, i, images, rnd, timings, failures):
+    """Log user i in and spawn one of the images the options form offers them."""
+    start = time.perf_counter()
+    name = yield auth.authenticate(None, {
+        'username': ldapmock.username(i),
+        'password': ldapmock.password(i),
+    })
+    if not name:
+        failures.append(('login', i))
+        return
+    mark = time.perf_counter()
+    timings['login'].append(mark - start)
+
+    auth_state = None
+    if isinstance(name, dict):
+        name, auth_state = name['name'], name.get('auth_state')
+    user = FakeUser(name, i)
+    user.auth_state = auth_state
+    spawner = spawner_class(_mock=True, user=user, config=config, authenticator=auth)
+    form = yield spawner.get_options_form()
+    # the form only offers what the node selector rules allow for the user's groups
+    offered = [image for image in images if 'value="%s"' % image in form]
+    assert offered, 'no image offered to %s' % name
+    image = rnd.choice(offered)
+    spawner.user_options = spawner.options_from_form({'kernel_image': [image]})
+    now = time.perf_counter()
+    timings['options_form'].append(now - mark)
+    mark = now
+
+    yield auth.pre_spawn_start(user, spawner)
+    now = time.perf_counter()
+    timings['pre_spawn_start'].append(now - mark)
+    mark = now
+
+    pod = yield spawner.get_pod_manifest()
+    now = time.perf_counter()
+    timings['pod_manifest'].append(now - mark)
+    timings['total'].append(now - start)
+    assert pod.spec.containers[0].image
+
+
+@gen.coroutine
+def run(args):
+    node_selectors = os.path.join(CONFIG, 'node-selectors.yaml')
+    images_d = os.path.join(CONFIG, 'images.d')
+    images = catalog_images(images_d)
+
+    ns = ldapmock.load_config('10-authenticator.py')
+    spawner_ns = ldapmock.load_config('20-spawner.py', ns['c'])
+    c = ns['c']
+    c.SLACSpawner.node_selector_config_file = node_selectors
+    c.SLACSpawner.images_config_d = images_d + '/'
+    c.SLACSpawner.image_registry_urls = {'registry-1.docker.io': start_registry(args.registry_latency)}
+    c.SLACAuth.bind_cache_ttl = args.bind_cache
+    c.SLACAuth.enable_auth_state = args.auth_state
+
+    spawner_class = spawner_ns['SLACSpawner']
+    api = FakeCoreV1Api(make_nodes(node_selectors, images, args.nodes))
+    spawner_class._node_watcher = spawner_ns['NodeWatcher'](api)
+    spawner_class._node_watcher._list_and_update()
+    spawner_class._pod_watcher = spawner_ns['PodRequestWatcher'](api)
+    spawner_class._pod_watcher._list_and_update()
+
+    server, allowed = ldapmock.make_directory(users=args.users, allowed=args.allowed,
+                                              experiments=selector_groups(node_selectors))
+    auth = ldapmock.mock_authenticator(ns['SLACAuth'], server, args.latency)(config=c)
+    auth.allowed_groups = allowed
+    if args.mirror:
+        auth.group_mirror_enabled = True
+        auth.group_mirror.load()
+
+    rnd = random.Random(0)
+    timings = dict((p, []) for p in PHASES)
+    failures = []
+    harness_errors = []
+    lags = []
+    running = [True]
+    lag_monitor = loop_lag(0.01, lags, running)
+
+    slots = Semaphore(args.concurrency)
+
+    @gen.coroutine
+    def one(i):
+        with (yield slots.acquire()):
+            try:
+                yield simulate(auth, spawner_class, c, i % args.users, images, rnd, timings, failures)
+            except AssertionError as e:
+                # the load test's own expectations, not a failed spawn
+                harness_errors.append((str(e) or 'AssertionError', i))
+            except Exception as e:
+                failures.append((type(e).__name__, i))
+
+    start = time.monotonic()
+    yield [one(i) for i in range(args.spawns or args.users)]
+    elapsed = time.monotonic() - start
+    running[0] = False
+    yield lag_monitor
+
+    spawns = len(timings['total'])
+    print('%d spawns in %.1fs: %.1f spawns/s, %d failed, %d harness errors' % (
+        spawns, elapsed, spawns / elapsed, len(failures), len(harness_errors)))
+    print('%-16s %6s %9s %9s %9s' % ('phase', 'n', 'p50 ms', 'p99 ms', 'max ms'))
+    for phase in PHASES:
+        values = timings[phase]
+        print('%-16s %6d %9.1f %9.1f %9.1f' % (phase, len(values), 1000 * percentile(values, 50),
+                                               1000 * percentile(values, 99), 1000 * max(values or [0])))
+    print('%-16s %6d %9.1f %9.1f %9.1f' % ('event loop lag', len(lags), 1000 * percentile(lags, 50),
+                                           1000 * percentile(lags, 99), 1000 * max(lags or [0])))
+    if failures:
+        print('failures: %s' % ', '.join('%s (user %d)' % f for f in failures[:10]))
+    if harness_errors:
+        print('harness errors: %s' % ', '.join('%s (user %d)' % e for e in harness_errors[:10]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--users', type=int, default=200, help='users in the directory')
+    parser.add_argument('--spawns', type=int, default=0, help='logins and spawns to run (default: --users)')
+    parser.add_argument('--concurrency', type=int, default=50, help='users logging in and spawning at once')
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds per LDAP round trip')
+    parser.add_argument('--allowed', type=int, default=30, help='number of allowed groups')
+    parser.add_argument('--nodes', type=int, default=4, help='nodes per node selector rule')
+    parser.add_argument('--registry-latency', type=float, default=0.05, help='seconds per digest lookup')
+    parser.add_argument('--bind-cache', type=float, default=0, help='SLACAuth.bind_cache_ttl')
+    parser.add_argument('--mirror', action='store_true', help='answer groups from the posixGroup mirror')
+    parser.add_argument('--auth-state', action='store_true', help='keep the uid and groups in auth_state')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    IOLoop.current().run_sync(lambda: run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#!/bin/env python
+"""Check that NodeSelectorRules picks the same rule as the old linear walk.
+
+get_pod_manifest used to walk node_selectors in order and take the first
+entry whose filter matched (legacy_match below, the loop as it was, minus
+its logging). NodeSelectorRules answers from group and image indexes
+instead. This compares both on config/node-selectors.yaml and on --configs
+randomly generated rule files (gnames, images and uid filters, entries
+without a filter, empty lists), --lookups random group/image lookups each,
+and fails on the first difference. It also times both.
+
+Run it whenever NodeSelectorRules changes:
+
+    python benchmarks/node_selector_rules.py --configs 500 --lookups 50
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import yaml
+
+import ldapmock
+
+CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config')
+GROUPS = ['lsst', 'lsst-a', 'atlas', 'at', 'bd', 'cdms', 'cryo-em', 'x', 'y']
+IMAGES = ['sciplat-lab', 'slac-jupyterlab-gpu', 'cdms-jupyterlab', 'atlas-jupyterlab-pyroot',
+          'cryosparc-docker', 'other']
+
+
+def legacy_match(config, gnames, image_name):
+    """(spawn_on, spec) as the linear walk of node_selectors found them."""
+    spawn_on = {}
+    spec = {}
+    if 'node_defaults' in config:
+        this = config['node_defaults']
+        if 'spawn_on' in this:
+            spawn_on = this['spawn_on']
+        if 'spec' in this:
+            spec = this['spec']
+    if 'node_selectors' in config:
+        for idx, item in enumerate(config['node_selectors']):
+            if 'filter' in item:
+                this = item['filter']
+                matching = []
+                for n in ('gnames', 'images', 'uid'):
+                    if n in this:
+                        a = []
+                        if n == 'gnames':
+                            a = gnames
+                        elif n == 'images':
+                            a = [image_name, ]
+                        if set(this[n]).intersection(a):
+                            matching.append(True)
+                        else:
+                            matching.append(False)
+                if False in matching:
+                    continue
+                return item['spawn_on'], item['spec']
+    return spawn_on, spec
+
+
+def indexed_match(rules, gnames, image_name):
+    rule = rules.match(gnames, image_name)
+    if rule is None:
+        return rules.default_spawn_on, rules.default_spec
+    return rule.spawn_on, rule.spec
+
+
+def random_config(rnd):
+    selectors = []
+    for i in range(rnd.randint(0, 8)):
+        this = {}
+        for key, pool, p in (('gnames', GROUPS, 0.5), ('images', IMAGES, 0.5), ('uid', ['1000'], 0.1)):
+            if rnd.random() < p:
+                this[key] = rnd.sample(pool, rnd.randint(0, min(3, len(pool))))
+        item = {'name': 'rule-%d' % i, 'spawn_on': {'rule': str(i)}, 'spec': {'index': i}}
+        if rnd.random() < 0.9:
+            item['filter'] = this
+        selectors.append(item)
+    return {'node_defaults': {'spawn_on': {'default': 'true'}, 'spec': {}}, 'node_selectors': selectors}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--configs', type=int, default=500, help='random rule files besides node-selectors.yaml')
+    parser.add_argument('--lookups', type=int, default=50, help='lookups per rule file')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    NodeSelectorRules = ldapmock.load_config('20-spawner.py')['NodeSelectorRules']
+    rnd = random.Random(args.seed)
+    with open(os.path.join(CONFIG, 'node-selectors.yaml')) as f:
+        configs = [yaml.safe_load(f)]
+    configs += [random_config(rnd) for _ in range(args.configs)]
+
+    cases = 0
+    legacy_time = indexed_time = 0.0
+    for config in configs:
+        rules = NodeSelectorRules(config)
+        for _ in range(args.lookups):
+            gnames = rnd.sample(GROUPS, rnd.randint(0, 4))
+            image_name = rnd.choice(IMAGES)
+            start = time.perf_counter()
+            expected = legacy_match(config, gnames, image_name)
+            mid = time.perf_counter()
+            got = indexed_match(rules, gnames, image_name)
+            indexed_time += time.perf_counter() - mid
+            legacy_time += mid - start
+            cases += 1
+            if got != expected:
+                print('MISMATCH for groups %s, image %s:\n  legacy  %s\n  indexed %s\nrules:\n%s' % (
+                    gnames, image_name, expected, got, yaml.safe_dump(config, default_flow_style=False)))
+                sys.exit(1)
+    print('identical on %d lookups over %d rule files' % (cases, len(configs)))
+    print('legacy %.2fus/lookup, indexed %.2fus/lookup' % (1e6 * legacy_time / cases, 1e6 * indexed_time / cases))
+
+
+if __name__ == '__main__':
+    main()
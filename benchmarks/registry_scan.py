@@ -0,0 +1,251 @@
+#!/bin/env python
+"""Replay registry tag pages to the image scanner and to the old serial scan.
+
+utils/lsst-image-scanner.py used to walk the tag pages one at a time with
+urllib (Docker Hub's default 10 tags a page) and sort every tag; it now
+fetches 100 tags a page over keep-alive connections, several pages at once
+or newest first until the kept tags can't change, with ETag revalidation
+when given a cache directory. legacy_scan below is the old fetch loop and
+sort.
+
+A local server replays the tags of registry-tags.json the way
+hub.docker.com pages them (count, next, page and page_size, ETag and
+If-None-Match), --latency seconds per request. The old scan and each mode
+of the new one (streaming, all pages concurrently, a cold then a warm
+cache, through a redirect to another host, and from a registry that
+ignores ordering=last_updated) must keep the same tags;
+the script exits 1 on the first difference, and reports the requests and
+time each took.
+
+registry-tags.json is a tag list in the shape of the lsstsqre/jld-lab
+pages (daily, weekly and release tags, old and current naming, a few
+others), newest first. --record saves a live repository's tags over it:
+
+    python benchmarks/registry_scan.py --latency 0.05
+    python benchmarks/registry_scan.py --record lsstsqre/jld-lab
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import math
+import os
+import random
+import runpy
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIXTURE = os.path.join(HERE, 'registry-tags.json')
+SCANNER = os.path.join(HERE, '..', 'utils', 'lsst-image-scanner.py')
+
+
+def legacy_scan(url, dailies=3, weeklies=2, releases=1):
+    """The tags kept by the serial scan, as ScanRepo.scan did before it fetched pages concurrently."""
+    def convert_time(ts):
+        f = '%Y-%m-%dT%H:%M:%S.%f%Z'
+        if ts[-1] == "Z":
+            ts = ts[:-1] + "UTC"
+        return datetime.datetime.strptime(ts, f)
+
+    results = []
+    page = 1
+    while True:
+        req = urllib.request.Request(url + "?%s" % urllib.parse.urlencode({'page': page}), None,
+                                     {"Accept": "application/json"})
+        j = json.loads(urllib.request.urlopen(req).read().decode("utf-8"))
+        results.extend(j["results"])
+        if "next" not in j or not j["next"]:
+            break
+        page = page + 1
+    candidates = {'r': [], 'w': [], 'd': []}
+    for res in results:
+        if res["name"][0] in candidates:
+            res["comp_ts"] = convert_time(res["last_updated"])
+            candidates[res["name"][0]].append(res)
+    for c in candidates.values():
+        c.sort(key=lambda x: x["comp_ts"], reverse=True)
+    r = {"daily": candidates['d'][:dailies], "weekly": candidates['w'][:weeklies],
+         "release": candidates['r'][:releases]}
+    for tp in r:
+        for v in r[tp]:
+            del v["comp_ts"]
+    return r
+
+
+class RegistryReplay(ThreadingHTTPServer):
+    """Serves one repository's tag pages; with redirect_to, redirects every request there instead."""
+
+    daemon_threads = True
+
+    def __init__(self, tags, latency=0.0, redirect_to=None):
+        super().__init__(('127.0.0.1', 0), ReplayHandler)
+        self.tags = tags
+        self.latency = latency
+        self.redirect_to = redirect_to
+        self.requests = 0
+        self.not_modified = 0
+        self.lock = threading.Lock()
+
+    @property
+    def base(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def reset(self):
+        with self.lock:
+            self.requests = self.not_modified = 0
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        time.sleep(server.latency)
+        if server.redirect_to:
+            self.send_response(301)
+            self.send_header('Location', server.redirect_to + self.path)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        page = int(query.get('page', 1))
+        page_size = min(int(query.get('page_size', 10)), 100)
+        tags = server.tags
+        pages = max(1, int(math.ceil(len(tags) / float(page_size))))
+        if page > pages:
+            self.send_error(404)
+            return
+        model = {
+            'count': len(tags),
+            'next': None,
+            'previous': None,
+            'results': tags[(page - 1) * page_size:page * page_size],
+        }
+        if page < pages:
+            query['page'] = page + 1
+            model['next'] = 'http://%s%s?%s' % (self.headers['Host'], url.path, urllib.parse.urlencode(query))
+        body = json.dumps(model).encode('utf-8')
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            with server.lock:
+                server.not_modified += 1
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def record(repository, path=FIXTURE, host='hub.docker.com'):
+    """Save every tag of a live repository, newest first, as the replay fixture."""
+    url = 'https://%s/v2/repositories/%s/tags' % (host, repository)
+    tags = []
+    page = 1
+    while url:
+        query = urllib.parse.urlencode({'page': page, 'page_size': 100, 'ordering': 'last_updated'})
+        req = urllib.request.Request(url.split('?')[0] + '?' + query, None, {"Accept": "application/json"})
+        j = json.loads(urllib.request.urlopen(req).read().decode('utf-8'))
+        tags.extend(dict((k, t.get(k)) for k in ('name', 'id', 'full_size', 'last_updated')) for t in j['results'])
+        url = j.get('next')
+        page += 1
+    with open(path, 'w') as f:
+        f.write('{"repository": "%s",\n "results": [\n' % repository)
+        f.write(',\n'.join(json.dumps(t, sort_keys=True) for t in tags))
+        f.write('\n]}\n')
+    print('recorded %d tags of %s in %s' % (len(tags), repository, path))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--fixture', default=FIXTURE)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds the replayed registry takes per request')
+    parser.add_argument('--record', metavar='OWNER/NAME', help='save a live repository\'s tags to --fixture and exit')
+    args = parser.parse_args()
+
+    if args.record:
+        record(args.record, args.fixture)
+        return
+
+    with open(args.fixture) as f:
+        fixture = json.load(f)
+    owner, name = fixture['repository'].split('/')
+    ScanRepo = runpy.run_path(SCANNER)['ScanRepo']
+    registry = RegistryReplay(fixture['results'], args.latency).start()
+    redirector = RegistryReplay([], args.latency, redirect_to=registry.base.replace('127.0.0.1', 'localhost')).start()
+    # a registry that ignores ordering=last_updated: the streaming scan must notice and scan every page
+    shuffled = list(fixture['results'])
+    random.Random(0).shuffle(shuffled)
+    unordered = RegistryReplay(shuffled, args.latency).start()
+    host = registry.base.split('://')[1]
+    cache_dir = tempfile.mkdtemp(prefix='registry-scan-')
+
+    def timed(run):
+        servers = (registry, redirector, unordered)
+        for server in servers:
+            server.reset()
+        start = time.perf_counter()
+        data = run()
+        return (data, time.perf_counter() - start, sum(server.requests for server in servers),
+                sum(server.not_modified for server in servers))
+
+    def scan(**kwargs):
+        def run():
+            with ScanRepo(owner=owner, name=name, insecure=True, **dict({'host': host}, **kwargs)) as scanner:
+                scanner.scan()
+                return scanner.get_data()
+        return run
+
+    try:
+        expected, elapsed, requests, _ = timed(lambda: legacy_scan(registry.base + '/v2/repositories/%s/tags' % (
+            fixture['repository'])))
+        print('%-22s %5d requests %7.2fs' % ('serial (old)', requests, elapsed))
+        for label, run in (
+                ('streaming', scan()),
+                ('all pages', scan(streaming=False)),
+                ('streaming, cold cache', scan(cache_dir=cache_dir)),
+                ('streaming, warm cache', scan(cache_dir=cache_dir)),
+                ('all pages, cold cache', scan(cache_dir=cache_dir, streaming=False)),
+                ('all pages, warm cache', scan(cache_dir=cache_dir, streaming=False)),
+                ('redirected', scan(host=redirector.base.split('://')[1])),
+                ('unordered registry', scan(host=unordered.base.split('://')[1]))):
+            data, elapsed, requests, not_modified = timed(run)
+            print('%-22s %5d requests %7.2fs  %d not modified' % (label, requests, elapsed, not_modified))
+            if data != expected:
+                print('MISMATCH (%s):\n  old %s\n  new %s' % (label, json.dumps(expected, sort_keys=True),
+                                                               json.dumps(data, sort_keys=True)))
+                sys.exit(1)
+        print('identical: %s' % ', '.join('%s %s' % (kind, ' '.join(t['name'] for t in tags))
+                                          for kind, tags in sorted(expected.items())))
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        registry.shutdown()
+        redirector.shutdown()
+        unordered.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+#!/bin/env python
+"""How right-sized guarantees pack compared to the configured ones.
+
+Simulates --users users, each working with one image of a few --images
+whose sessions peak at different cpu and memory (lognormal around a
+per-image typical usage, scaled per user). --history past sessions per user
+are fed through the same path as in the hub: pod usage is written to the
+YAML file read by FileUsageSource (the stand-in for metrics-server), polled
+by UsageSampler and recorded in a UsageHistory.
+
+Then every user spawns once more, and the session's guarantees are set by
+three policies:
+
+    configured   the LAB_CPU_GUARANTEE/LAB_MEM_GUARANTEE defaults (0.02, 64K)
+    limits       guarantee = limit
+    rightsized   SLACSpawner's rightsizing: percentile of past peaks times
+                 headroom, clamped between the configured guarantee and limit
+
+Each policy's pods are packed first-fit (largest first) onto nodes of
+--node-cpu/--node-memory, as the scheduler would by requests. Reported are
+the nodes needed, the sessions that peak above their guarantee and the nodes
+whose pods together peak above the node's capacity (throttled or OOM killed).
+
+    python benchmarks/rightsizing.py --users 300 --history 10
+"""
+import argparse
+import logging
+import os
+import random
+import tempfile
+
+import yaml
+from tornado.ioloop import IOLoop
+
+import ldapmock
+
+GI = 2 ** 30
+
+
+def make_population(users, images, seed=0):
+    """{user: (image, cpu scale, memory scale)} and {image: (typical cpu, typical memory)}"""
+    rnd = random.Random(seed)
+    profiles = dict(('image-%d' % i, (rnd.uniform(0.1, 1.5), rnd.uniform(0.5, 6) * GI)) for i in range(images))
+    population = dict(('user%04d' % u, (rnd.choice(sorted(profiles)), rnd.lognormvariate(0, 0.4),
+                                        rnd.lognormvariate(0, 0.4))) for u in range(users))
+    return population, profiles
+
+
+def peak(rnd, population, profiles, user, cpu_limit, mem_limit):
+    image, cpu_scale, mem_scale = population[user]
+    cpu, memory = profiles[image]
+    return (min(cpu_limit, cpu * cpu_scale * rnd.lognormvariate(0, 0.3)),
+            min(mem_limit, memory * mem_scale * rnd.lognormvariate(0, 0.2)))
+
+
+def record_history(ns, population, profiles, sessions, args, rnd):
+    """Run `sessions` rounds of every user's pod through FileUsageSource and UsageSampler."""
+    history = ns['UsageHistory'](size=args.history_size)
+    fd, usage_file = tempfile.mkstemp(suffix='.yaml')
+    os.close(fd)
+    sampler = ns['UsageSampler'](ns['FileUsageSource'](usage_file), history)
+    try:
+        for session in range(sessions):
+            peaks = dict((user, peak(rnd, population, profiles, user, args.cpu_limit, args.mem_limit))
+                         for user in population)
+            # a few samples per session, the last one at the peak
+            for fraction in (0.3, 0.7, 1.0):
+                with open(usage_file, 'w') as f:
+                    yaml.safe_dump(dict(('%s-%d' % (user, session), {
+                        'user': user, 'image': population[user][0],
+                        'cpu': '%dm' % (1000 * cpu * fraction), 'memory': str(int(memory * fraction)),
+                    }) for user, (cpu, memory) in peaks.items()), f)
+                IOLoop.current().run_sync(sampler.poll)
+            with open(usage_file, 'w') as f:
+                f.write('{}\n')
+            IOLoop.current().run_sync(sampler.poll)
+    finally:
+        os.unlink(usage_file)
+    return history
+
+
+def pack(pods, node_cpu, node_memory):
+    """First-fit decreasing of [(cpu request, memory request, cpu peak, memory peak)];
+    returns (nodes, overloaded nodes)."""
+    nodes = []
+    for pod in sorted(pods, key=lambda p: (p[1] / node_memory + p[0] / node_cpu), reverse=True):
+        for node in nodes:
+            if node['cpu'] + pod[0] <= node_cpu and node['memory'] + pod[1] <= node_memory:
+                break
+        else:
+            node = {'cpu': 0, 'memory': 0, 'peak_cpu': 0, 'peak_memory': 0}
+            nodes.append(node)
+        node['cpu'] += pod[0]
+        node['memory'] += pod[1]
+        node['peak_cpu'] += pod[2]
+        node['peak_memory'] += pod[3]
+    overloaded = sum(1 for n in nodes if n['peak_cpu'] > node_cpu or n['peak_memory'] > node_memory)
+    return len(nodes), overloaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--images', type=int, default=5, help='images, each with its own typical usage')
+    parser.add_argument('--history', type=int, default=10, help='past sessions per user')
+    parser.add_argument('--history-size', type=int, default=20, help='SLACSpawner.rightsizing_history_size')
+    parser.add_argument('--percentile', type=float, default=90.0, help='SLACSpawner.rightsizing_percentile')
+    parser.add_argument('--headroom', type=float, default=1.2, help='SLACSpawner.rightsizing_headroom')
+    parser.add_argument('--min-sessions', type=int, default=3, help='SLACSpawner.rightsizing_min_sessions')
+    parser.add_argument('--cpu-limit', type=float, default=4.0)
+    parser.add_argument('--mem-limit', type=float, default=16 * GI)
+    parser.add_argument('--node-cpu', type=float, default=32.0)
+    parser.add_argument('--node-memory', type=float, default=256 * GI)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    ns = ldapmock.load_config('20-spawner.py')
+    rightsized = ns['rightsized']
+    rnd = random.Random(args.seed)
+    population, profiles = make_population(args.users, args.images, args.seed)
+    history = record_history(ns, population, profiles, args.history, args, rnd)
+
+    policies = dict((name, []) for name in ('configured', 'limits', 'rightsized'))
+    for user, (image, _, _) in sorted(population.items()):
+        cpu, memory = peak(rnd, population, profiles, user, args.cpu_limit, args.mem_limit)
+        policies['configured'].append((0.02, 64 * 2 ** 10, cpu, memory))
+        policies['limits'].append((args.cpu_limit, args.mem_limit, cpu, memory))
+        sessions = history.sessions(user, image)
+        if len(sessions) < args.min_sessions:
+            sessions = history.image_sessions(image)
+        if len(sessions) < args.min_sessions:
+            policies['rightsized'].append((0.02, 64 * 2 ** 10, cpu, memory))
+            continue
+        policies['rightsized'].append((
+            rightsized([s[0] for s in sessions], args.percentile, args.headroom, 0.02, args.cpu_limit),
+            rightsized([s[1] for s in sessions], args.percentile, args.headroom, 64 * 2 ** 10, args.mem_limit),
+            cpu, memory))
+
+    print('%d users, %d sessions of history recorded, %d images' % (args.users, len(history), args.images))
+    print('%-12s %10s %12s %8s %12s %12s' % ('policy', 'cpu req', 'mem req GiB', 'nodes', 'overloaded', 'over guar.'))
+    for name in ('configured', 'limits', 'rightsized'):
+        pods = policies[name]
+        nodes, overloaded = pack(pods, args.node_cpu, args.node_memory)
+        over = sum(1 for p in pods if p[2] > p[0] or p[3] > p[1])
+        print('%-12s %10.1f %12.1f %8d %12d %11.1f%%' % (
+            name, sum(p[0] for p in pods), sum(p[1] for p in pods) / GI, nodes, overloaded,
+            100.0 * over / len(pods)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+Event loop stall detector for the hub, off unless LOOP_MONITOR_ENABLED is set.
+
+A heartbeat on the hub's IOLoop records how late it runs (the
+slac_event_loop_lag_seconds histogram). A watchdog thread checks the
+heartbeat; while it is older than LOOP_MONITOR_THRESHOLD seconds the loop
+is stalled, and the watchdog samples the loop thread's stack every
+LOOP_MONITOR_SAMPLE_INTERVAL seconds. Each stall is logged with its most
+frequent stack when it ends. All samples are aggregated in folded format
+(one `frame;frame;frame count` line per stack, as read by flamegraph.pl or
+speedscope) and written to LOOP_MONITOR_OUTPUT every
+LOOP_MONITOR_DUMP_INTERVAL seconds.
+
+While the loop is responsive the cost is one callback and one watchdog
+wake-up per LOOP_MONITOR_INTERVAL.
+"""
+import os
+import sys
+import threading
+import time
+
+from prometheus_client import Counter, Histogram
+from tornado.ioloop import IOLoop, PeriodicCallback
+from traitlets.log import get_logger
+
+LOOP_LAG = Histogram(
+    'slac_event_loop_lag_seconds',
+    'How late the event loop ran a periodic heartbeat',
+    buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, float('inf')),
+)
+LOOP_STALLS = Counter(
+    'slac_event_loop_stalls_total',
+    'Times the event loop was blocked for longer than the stall threshold',
+)
+LOOP_STALL_SECONDS = Counter(
+    'slac_event_loop_stall_seconds_total',
+    'Time the event loop spent blocked in stalls',
+)
+
+
+def folded_stack(frame):
+    """'file:function;...' from the outermost to the innermost frame"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s:%s:%d' % (os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class LoopMonitor(object):
+    """Heartbeat on the loop, and a watchdog thread sampling the loop's stack while the heartbeat is late."""
+
+    def __init__(self, interval=0.1, threshold=0.5, sample_interval=0.01,
+                 output=None, dump_interval=300, log=None):
+        self.interval = interval
+        self.threshold = threshold
+        self.sample_interval = sample_interval
+        self.output = output
+        self.dump_interval = dump_interval
+        self.log = log
+        self.samples = {}
+        self._lock = threading.Lock()
+        self._beat = time.monotonic()
+        self._loop_thread = None
+        self._callback = None
+        self._dumped = None
+
+    def start(self, loop=None):
+        """Install the heartbeat on loop (the current one by default) and start the watchdog."""
+        (loop or IOLoop.current()).add_callback(self._start_heartbeat)
+
+    def _start_heartbeat(self):
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._callback = PeriodicCallback(self._heartbeat, self.interval * 1000)
+        self._callback.start()
+        threading.Thread(target=self._watch, name='loop-monitor', daemon=True).start()
+
+    def _heartbeat(self):
+        now = time.monotonic()
+        LOOP_LAG.observe(max(0.0, now - self._beat - self.interval))
+        self._beat = now
+
+    def _watch(self):
+        last_dump = time.monotonic()
+        while True:
+            time.sleep(self.interval)
+            stalled_since = self._beat
+            if time.monotonic() - stalled_since > self.threshold:
+                self._sample_stall(stalled_since)
+            if self.output and time.monotonic() - last_dump > self.dump_interval:
+                last_dump = time.monotonic()
+                try:
+                    self.dump()
+                except Exception as e:
+                    if self.log:
+                        self.log.warn("Could not write loop profile %s: %s" % (self.output, e))
+
+    def _sample_stall(self, stalled_since):
+        """Sample the loop thread until its heartbeat runs again."""
+        stall = {}
+        while self._beat == stalled_since:
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is not None:
+                stack = folded_stack(frame)
+                stall[stack] = stall.get(stack, 0) + 1
+            del frame
+            time.sleep(self.sample_interval)
+        duration = self._beat - stalled_since - self.interval
+        LOOP_STALLS.inc()
+        LOOP_STALL_SECONDS.inc(duration)
+        with self._lock:
+            for stack, count in stall.items():
+                self.samples[stack] = self.samples.get(stack, 0) + count
+        if self.log and stall:
+            stack, count = max(stall.items(), key=lambda kv: kv[1])
+            self.log.warn("Event loop blocked for %.2fs; in %d of %d samples: %s" % (
+                duration, count, sum(stall.values()), stack.replace(';', ' > ')))
+
+    def folded(self):
+        with self._lock:
+            return ''.join('%s %d\n' % kv for kv in sorted(self.samples.items()))
+
+    def dump(self):
+        """Write the stacks sampled since the hub started to output, when there are new ones."""
+        text = self.folded()
+        if text == self._dumped:
+            return
+        tmp = self.output + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, self.output)
+        self._dumped = text
+
+
+if os.getenv('LOOP_MONITOR_ENABLED'):
+    loop_monitor = LoopMonitor(
+        interval=float(os.getenv('LOOP_MONITOR_INTERVAL') or 0.1),
+        threshold=float(os.getenv('LOOP_MONITOR_THRESHOLD') or 0.5),
+        sample_interval=float(os.getenv('LOOP_MONITOR_SAMPLE_INTERVAL') or 0.01),
+        output=os.getenv('LOOP_MONITOR_OUTPUT') or '/tmp/hub-loop-stalls.folded',
+        dump_interval=float(os.getenv('LOOP_MONITOR_DUMP_INTERVAL') or 300),
+        log=get_logger(),
+    )
+    loop_monitor.start()
@@ -9,21 +9,524 @@ from ldap3.utils.conv import escape_filter_chars
 import ldapauthenticator
 from jupyterhub.auth import Authenticator
 
-from traitlets import Unicode, Int, Bool, List, Union
+from traitlets import Unicode, Int, Bool, List, Union, Float
 
 import os
 import json
 #import oauthenticator
 #from oauthenticator.common import next_page_from_links
+from prometheus_client import Counter, Gauge, Histogram
 from tornado import gen
+from tornado.ioloop import IOLoop, PeriodicCallback
 import re
+import hashlib
+import hmac
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+IDENTITY_LOOKUP_DURATION = Histogram(
+    'slac_ldap_identity_lookup_duration_seconds',
+    'Time to resolve the uid and groups of a user in pre_spawn_start',
+    ['image'],
+)
+LDAP_POOL_SIZE = Gauge('slac_ldap_pool_size', 'Maximum number of pooled LDAP connections')
+LDAP_POOL_IN_USE = Gauge('slac_ldap_pool_in_use', 'Pooled LDAP connections currently checked out')
+LDAP_POOL_IDLE = Gauge('slac_ldap_pool_idle', 'Pooled LDAP connections open and idle')
+LDAP_POOL_WAIT_TIME = Histogram(
+    'slac_ldap_pool_wait_seconds',
+    'Time checkouts that found no free pooled LDAP connection waited for one',
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, float('inf')),
+)
+LDAP_POOL_TIMEOUTS = Counter(
+    'slac_ldap_pool_timeouts_total',
+    'Checkouts that gave up waiting for a pooled LDAP connection',
+)
+BIND_CACHE_LOGINS = Counter(
+    'slac_ldap_bind_cache_logins_total',
+    'Logins through the verified bind cache, by whether they bound (miss), reused a recent bind (hit) or shared a concurrent one (coalesced)',
+    ['result'],
+)
+
+
+def normalize_dn(dn):
+    """Lower-cased dn without blanks around separators, for comparing DNs."""
+    return ','.join( re.sub(r'\s*=\s*', '=', part.strip()) for part in re.split(r'(?<!\\),', dn.lower()) )
+
+
+def split_dn(dn):
+    """Split dn into its first RDN and the parent DN."""
+    parts = re.split(r'(?<!\\),', dn, 1)
+    return parts[0].strip(), (parts[1].strip() if len(parts) > 1 else '')
+
+
+class LDAPLookupError(Exception):
+    """The directory answered, but the user could not be resolved."""
+
+
+class LDAPPoolTimeout(Exception):
+    """No pooled LDAP connection became free in time."""
+
+
+class LDAPConnectionPool(object):
+    """Bounded pool of pre-bound ldap3 connections for use from worker threads.
+
+    At most `size` connections exist at any time; callers wait up to `timeout`
+    seconds for one to become free. Connections idle for longer than `max_idle`
+    are checked with a root DSE read before reuse, and connections that raised
+    an LDAP or socket error are dropped instead of being returned to the pool.
+    """
+
+    def __init__(self, factory, size=4, timeout=10, max_idle=60, log=None):
+        self.factory = factory
+        self.size = size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.log = log
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._idle = []
+        self.in_use = 0
+        self.created = 0
+        self.discarded = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self.size,
+                'open': len(self._idle) + self.in_use,
+                'in_use': self.in_use,
+                'idle': len(self._idle),
+                'created': self.created,
+                'discarded': self.discarded,
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                'wait_time': self.wait_time,
+                'max_wait_time': self.max_wait_time,
+            }
+
+    def _healthy(self, conn, last_used):
+        if conn.closed or not conn.bound:
+            return False
+        if time.monotonic() - last_used < self.max_idle:
+            return True
+        try:
+            return conn.search('', '(objectClass=*)', search_scope=ldap3.BASE,
+                               attributes=[ldap3.NO_ATTRIBUTES])
+        except Exception:
+            return False
+
+    def _discard(self, conn):
+        with self._lock:
+            self.discarded += 1
+        try:
+            conn.unbind()
+        except Exception:
+            pass
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, last_used = self._idle.pop()
+            if self._healthy(conn, last_used):
+                return conn
+            self._discard(conn)
+        conn = self.factory()
+        with self._lock:
+            self.created += 1
+        return conn
+
+    @contextmanager
+    def connection(self):
+        start = time.monotonic()
+        if not self._slots.acquire(blocking=False):
+            if not self._slots.acquire(timeout=self.timeout):
+                with self._lock:
+                    self.timeouts += 1
+                LDAP_POOL_TIMEOUTS.inc()
+                raise LDAPPoolTimeout('no LDAP connection available after %ss (%d in use)' % (self.timeout, self.in_use))
+            waited = time.monotonic() - start
+            with self._lock:
+                self.waits += 1
+                self.wait_time += waited
+                self.max_wait_time = max(self.max_wait_time, waited)
+            LDAP_POOL_WAIT_TIME.observe(waited)
+            if self.log and waited > 1:
+                self.log.warn("Waited %.1fs for an LDAP connection: %s" % (waited, self.stats()))
+        try:
+            conn = self._checkout()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.in_use += 1
+            self.checkouts += 1
+        reusable = True
+        try:
+            yield conn
+        except (ldap3.core.exceptions.LDAPException, OSError):
+            reusable = False
+            raise
+        finally:
+            with self._lock:
+                self.in_use -= 1
+                if reusable:
+                    self._idle.append((conn, time.monotonic()))
+            if not reusable:
+                self._discard(conn)
+            self._slots.release()
+
+
+class IdentityCache(object):
+    """Bounded LRU cache of resolved (uidNumber, group tuples), used from the event loop.
+
+    An entry is served as is for `ttl` seconds. For a further `stale_ttl` seconds the
+    old value is still served, but a background refresh is started. LDAPLookupError
+    answers ("not found") are cached for `negative_ttl` seconds. Concurrent lookups of
+    the same username share a single call to `lookup`.
+    """
+
+    def __init__(self, lookup, size=1024, ttl=600, stale_ttl=3600, negative_ttl=60, log=None):
+        self.lookup = lookup
+        self.size = size
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
+        self.log = log
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.refreshes = 0
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'inflight': len(self._inflight),
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'refreshes': self.refreshes,
+        }
+
+    def invalidate(self, username):
+        self._entries.pop(username, None)
+
+    def _store(self, username, value, error):
+        self._entries[username] = (time.monotonic(), value, error)
+        self._entries.move_to_end(username)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    @gen.coroutine
+    def _fetch(self, username):
+        try:
+            uid, groups = yield self.lookup(username)
+        except LDAPLookupError as e:
+            self._store(username, None, str(e))
+            raise
+        value = (uid, tuple(groups))
+        self._store(username, value, None)
+        return value
+
+    def _refresh(self, username):
+        future = self._inflight.get(username)
+        if future is not None:
+            self.coalesced += 1
+            return future
+        self.refreshes += 1
+        future = self._fetch(username)
+
+        def _done(f):
+            if self._inflight.get(username) is f:
+                del self._inflight[username]
+        self._inflight[username] = future
+        future.add_done_callback(_done)
+        return future
+
+    def _log_refresh(self, username, future):
+        try:
+            future.result()
+        except LDAPLookupError as e:
+            if self.log:
+                self.log.warn("Background identity refresh for %s: %s" % (username, e))
+        except Exception as e:
+            # keep serving the stale entry until it expires
+            if self.log:
+                self.log.warn("Background identity refresh for %s failed: %s" % (username, e))
+
+    @gen.coroutine
+    def get(self, username):
+        """Return (uidNumber, [group tuples]) for username, raising LDAPLookupError if unknown."""
+        entry = self._entries.get(username)
+        if entry is not None:
+            stored, value, error = entry
+            age = time.monotonic() - stored
+            if error is not None:
+                if age < self.negative_ttl:
+                    self.negative_hits += 1
+                    self._entries.move_to_end(username)
+                    raise LDAPLookupError(error)
+            elif age < self.ttl:
+                self.hits += 1
+                self._entries.move_to_end(username)
+                return value[0], list(value[1])
+            elif age < self.ttl + self.stale_ttl:
+                self.stale_hits += 1
+                self._entries.move_to_end(username)
+                future = self._refresh(username)
+                future.add_done_callback(lambda f: self._log_refresh(username, f))
+                return value[0], list(value[1])
+        self.misses += 1
+        uid, groups = yield self._refresh(username)
+        return uid, list(groups)
+
+
+class PosixGroupMirror(object):
+    """In-memory copy of the posixGroup entries below a search base.
+
+    load() pages through every group. refresh() only asks for entries whose
+    modifyTimestamp is at or past the newest one seen so far, and does a full
+    load() every `full_interval` seconds so that deleted groups disappear too
+    (or every time, if the server does not return modifyTimestamp). The gidNumber
+    and memberUid indexes are rebuilt on the side and swapped in with a single
+    assignment, so lookups from other threads never see a half-built mirror.
+    """
+
+    attributes = ['cn', 'gidNumber', 'memberUid', 'modifyTimestamp']
+
+    def __init__(self, pool, search_base, page_size=500, full_interval=21600, log=None):
+        self.pool = pool
+        self.search_base = search_base
+        self.page_size = page_size
+        self.full_interval = full_interval
+        self.log = log
+        # (groups by dn, cn by gidNumber, [(cn, gidNumber)] by memberUid)
+        self._state = None
+        self._newest = None
+        self._loaded = None
+        self.full_loads = 0
+        self.delta_loads = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def ready(self):
+        return self._state is not None
+
+    def stats(self):
+        state = self._state
+        return {
+            'groups': len(state[0]) if state else 0,
+            'members': len(state[2]) if state else 0,
+            'full_loads': self.full_loads,
+            'delta_loads': self.delta_loads,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    @staticmethod
+    def _first(value):
+        if isinstance(value, (list, tuple)):
+            return value[0] if value else None
+        return value
+
+    def _search(self, search_filter):
+        with self.pool.connection() as conn:
+            entries = conn.extend.standard.paged_search(
+                self.search_base, search_filter,
+                search_scope=ldap3.SUBTREE,
+                attributes=self.attributes,
+                paged_size=self.page_size,
+                generator=False
+            )
+            groups = {}
+            newest = None
+            for entry in entries:
+                if entry.get('type') != 'searchResEntry':
+                    continue
+                attrs = entry['attributes']
+                members = attrs.get('memberUid') or []
+                if isinstance(members, str):
+                    members = [members]
+                groups[normalize_dn(entry['dn'])] = (
+                    self._first(attrs.get('cn')),
+                    self._first(attrs.get('gidNumber')),
+                    frozenset(members)
+                )
+                stamp = self._first(entry.get('raw_attributes', {}).get('modifyTimestamp'))
+                if stamp:
+                    stamp = stamp.decode() if isinstance(stamp, bytes) else str(stamp)
+                    if newest is None or stamp > newest:
+                        newest = stamp
+            return groups, newest
+
+    def _swap(self, groups, newest):
+        by_gid = {}
+        by_member = {}
+        for cn, gid, members in groups.values():
+            if cn is None or gid is None:
+                continue
+            by_gid.setdefault(str(gid), cn)
+            for m in members:
+                by_member.setdefault(m, []).append((cn, gid))
+        self._state = (groups, by_gid, by_member)
+        self._newest = newest
+
+    def load(self):
+        """Page through all posixGroups and replace the mirror."""
+        start = time.monotonic()
+        groups, newest = self._search('(objectclass=posixGroup)')
+        self._swap(groups, newest)
+        self._loaded = time.monotonic()
+        self.full_loads += 1
+        if self.log:
+            self.log.info("Loaded %d posixGroups from %s in %.1fs" % (len(groups), self.search_base, self._loaded - start))
+
+    def refresh(self):
+        """Apply groups modified since the last load, or reload everything when due."""
+        if (self._state is None or self._newest is None
+                or time.monotonic() - self._loaded >= self.full_interval):
+            return self.load()
+        changed, newest = self._search(
+            '(&(objectclass=posixGroup)(modifyTimestamp>=%s))' % self._newest)
+        groups = self._state[0]
+        changed = dict((dn, g) for dn, g in changed.items() if groups.get(dn) != g)
+        self.delta_loads += 1
+        if not changed:
+            return
+        groups = dict(groups)
+        groups.update(changed)
+        self._swap(groups, max(newest or self._newest, self._newest))
+        if self.log:
+            self.log.info("Updated %d posixGroups in mirror of %s" % (len(changed), self.search_base))
+
+    def gid_cn(self, gid):
+        """cn of the group with gidNumber gid, or None if it is not mirrored."""
+        state = self._state
+        cn = state[1].get(str(gid)) if state else None
+        if cn is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return cn
+
+    def members_of(self, dn):
+        """memberUids of the group with the given normalized dn, or None if it is not mirrored."""
+        state = self._state
+        group = state[0].get(dn) if state else None
+        return group[2] if group else None
+
+    def member_groups(self, username):
+        """[(cn, gidNumber)] of the groups listing username as memberUid."""
+        state = self._state
+        return list(state[2].get(username, ())) if state else []
+
+
+class VerifiedBindCache(object):
+    """Short-lived memory of successful logins, used from the event loop.
+
+    Entries are keyed by username and hold a PBKDF2 hash of the password, salted
+    with a per-process random salt and the username; the password itself is never
+    kept. A login whose hash matches an entry younger than `ttl` seconds skips LDAP.
+    Concurrent attempts with the same username and password share one bind.
+    Logins are counted in slac_ldap_bind_cache_logins_total by result.
+    """
+
+    def __init__(self, run, ttl=60, iterations=50000, size=4096, log=None):
+        self.run = run
+        self.ttl = ttl
+        self.iterations = iterations
+        self.size = size
+        self.log = log
+        self._salt = os.urandom(16)
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self.binds = 0
+        self.cached = 0
+        self.coalesced = 0
+
+    @property
+    def saved(self):
+        return self.cached + self.coalesced
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'binds': self.binds,
+            'cached': self.cached,
+            'coalesced': self.coalesced,
+            'saved': self.saved,
+        }
+
+    def _digest(self, username, password):
+        return hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'),
+                                   self._salt + username.encode('utf-8'), self.iterations)
+
+    def _store(self, username, digest, result):
+        self._entries[username] = (time.monotonic() + self.ttl, digest, result)
+        self._entries.move_to_end(username)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    @gen.coroutine
+    def _bind(self, key, bind):
+        try:
+            result = yield bind()
+        finally:
+            self._inflight.pop(key, None)
+        # a failed bind (None) must not be replayed to the next attempt
+        if result:
+            self._store(key[0], key[1], result)
+        return result
+
+    @gen.coroutine
+    def authenticate(self, username, password, bind):
+        """Return the result of a successful bind() for username/password, reusing a recent one."""
+        digest = yield self.run(self._digest, username, password)
+        entry = self._entries.get(username)
+        if entry is not None:
+            expires, cached_digest, result = entry
+            if expires < time.monotonic():
+                del self._entries[username]
+            elif hmac.compare_digest(cached_digest, digest):
+                self.cached += 1
+                BIND_CACHE_LOGINS.labels('hit').inc()
+                if self.log:
+                    self.log.debug("Reusing verified bind of %s (%d binds saved)" % (username, self.saved))
+                return result
+        key = (username, digest)
+        future = self._inflight.get(key)
+        if future is None:
+            self.binds += 1
+            BIND_CACHE_LOGINS.labels('miss').inc()
+            future = self._inflight[key] = self._bind(key, bind)
+        else:
+            self.coalesced += 1
+            BIND_CACHE_LOGINS.labels('coalesced').inc()
+        result = yield future
+        return result
 
 
 class SLACAuth(ldapauthenticator.LDAPAuthenticator):
     """ Authenticator for SLAC to use LSST kubespaner
     """
-    enable_auth_state = False
-    _state = {}
 
     group_search_base = Unicode(
         config=True,
@@ -44,6 +547,251 @@ class SLACAuth(ldapauthenticator.LDAPAuthenticator):
         """
     )
 
+    ldap_pool_size = Int(
+        config=True,
+        default_value=4,
+        help="""
+        Maximum number of pooled, pre-bound LDAP connections used for user and group lookups.
+        """
+    )
+
+    ldap_pool_timeout = Float(
+        config=True,
+        default_value=10.0,
+        help="""
+        Seconds to wait for a free pooled LDAP connection before giving up.
+        """
+    )
+
+    ldap_pool_max_idle = Float(
+        config=True,
+        default_value=60.0,
+        help="""
+        Pooled connections idle for longer than this many seconds are health-checked before reuse.
+        """
+    )
+
+    ldap_timeout = Float(
+        config=True,
+        default_value=10.0,
+        help="""
+        Connect and receive timeout, in seconds, of pooled LDAP connections.
+        """
+    )
+
+    ldap_threads = Int(
+        config=True,
+        default_value=8,
+        help="""
+        Number of worker threads running LDAP binds and searches off the event loop.
+        """
+    )
+
+    identity_cache_size = Int(
+        config=True,
+        default_value=1024,
+        help="""
+        Maximum number of users whose uid and groups are kept in memory.
+        """
+    )
+
+    identity_cache_ttl = Float(
+        config=True,
+        default_value=600.0,
+        help="""
+        Seconds a resolved uid and group list is used without asking LDAP again.
+        """
+    )
+
+    identity_cache_stale_ttl = Float(
+        config=True,
+        default_value=3600.0,
+        help="""
+        Seconds after identity_cache_ttl during which the old uid and groups are still used
+        while they are refreshed in the background.
+        """
+    )
+
+    identity_cache_negative_ttl = Float(
+        config=True,
+        default_value=60.0,
+        help="""
+        Seconds a "user not found" answer from LDAP is remembered.
+        """
+    )
+
+    identity_prefetch_enabled = Bool(
+        config=True,
+        default_value=True,
+        help="""
+        Start resolving the uid and groups of a user in the background as soon as they log in,
+        so that the options form and pre_spawn_start find them in the identity cache.
+        """
+    )
+
+    auth_state_identity_ttl = Float(
+        config=True,
+        default_value=3600.0,
+        help="""
+        Seconds the uid and groups stored in auth_state are used as they are by pre_spawn_start.
+        """
+    )
+
+    auth_state_identity_max_age = Float(
+        config=True,
+        default_value=7 * 86400.0,
+        help="""
+        Seconds after which the uid and groups in auth_state are no longer used. Between
+        auth_state_identity_ttl and this age they are used, and refreshed in the background.
+        """
+    )
+
+    group_mirror_enabled = Bool(
+        config=True,
+        default_value=False,
+        help="""
+        Keep an in-memory copy of the posixGroups under group_search_base and answer
+        group lookups from it, falling back to LDAP for unknown gidNumbers.
+        Memberships are taken from memberUid, as in the default group_search_filter.
+        """
+    )
+
+    group_mirror_refresh_interval = Float(
+        config=True,
+        default_value=300.0,
+        help="""
+        Seconds between incremental (modifyTimestamp based) refreshes of the group mirror.
+        """
+    )
+
+    group_mirror_full_interval = Float(
+        config=True,
+        default_value=21600.0,
+        help="""
+        Seconds between full reloads of the group mirror, which also drop deleted groups.
+        """
+    )
+
+    group_mirror_page_size = Int(
+        config=True,
+        default_value=500,
+        help="""
+        Page size of the paged search used to load the group mirror.
+        """
+    )
+
+    bind_cache_ttl = Float(
+        config=True,
+        default_value=0.0,
+        help="""
+        Seconds a successful login is remembered, so that repeated or concurrent logins with
+        the same username and password do not bind to LDAP again. 0 disables the cache.
+        Only a salted PBKDF2 hash of the password is kept.
+        """
+    )
+
+    bind_cache_iterations = Int(
+        config=True,
+        default_value=50000,
+        help="""
+        PBKDF2 iterations used to hash passwords for the bind cache.
+        """
+    )
+
+    _ldap_pool = None
+    _ldap_executor = None
+    _identity_cache = None
+    _bind_cache = None
+    _group_mirror = None
+    _group_mirror_refreshing = False
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        if self.group_mirror_enabled:
+            IOLoop.current().add_callback(self._start_group_mirror)
+
+    @property
+    def ldap_pool(self):
+        if self._ldap_pool is None:
+            pool = LDAPConnectionPool( self._pool_connection,
+                size=self.ldap_pool_size, timeout=self.ldap_pool_timeout,
+                max_idle=self.ldap_pool_max_idle, log=self.log )
+            LDAP_POOL_SIZE.set( pool.size )
+            LDAP_POOL_IN_USE.set_function( lambda: pool.in_use )
+            LDAP_POOL_IDLE.set_function( lambda: len(pool._idle) )
+            self._ldap_pool = pool
+        return self._ldap_pool
+
+    @property
+    def ldap_executor(self):
+        if self._ldap_executor is None:
+            self._ldap_executor = ThreadPoolExecutor( self.ldap_threads )
+        return self._ldap_executor
+
+    @property
+    def identity_cache(self):
+        if self._identity_cache is None:
+            self._identity_cache = IdentityCache(
+                lambda username: self.run_ldap( self._getUserGroup, username ),
+                size=self.identity_cache_size, ttl=self.identity_cache_ttl,
+                stale_ttl=self.identity_cache_stale_ttl,
+                negative_ttl=self.identity_cache_negative_ttl, log=self.log )
+        return self._identity_cache
+
+    @property
+    def group_mirror(self):
+        if self._group_mirror is None:
+            self._group_mirror = PosixGroupMirror( self.ldap_pool, self.group_search_base,
+                page_size=self.group_mirror_page_size,
+                full_interval=self.group_mirror_full_interval, log=self.log )
+        return self._group_mirror
+
+    @gen.coroutine
+    def _start_group_mirror(self):
+        yield self._refresh_group_mirror()
+        PeriodicCallback( lambda: IOLoop.current().spawn_callback(self._refresh_group_mirror),
+                          self.group_mirror_refresh_interval * 1000 ).start()
+
+    @gen.coroutine
+    def _refresh_group_mirror(self):
+        if self._group_mirror_refreshing:
+            return
+        self._group_mirror_refreshing = True
+        try:
+            yield self.run_ldap( self.group_mirror.refresh )
+        except Exception as e:
+            self.log.warn("Could not refresh posixGroup mirror: %s" % (e,))
+        finally:
+            self._group_mirror_refreshing = False
+
+    @property
+    def bind_cache(self):
+        if self._bind_cache is None:
+            self._bind_cache = VerifiedBindCache( self.run_ldap, ttl=self.bind_cache_ttl,
+                iterations=self.bind_cache_iterations, log=self.log )
+        return self._bind_cache
+
+    def prefetch_identity(self, username):
+        """Start an identity cache lookup of username without waiting for it."""
+        def _done(f):
+            try:
+                f.result()
+            except Exception as e:
+                self.log.warn("Identity prefetch for %s failed: %s" % (username, e))
+        self.identity_cache.get( username ).add_done_callback( _done )
+
+    def run_ldap(self, fn, *args):
+        """Run blocking ldap3 work on the LDAP worker threads."""
+        return IOLoop.current().run_in_executor( self.ldap_executor, fn, *args )
+
+    def _pool_connection(self):
+        server = ldap3.Server( self.server_address, port=self.server_port, use_ssl=self.use_ssl,
+                               connect_timeout=self.ldap_timeout )
+        conn = ldap3.Connection( server, receive_timeout=self.ldap_timeout )
+        if not conn.bind():
+            raise ldap3.core.exceptions.LDAPBindError( 'anonymous bind to %s failed: %s' % (self.server_address, conn.result) )
+        return conn
+
 
     @gen.coroutine
     def pre_spawn_start(self, user, spawner):
@@ -61,17 +809,84 @@ class SLACAuth(ldapauthenticator.LDAPAuthenticator):
 
         # We are running the Lab at the far end, not the old Notebook
         spawner.default_url = '/lab'
+        # tags may be re-pushed; only used when the tag cannot be resolved to a digest
+        # (see SLACSpawner.image_digest_enabled)
         spawner.image_pull_policy = 'Always'
 
         # set uid and gid permissions
         u = str(user).split()[0].replace('<User(','') # wow... hack or what?
-        ext_uid, ext_groups = self._getUserGroup( u )
+        image = (spawner.user_options or {}).get('kernel_image') or spawner.image or ''
+        lookup_start = time.perf_counter()
+        ext_uid, ext_groups = yield self._spawn_identity( user, u )
+        # the spawner keeps the label to catalog images; anything else is 'other'
+        image_label = spawner.image_label( image ) if hasattr( spawner, 'image_label' ) else 'other'
+        IDENTITY_LOOKUP_DURATION.labels( image_label ).observe( time.perf_counter() - lookup_start )
         spawner.environment['EXTERNAL_UID'] = str(ext_uid)
         spawner.environment['EXTERNAL_GROUPS'] = ','.join( ext_groups )
         spawner.user_gids = ext_groups
 
-        self.log.info("Spawning for %s with environment: %s" % (str(user), json.dumps(spawner.environment)) ) 
+        self.log.info("Spawning for %s" % (str(user),) )
+        self.log.debug("Spawning for %s with environment: %s" % (str(user), json.dumps(spawner.environment)) )
+
+
+    @staticmethod
+    def identity_state(uid, groups):
+        """auth_state entries for a resolved uidNumber and 'cn:gidNumber' group tuples (primary first)."""
+        return {
+            'uid': uid,
+            'gid': int(groups[0].rsplit(':', 1)[1]) if groups else None,
+            'groups': list(groups),
+            'resolved': time.time(),
+        }
+
+    @gen.coroutine
+    def _save_identity(self, user, auth_state, uid, groups):
+        state = dict(auth_state or {})
+        state.update( self.identity_state( uid, groups ) )
+        yield user.save_auth_state( state )
+
+    @gen.coroutine
+    def _refresh_identity(self, user, username, auth_state):
+        try:
+            uid, groups = yield self.identity_cache.get( username )
+            yield self._save_identity( user, auth_state, uid, groups )
+        except Exception as e:
+            self.log.warn("Background refresh of the identity of %s failed: %s" % (username, e))
 
+    @gen.coroutine
+    def _store_login_identity(self, handler, username, lookup):
+        """Write the identity to auth_state once lookup resolves and the login request is done."""
+        try:
+            uid, groups = yield lookup
+        except Exception as e:
+            self.log.warn("Not storing the identity of %s in auth_state: %s" % (username, e))
+            return
+        # the login saves the auth_state authenticate() returned; write ours after it
+        deadline = time.monotonic() + 60
+        while not handler._finished and time.monotonic() < deadline:
+            yield gen.sleep( 0.1 )
+        user = handler.find_user( username )
+        if user is None:
+            return
+        auth_state = yield user.get_auth_state()
+        yield self._save_identity( user, auth_state, uid, groups )
+
+    @gen.coroutine
+    def _spawn_identity(self, user, username):
+        """(uidNumber, group tuples) of user: from auth_state while fresh enough, else from the identity cache."""
+        auth_state = None
+        if self.enable_auth_state:
+            auth_state = yield user.get_auth_state()
+        if auth_state and auth_state.get('groups') and 'resolved' in auth_state:
+            age = time.time() - auth_state['resolved']
+            if age < self.auth_state_identity_max_age:
+                if age >= self.auth_state_identity_ttl:
+                    IOLoop.current().spawn_callback( self._refresh_identity, user, username, auth_state )
+                return auth_state['uid'], list(auth_state['groups'])
+        uid, groups = yield self.identity_cache.get( username )
+        if self.enable_auth_state:
+            yield self._save_identity( user, auth_state, uid, groups )
+        return uid, groups
 
     def _authenticate(self, handler, data):
         username = data['username']
@@ -173,29 +988,7 @@ class SLACAuth(ldapauthenticator.LDAPAuthenticator):
 
         if self.allowed_groups:
             self.log.debug('username:%s Using dn %s', username, userdn)
-            found = False
-            for group in self.allowed_groups:
-                group_filter = (
-                    '(|'
-                    '(member={userdn})'
-                    '(uniqueMember={userdn})'
-                    '(memberUid={uid})'
-                    ')'
-                )
-                group_filter = group_filter.format(
-                    userdn=userdn,
-                    uid=username
-                )
-                group_attributes = ['member', 'uniqueMember', 'memberUid']
-                found = conn.search(
-                    group,
-                    search_scope=ldap3.BASE,
-                    search_filter=group_filter,
-                    attributes=group_attributes
-                )
-                if found:
-                    break
-            if not found:
+            if not self._inAllowedGroups( conn, userdn, username ):
                 # If we reach here, then none of the groups matched
                 msg = 'username:{username} User not in any of the allowed groups'
                 self.log.warn(msg.format(username=username))
@@ -203,41 +996,94 @@ class SLACAuth(ldapauthenticator.LDAPAuthenticator):
 
         return conn, is_bound, username
 
+    def _inAllowedGroups( self, conn, userdn, username ):
+        """True if userdn/username is a member of any of allowed_groups.
+
+        Groups known to the posixGroup mirror are answered from memory. The rest are
+        checked with one LEVEL search per distinct parent DN (normally just one),
+        OR-ing the RDNs of all allowed groups below it, so the cost of a login does
+        not grow with the number of allowed groups.
+        """
+        allowed = dict( (normalize_dn(g), g) for g in self.allowed_groups )
+        if self.group_mirror_enabled and self.group_mirror.ready:
+            remaining = {}
+            for key, group in allowed.items():
+                members = self.group_mirror.members_of( key )
+                if members is None:
+                    remaining[key] = group
+                elif username in members:
+                    return True
+            allowed = remaining
+
+        member_filter = (
+            '(|'
+            '(member={userdn})'
+            '(uniqueMember={userdn})'
+            '(memberUid={uid})'
+            ')'
+        ).format( userdn=userdn, uid=username )
+        by_parent = {}
+        for group in allowed.values():
+            rdn, parent = split_dn( group )
+            attr, _, value = rdn.partition( '=' )
+            value = escape_filter_chars( re.sub(r'\\(.)', r'\1', value.strip()) )
+            by_parent.setdefault( parent, [] ).append( '(%s=%s)' % (attr.strip(), value) )
+        for parent, rdns in by_parent.items():
+            rdn_filter = ''.join( rdns )
+            conn.search(
+                parent,
+                search_scope=ldap3.LEVEL,
+                search_filter='(&%s(|%s))' % (member_filter, rdn_filter),
+                attributes=[ldap3.NO_ATTRIBUTES]
+            )
+            for entry in conn.response:
+                if entry.get('type', 'searchResEntry') == 'searchResEntry' and normalize_dn( entry['dn'] ) in allowed:
+                    return True
+        return False
+
     def _getUserGroup( self, username ):
-            
-        self.log.debug('Looking for user in base {user_search_base}: {userattr}={username}'.format(user_search_base=self.user_search_base,userattr=self.user_attribute,username=username))
-        data = {}
-        _conn = None
+        """Resolve uidNumber and 'cn:gidNumber' group tuples of username, on a pooled connection."""
         retry = 3
-        while retry > 0:
+        while True:
             try:
-                self.log.info("searching ldap...")
-                # _conn = self._state['conn']
-                server = ldap3.Server( self.server_address, port=self.server_port, use_ssl=self.use_ssl )
-                _conn = ldap3.Connection( server )
-                _conn.bind()
-                _conn.search(
-                    search_base=self.user_search_base,
-                    search_scope=ldap3.SUBTREE,
-                    search_filter=self.search_filter.format(userattr=self.user_attribute,username=username),
-                    attributes=self.attributes
-                )
-                retry = 0
+                with self.ldap_pool.connection() as conn:
+                    return self._searchUserGroup( conn, username )
+            except LDAPLookupError:
+                raise
             except Exception as e:
                 self.log.warn("Error connecting to ldap: %s" % (e,))
                 retry = retry - 1
                 if retry == 0:
                     raise Exception('Please log-out and log-back in to proceed.')
 
+    def _searchUserGroup( self, _conn, username ):
+
+        self.log.debug('Looking for user in base {user_search_base}: {userattr}={username}'.format(user_search_base=self.user_search_base,userattr=self.user_attribute,username=username))
+        data = {}
+        _conn.search(
+            search_base=self.user_search_base,
+            search_scope=ldap3.SUBTREE,
+            search_filter=self.search_filter.format(userattr=self.user_attribute,username=username),
+            attributes=self.attributes
+        )
+
         if len(_conn.response) == 0:
-            raise Exception('User with {userattr}={username} not found in directory'.format(
+            raise LDAPLookupError('User with {userattr}={username} not found in directory'.format(
                 userattr=self.user_attribute, username=username))
         elif len(_conn.response) > 1:
-            raise Exception('User with {userattr}={username} found more than {len}-fold in directory'.format(
+            raise LDAPLookupError('User with {userattr}={username} found more than {len}-fold in directory'.format(
                 userattr=self.user_attribute, username=username, len=len(_conn.response)))
         for k,v in _conn.response[0]['attributes'].items():
              data[k] = v
 
+        if self.group_mirror_enabled and self.group_mirror.ready:
+            gidCN = self.group_mirror.gid_cn( data['gidNumber'] )
+            if gidCN is not None:
+                tuples = [ '%s:%s' % (gidCN, data['gidNumber']) ]
+                tuples.extend( '%s:%s' % g for g in self.group_mirror.member_groups( username ) )
+                return data['uidNumber'], tuples
+            self.log.info("gidNumber %s of %s not in group mirror, asking ldap" % (data['gidNumber'], username))
+
         # get the gid name
         _conn.search(
                 search_base=self.group_search_base,
@@ -246,9 +1092,9 @@ class SLACAuth(ldapauthenticator.LDAPAuthenticator):
                 attributes=self.attributes
         )
         if len(_conn.response) == 0:
-            raise Exception( "Could not find user's CN for gidNumber %s" % (data['gidNumber'],) )
+            raise LDAPLookupError( "Could not find user's CN for gidNumber %s" % (data['gidNumber'],) )
         elif len(_conn.response) > 1:
-            raise Exception("Too many matches for user's gidNumber %s" % (data['gidNumber'],) )
+            raise LDAPLookupError("Too many matches for user's gidNumber %s" % (data['gidNumber'],) )
             
         data['gidCN'] = _conn.response[0]['attributes']['cn'][0]
 
@@ -283,13 +1129,57 @@ class SLACAuth(ldapauthenticator.LDAPAuthenticator):
     def authenticate( self, handler, data):
         try:
             self.log.info("authenticate()")
-            self._state['conn'], is_bound, username = self._authenticate( handler, data )
+            password = data.get('password')
+            if self.bind_cache_ttl > 0 and password and password.strip():
+                username = yield self.bind_cache.authenticate( data['username'], password,
+                    lambda: self._bindUser( handler, data ) )
+            else:
+                username = yield self._bindUser( handler, data )
         except:
             return None
+        if not username:
+            return None
+        name = self.normalize_username( str(username) )
+        if self.enable_auth_state:
+            # keep the identity across hub restarts, without making the login wait for LDAP
+            auth_state = None
+            user = handler.find_user( name ) if handler is not None else None
+            if user is not None:
+                # the hub saves whatever auth_state is returned; keep the stored identity meanwhile
+                auth_state = yield user.get_auth_state()
+            lookup = self.identity_cache.get( name )
+            if lookup.done() and lookup.exception() is None:
+                uid, groups = lookup.result()
+                auth_state = dict( auth_state or {}, **self.identity_state( uid, groups ) )
+            elif handler is not None:
+                IOLoop.current().spawn_callback( self._store_login_identity, handler, name, lookup )
+            else:
+                self.prefetch_identity( name )
+            return { 'name': str(username), 'auth_state': auth_state }
+        if self.identity_prefetch_enabled:
+            # pre_spawn_start joins this lookup (or finds it cached) rather than starting its own;
+            # it looks users up by their hub name
+            self.prefetch_identity( name )
         return str(username)
 
+    def _bindAndRelease( self, handler, data ):
+        """Check the user's credentials; the connection bound as the user is not kept."""
+        result = self._authenticate( handler, data )
+        if result is None:
+            return None
+        conn, is_bound, username = result
+        conn.unbind()
+        return username
+
+    @gen.coroutine
+    def _bindUser( self, handler, data ):
+        username = yield self.run_ldap( self._bindAndRelease, handler, data )
+        return username
+
 
 c.JupyterHub.authenticator_class = SLACAuth
+# uid and groups are kept in auth_state, which is encrypted with JUPYTERHUB_CRYPT_KEY
+c.SLACAuth.enable_auth_state = bool(os.getenv('JUPYTERHUB_CRYPT_KEY'))
 c.LDAPAuthenticator.server_address = 'ldap01.slac.stanford.edu'
 c.LDAPAuthenticator.use_ssl = True
 c.LDAPAuthenticator.bind_dn_template = [
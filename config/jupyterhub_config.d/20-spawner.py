@@ -2,20 +2,1103 @@
 """The spawner is the KubeSpawner, modified to use the options form data.
 """
 import datetime
+from datetime import timedelta
+import hashlib
 import escapism
 import json
+import re
 import kubespawner
+from collections import namedtuple
 import os
-import urllib
+import urllib.parse
 from urllib.error import HTTPError
+from kubespawner.clients import shared_client
 from kubespawner.objects import make_pod
+from kubernetes import watch
+from kubernetes.client import V1DeleteOptions
+from prometheus_client import Histogram, Counter, Gauge
 from tornado import gen
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.locks import Condition, Event
 import yaml
 import glob
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from traitlets import Unicode, Int, Bool, List, Union, Float, Dict
+
+
+SPAWN_BUCKETS = (1, 2.5, 5, 10, 20, 30, 60, 90, 120, 180, 300, 450, 600, float('inf'))
+
+NODE_SELECTOR_DURATION = Histogram(
+    'slac_node_selector_rule_duration_seconds',
+    'Time to evaluate node-selectors.yaml rules for a spawn',
+    ['image', 'rule'],
+    buckets=(.00001, .000025, .00005, .0001, .00025, .0005, .001, .0025, .005, .01, float('inf')),
+)
+POD_MANIFEST_DURATION = Histogram(
+    'slac_pod_manifest_duration_seconds',
+    'Time to build the pod manifest of a spawn',
+    ['image', 'rule'],
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, float('inf')),
+)
+SPAWN_SCHEDULED_DURATION = Histogram(
+    'slac_spawn_scheduled_duration_seconds',
+    'Time from the start of a spawn until its pod is scheduled onto a node',
+    ['image', 'rule'],
+    buckets=SPAWN_BUCKETS,
+)
+SPAWN_READY_DURATION = Histogram(
+    'slac_spawn_ready_duration_seconds',
+    'Time from the start of a spawn until the notebook server is running',
+    ['image', 'rule'],
+    buckets=SPAWN_BUCKETS,
+)
+SPAWN_FAILURES = Counter(
+    'slac_spawn_failures_total',
+    'Spawns that did not reach a running notebook server',
+    ['image', 'rule'],
+)
+SPAWN_PLACEMENTS = Counter(
+    'slac_spawn_placements_total',
+    'Node selectors spawns were sent to by the capacity check: primary, fallback-<n> or full (refused)',
+    ['image', 'rule', 'placement'],
+)
+SPAWN_QUEUE_DURATION = Histogram(
+    'slac_spawn_queue_duration_seconds',
+    'Time a spawn waited in the admission queue',
+    ['image', 'rule'],
+    buckets=SPAWN_BUCKETS,
+)
+SPAWN_QUEUE_WAITING = Gauge(
+    'slac_spawn_queue_waiting',
+    'Spawns waiting in the admission queue',
+)
+SPAWN_QUEUE_ADMITTED = Gauge(
+    'slac_spawn_queue_admitted',
+    'Spawns admitted and not finished starting',
+)
+WARM_POOL_CLAIMS = Counter(
+    'slac_warm_pool_claims_total',
+    'Spawns that looked for a warm placeholder pod, by whether one was claimed (hit) or not (miss)',
+    ['image', 'rule', 'result'],
+)
+WARM_POOL_CLAIM_DURATION = Histogram(
+    'slac_warm_pool_claim_duration_seconds',
+    'Time to claim a warm placeholder pod for a spawn',
+    ['image', 'rule'],
+    buckets=(.001, .005, .01, .05, .1, .25, .5, 1, 2.5, 5, float('inf')),
+)
+WARM_POOL_SIZE = Gauge(
+    'slac_warm_pool_pods',
+    'Warm placeholder pods, by phase',
+    ['image', 'rule', 'phase'],
+)
+
+
+def parse_image_spec(image_spec):
+    """Split 'owner/name:tag' into (name, tag); the tag's '_' become '.'."""
+    image_name = image_spec
+    tag = "latest"
+    s_idx = image_spec.find('/')
+    c_idx = image_spec.find(':')
+    if s_idx != -1:
+        image_name = image_spec[(s_idx + 1):]
+        if c_idx > 0:
+            image_name = image_spec[(s_idx + 1):c_idx]
+            tag = image_spec[(c_idx + 1):].replace('_','.')
+    return image_name, tag
+
+
+class ImageCatalog(object):
+    """In-memory copy of the images.d directory and the options form rendered from it.
+
+    The directory is only re-globbed every `check_interval` seconds, and a file is
+    only re-parsed when its (mtime, size, inode) changes. As ConfigMap updates swap
+    the ..data symlink, the resolved directory path is also part of the signature.
+    """
+
+    def __init__(self, directory, check_interval=5, log=None):
+        self.directory = directory
+        self.check_interval = check_interval
+        self.log = log
+        self.hits = 0
+        self.reloads = 0
+        self._files = {}
+        self._realpath = None
+        self._checked = None
+        self._sections = []
+        self._images = frozenset()
+        self._image_names = frozenset()
+        self._html = ''
+        self._filtered = {}
+        self._filtered_rules = None
+
+    @staticmethod
+    def _signature(st):
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _load(self, path):
+        with open(path, 'r') as conf:
+            try:
+                return yaml.safe_load(conf)
+            except Exception:
+                if self.log:
+                    self.log.warn(" Could not parse image list %s" % path)
+        return None
+
+    def _render(self, sections):
+        html = []
+        for section in sections:
+            if 'title' in section:
+                html.append('<h3>%s</h3><br/>\n' % section['title'])
+            if 'updated' in section:
+                html.append("updated at %s<br>\n" % section['updated'])
+            if 'images' in section:
+                for image in section['images']:
+                    html.append('<input type="radio" name="kernel_image" value="%s">%s<br>\n' % (image['image'], image['description']))
+        return ''.join(html)
+
+    def refresh(self, force=False):
+        """Re-read changed files; returns True if the catalog was rebuilt."""
+        now = time.monotonic()
+        if not force and self._checked is not None and now - self._checked < self.check_interval:
+            self.hits += 1
+            return False
+        self._checked = now
+
+        realpath = os.path.realpath(self.directory)
+        if realpath != self._realpath:
+            # symlink swapped (or first load): every file may have changed underneath us
+            self._files = {}
+            self._realpath = realpath
+
+        files = {}
+        reread = 0
+        for path in sorted(glob.glob(os.path.join(self.directory, '*.yaml'))):
+            try:
+                sig = self._signature(os.stat(path))
+            except OSError:
+                continue
+            cached = self._files.get(path)
+            if cached is not None and cached[0] == sig:
+                files[path] = cached
+            else:
+                files[path] = (sig, self._load(path))
+                reread += 1
+
+        if not reread and list(files) == list(self._files):
+            self.hits += 1
+            return False
+
+        self._files = files
+        self._sections = [section for _, section in files.values() if isinstance(section, dict)]
+        self._images = frozenset(image['image'] for section in self._sections
+                                 for image in section.get('images') or ())
+        self._image_names = frozenset(parse_image_spec(image)[0] for image in self._images)
+        self._html = self._render(self._sections)
+        self._filtered = {}
+        self.reloads += 1
+        if self.log:
+            self.log.info("Loaded image catalog %s: %d file(s) re-read, %d hits / %d reloads" % (
+                self.directory, reread, self.hits, self.reloads))
+        return True
+
+    @property
+    def sections(self):
+        self.refresh()
+        return self._sections
+
+    @property
+    def images(self):
+        """Every image spec the catalog offers."""
+        self.refresh()
+        return self._images
+
+    @property
+    def image_names(self):
+        """The parse_image_spec() names of the catalog images."""
+        self.refresh()
+        return self._image_names
+
+    @property
+    def html(self):
+        self.refresh()
+        return self._html
+
+    def filtered_html(self, rules, gnames):
+        """The form with only the images rules.allows() for gnames.
+
+        Rendered once per rules.group_signature(gnames), so all users whose groups
+        make no difference to the rules share a render.
+        """
+        self.refresh()
+        if rules is not self._filtered_rules:
+            self._filtered = {}
+            self._filtered_rules = rules
+        key = rules.group_signature(gnames)
+        html = self._filtered.get(key)
+        if html is None:
+            sections = []
+            for section in self._sections:
+                images = [image for image in section.get('images') or ()
+                          if rules.allows(gnames, parse_image_spec(image['image'])[0])]
+                if images:
+                    sections.append(dict(section, images=images))
+            html = self._filtered[key] = self._render(sections)
+        return html
+
+
+NodeSelectorRule = namedtuple('NodeSelectorRule', ['index', 'name', 'spawn_on', 'spec', 'fallback'])
+
+
+class NodeSelectorRules(object):
+    """Immutable, indexed form of the node-selectors.yaml file.
+
+    match() returns the same rule as walking node_selectors in order and taking
+    the first whose filter matches: every key of 'gnames' and 'images' present in a
+    filter must intersect the user's groups / the image name, a 'uid' key never
+    matches and entries without a filter are ignored. Instead of walking the list,
+    the candidate rules are looked up in group -> rules and image -> rules indexes
+    and the lowest index of their intersection wins.
+    """
+
+    def __init__(self, config):
+        config = config or {}
+        defaults = config.get('node_defaults') or {}
+        self.default_spawn_on = defaults.get('spawn_on', {})
+        self.default_spec = defaults.get('spec', {})
+        self.default_fallback = tuple(defaults.get('fallback') or ())
+
+        rules = {}
+        by_group = {}
+        by_image = {}
+        any_group = set()
+        any_image = set()
+        for idx, item in enumerate(config.get('node_selectors') or []):
+            if 'filter' not in item:
+                continue
+            this = item['filter'] or {}
+            if 'uid' in this:
+                # uid filters are never satisfied
+                continue
+            rules[idx] = NodeSelectorRule(idx, item.get('name') or 'rule-%d' % idx,
+                                          item.get('spawn_on', {}), item.get('spec', {}),
+                                          tuple(item.get('fallback') or ()))
+            for key, index, unfiltered in (('gnames', by_group, any_group), ('images', by_image, any_image)):
+                if key in this:
+                    for value in this[key] or ():
+                        index.setdefault(value, set()).add(idx)
+                else:
+                    unfiltered.add(idx)
+
+        self._rules = rules
+        self._by_group = dict((k, frozenset(v)) for k, v in by_group.items())
+        self._by_image = dict((k, frozenset(v)) for k, v in by_image.items())
+        self._any_group = frozenset(any_group)
+        self._any_image = frozenset(any_image)
+
+    def __len__(self):
+        return len(self._rules)
+
+    def group_signature(self, gnames):
+        """The groups of gnames that some rule filters on; users with equal signatures match alike."""
+        return frozenset(g for g in gnames if g in self._by_group)
+
+    def allows(self, gnames, image_name):
+        """False for an image that rules are written for, unless one of those rules is the match for gnames."""
+        named = self._by_image.get(image_name)
+        if not named:
+            return True
+        rule = self.match(gnames, image_name)
+        return rule is not None and rule.index in named
+
+    def placements(self, image_name):
+        """spawn_on selectors image_name can be spawned with: those of the rules naming it,
+        else where a user without groups would be sent. Used by utils/catalog-prepuller.py."""
+        named = self._by_image.get(image_name)
+        if named:
+            return [self._rules[idx].spawn_on for idx in sorted(named)]
+        rule = self.match((), image_name)
+        return [rule.spawn_on if rule is not None else self.default_spawn_on]
+
+    def match(self, gnames, image_name):
+        """Return the first NodeSelectorRule for the groups and image name, or None."""
+        candidates = self._any_image.union(self._by_image.get(image_name, ()))
+        if not candidates:
+            return None
+        allowed = set(self._any_group)
+        for g in gnames:
+            allowed.update(self._by_group.get(g, ()))
+        matched = candidates.intersection(allowed)
+        if not matched:
+            return None
+        return self._rules[min(matched)]
+
+
+class NodeSelectorConfig(object):
+    """Compiles node-selectors.yaml once, and again whenever the file changes.
+
+    The compiled NodeSelectorRules is replaced with a single assignment, so a
+    spawn always sees either the old or the new rule set, never a mix of both.
+    """
+
+    def __init__(self, path, check_interval=5, log=None):
+        self.path = path
+        self.check_interval = check_interval
+        self.log = log
+        self.reloads = 0
+        self._signature = None
+        self._checked = None
+        self._rules = None
+
+    def refresh(self, force=False):
+        now = time.monotonic()
+        if not force and self._rules is not None and now - self._checked < self.check_interval:
+            return False
+        self._checked = now
+
+        st = os.stat(self.path)
+        signature = (os.path.realpath(self.path), st.st_mtime_ns, st.st_size, st.st_ino)
+        if signature == self._signature:
+            return False
+        try:
+            with open(self.path, 'r') as f:
+                rules = NodeSelectorRules(yaml.safe_load(f))
+        except Exception as e:
+            if self._rules is None:
+                raise
+            if self.log:
+                self.log.error("Could not load node selectors from %s, keeping previous rules: %s" % (self.path, e))
+            return False
+        self._rules = rules
+        self._signature = signature
+        self.reloads += 1
+        if self.log:
+            self.log.info("Loaded %d node selector rule(s) from %s" % (len(rules), self.path))
+        return True
+
+    @property
+    def rules(self):
+        self.refresh()
+        return self._rules
+
+
+NodeInfo = namedtuple('NodeInfo', ['name', 'hostname', 'labels', 'images', 'allocatable', 'schedulable'])
+
+QUANTITY_SUFFIXES = {
+    'Ki': 2 ** 10, 'Mi': 2 ** 20, 'Gi': 2 ** 30, 'Ti': 2 ** 40, 'Pi': 2 ** 50, 'Ei': 2 ** 60,
+    'n': 1e-9, 'u': 1e-6, 'm': 1e-3, 'k': 1e3, 'K': 1e3, 'M': 1e6, 'G': 1e9, 'T': 1e12, 'P': 1e15, 'E': 1e18,
+}
+
+
+def parse_quantity(quantity):
+    """Kubernetes resource quantity ('500m', '10G', '2Gi', 4) as a float, in cores or bytes."""
+    quantity = str(quantity).strip()
+    for suffix in (quantity[-2:], quantity[-1:]):
+        if suffix in QUANTITY_SUFFIXES:
+            return float(quantity[:-len(suffix)]) * QUANTITY_SUFFIXES[suffix]
+    return float(quantity)
+
+
+def normalize_image(name):
+    """Image reference as written in images.d, e.g. without the docker.io/ registry."""
+    for prefix in ('docker.io/', 'library/'):
+        if name.startswith(prefix):
+            name = name[len(prefix):]
+    return name
+
+
+class SpawnCapacityError(RuntimeError):
+    """No node allowed for a spawn has room for it."""
+
+
+class KubeWatcher(object):
+    """Cluster-wide view of one kind of object, kept current by a watch thread shared by all spawners.
+
+    Modelled on kubespawner's reflectors: list once, then watch from that
+    resourceVersion, and start over with a fresh list whenever the watch ends or
+    fails. Subclasses name the list call and reduce each object with _parse();
+    _parse() returning None drops the object.
+    """
+
+    list_method = None
+    kind = 'object'
+
+    def __init__(self, api, log=None, timeout=300, restart_delay=10):
+        self.api = api
+        self.log = log
+        self.timeout = timeout
+        self.restart_delay = restart_delay
+        self.items = {}
+        self.first_load = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._watch_and_update, name='%s-watcher' % self.kind, daemon=True)
+            self._thread.start()
+
+    def _parse(self, obj):
+        raise NotImplementedError
+
+    @staticmethod
+    def _key(obj):
+        return (obj.metadata.namespace, obj.metadata.name)
+
+    def _update(self, obj):
+        parsed = self._parse(obj)
+        if parsed is None:
+            self.items.pop(self._key(obj), None)
+        else:
+            self.items[self._key(obj)] = parsed
+
+    def _list_and_update(self):
+        initial = getattr(self.api, self.list_method)(_request_timeout=60)
+        items = {}
+        for obj in initial.items:
+            parsed = self._parse(obj)
+            if parsed is not None:
+                items[self._key(obj)] = parsed
+        self.items = items
+        self.first_load.set()
+        return initial.metadata.resource_version
+
+    def _watch_and_update(self):
+        while True:
+            try:
+                resource_version = self._list_and_update()
+                w = watch.Watch()
+                for event in w.stream(getattr(self.api, self.list_method), resource_version=resource_version,
+                                      timeout_seconds=self.timeout, _request_timeout=self.timeout + 60):
+                    obj = event['object']
+                    if event['type'] == 'DELETED':
+                        self.items.pop(self._key(obj), None)
+                    else:
+                        self._update(obj)
+            except Exception as e:
+                if self.log:
+                    self.log.warn("%s watch failed, restarting in %ss: %s" % (self.kind.capitalize(), self.restart_delay, e))
+                time.sleep(self.restart_delay)
+
+
+class NodeWatcher(KubeWatcher):
+    """Labels, images, allocatable resources and schedulability of every node."""
+
+    list_method = 'list_node'
+    kind = 'node'
+
+    @property
+    def nodes(self):
+        return self.items
+
+    def _parse(self, node):
+        images = set()
+        allocatable = {}
+        ready = False
+        if node.status:
+            for image in node.status.images or ():
+                images.update(normalize_image(n) for n in image.names or ())
+            for resource, quantity in (node.status.allocatable or {}).items():
+                allocatable[resource] = parse_quantity(quantity)
+            ready = any(c.type == 'Ready' and c.status == 'True' for c in node.status.conditions or ())
+        labels = node.metadata.labels or {}
+        schedulable = ready and not (node.spec and node.spec.unschedulable)
+        return NodeInfo(node.metadata.name, labels.get('kubernetes.io/hostname', node.metadata.name),
+                        labels, frozenset(images), allocatable, schedulable)
+
+    def select(self, node_selector):
+        """Nodes carrying every label of node_selector."""
+        return [n for n in list(self.nodes.values())
+                if all(n.labels.get(k) == str(v) for k, v in node_selector.items())]
+
+
+def pod_requests(spec):
+    """Resources the scheduler reserves for a pod spec: containers summed, init containers at most."""
+    def container_requests(container):
+        resources = container.resources
+        requests = dict((resources.limits or {}) if resources else {})
+        requests.update((resources.requests or {}) if resources else {})
+        return dict((k, parse_quantity(v)) for k, v in requests.items())
+    total = {}
+    for container in spec.containers or ():
+        for k, v in container_requests(container).items():
+            total[k] = total.get(k, 0) + v
+    for container in spec.init_containers or ():
+        for k, v in container_requests(container).items():
+            total[k] = max(total.get(k, 0), v)
+    return total
+
+
+class PodRequestWatcher(KubeWatcher):
+    """Node and resource requests of every pod bound to a node and not finished, in all namespaces."""
+
+    list_method = 'list_pod_for_all_namespaces'
+    kind = 'pod'
+
+    def _parse(self, pod):
+        if not pod.spec.node_name or (pod.status and pod.status.phase in ('Succeeded', 'Failed')):
+            return None
+        return (pod.spec.node_name, pod_requests(pod.spec))
+
+    def used(self):
+        """{node name: {resource: requested}}"""
+        used = {}
+        for node, requests in list(self.items.values()):
+            node_used = used.setdefault(node, {})
+            for k, v in requests.items():
+                node_used[k] = node_used.get(k, 0) + v
+        return used
+
+
+DOCKER_HUB = 'registry-1.docker.io'
+
+MANIFEST_TYPES = ', '.join((
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.oci.image.index.v1+json',
+    'application/vnd.oci.image.manifest.v1+json',
+))
+
+
+def split_image_reference(image_spec):
+    """(name, registry, repository, tag) of a tag reference, with Docker Hub defaults.
+
+    name is the reference without its tag, as written, so that name@digest can be pulled.
+    """
+    name, tag = image_spec, 'latest'
+    slash = name.rfind('/')
+    colon = name.rfind(':')
+    if colon > slash:
+        name, tag = name[:colon], name[colon + 1:]
+    first, _, rest = name.partition('/')
+    if rest and ('.' in first or ':' in first or first == 'localhost'):
+        registry, repository = first, rest
+    else:
+        registry, repository = DOCKER_HUB, name
+        if '/' not in repository:
+            repository = 'library/' + repository
+    return name, registry, repository, tag
+
+
+class ImageDigestResolver(object):
+    """Resolves image tags to the digest they currently point at, from the event loop.
+
+    Digests are kept for `ttl` seconds; after that the cached digest is still used
+    for up to `max_stale` seconds while one background lookup refreshes it. Lookups
+    use the registry v2 API (HEAD of the manifest, with a bearer token when the
+    registry asks for one). Registries can be redirected to another base URL, e.g. a
+    local stand-in, with `registry_urls`. resolve() returns None if the registry
+    cannot be reached, and the caller falls back to pulling by tag; a tag that
+    failed is not looked up again for `retry_after` seconds, so an unreachable
+    registry does not add a timeout to every spawn.
+    """
+
+    def __init__(self, ttl=300, max_stale=86400, timeout=5, retry_after=30, registry_urls=None, log=None):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.registry_urls = registry_urls or {}
+        self.log = log
+        self._digests = {}
+        self._failed = {}
+        self._inflight = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.lookups = 0
+        self.failures = 0
+
+    def stats(self):
+        return {
+            'images': len(self._digests),
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'lookups': self.lookups,
+            'failures': self.failures,
+        }
+
+    @gen.coroutine
+    def _token(self, challenge):
+        params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        realm = params.pop('realm', None)
+        if not realm:
+            return None
+        url = realm + '?' + urllib.parse.urlencode(params)
+        resp = yield AsyncHTTPClient().fetch(url, request_timeout=self.timeout)
+        body = json.loads(resp.body.decode('utf-8'))
+        return body.get('token') or body.get('access_token')
+
+    @gen.coroutine
+    def _lookup(self, image_spec):
+        name, registry, repository, tag = split_image_reference(image_spec)
+        base = self.registry_urls.get(registry, 'https://' + registry)
+        url = '%s/v2/%s/manifests/%s' % (base.rstrip('/'), repository, tag)
+        headers = {'Accept': MANIFEST_TYPES}
+        client = AsyncHTTPClient()
+        resp = yield client.fetch(HTTPRequest(url, method='HEAD', headers=headers,
+                                              request_timeout=self.timeout), raise_error=False)
+        if resp.code == 401 and 'Www-Authenticate' in resp.headers:
+            token = yield self._token(resp.headers['Www-Authenticate'])
+            if token:
+                headers['Authorization'] = 'Bearer ' + token
+            resp = yield client.fetch(HTTPRequest(url, method='HEAD', headers=headers,
+                                                  request_timeout=self.timeout), raise_error=False)
+        digest = resp.headers.get('Docker-Content-Digest') if resp.code == 200 else None
+        if not digest:
+            raise ValueError('HTTP %s from %s' % (resp.code, url))
+        return '%s@%s' % (name, digest)
+
+    @gen.coroutine
+    def _refresh(self, image_spec):
+        self.lookups += 1
+        try:
+            ref = yield self._lookup(image_spec)
+        except Exception as e:
+            self.failures += 1
+            self._failed[image_spec] = time.monotonic()
+            if self.log:
+                self.log.warn("Could not resolve digest of %s: %s" % (image_spec, e))
+            return None
+        finally:
+            self._inflight.pop(image_spec, None)
+        self._failed.pop(image_spec, None)
+        if self.log and self._digests.get(image_spec, (None,))[0] != ref:
+            self.log.info("Resolved %s to %s" % (image_spec, ref))
+        self._digests[image_spec] = (ref, time.monotonic())
+        return ref
+
+    def _start_refresh(self, image_spec):
+        future = self._inflight.get(image_spec)
+        if future is None:
+            future = self._inflight[image_spec] = self._refresh(image_spec)
+        return future
+
+    @gen.coroutine
+    def resolve(self, image_spec):
+        """name@digest for the tag reference image_spec, or None if it cannot be resolved."""
+        if '@' in image_spec:
+            return image_spec
+        cached = self._digests.get(image_spec)
+        if cached is not None:
+            ref, resolved = cached
+            age = time.monotonic() - resolved
+            if age < self.ttl:
+                self.hits += 1
+                return ref
+            if age < self.ttl + self.max_stale:
+                self.stale_hits += 1
+                if time.monotonic() - self._failed.get(image_spec, -self.retry_after) >= self.retry_after:
+                    self._start_refresh(image_spec)
+                return ref
+        if time.monotonic() - self._failed.get(image_spec, -self.retry_after) < self.retry_after:
+            return None
+        ref = yield self._start_refresh(image_spec)
+        return ref
 
-from traitlets import Unicode, Int, Bool, List, Union
 
 # Spawn the pod with custom settings retrieved via token additional scope.
+WarmPoolKey = namedtuple('WarmPoolKey', ['image', 'rule'])
+
+WARM_POOL_LABEL = 'hub.jupyter.org/warm-pool'
+
+
+class WarmPool(object):
+    """Placeholder pods kept running per (image, node selector rule), shared by all spawners.
+
+    A placeholder runs the image with the rule's node selector, resource
+    guarantees and the volumes that do not depend on the user, so that its node
+    has the image pulled, the shared volumes attached and room reserved; it
+    runs `sleep infinity` in place of the image's entrypoint. A spawn claims one
+    by deleting it and preferring its node for the user's pod, which is then
+    built as usual (uid, groups, home mount). Pods cannot be changed once
+    created, hence the swap rather than reusing the placeholder.
+
+    Each key is kept at as many placeholders as it had spawns in the last
+    demand_window seconds, up to max_size, by reconcile() every interval.
+    """
+
+    def __init__(self, api, namespace, max_size=5, demand_window=600, interval=30, log=None):
+        self.api = api
+        self.namespace = namespace
+        self.max_size = max_size
+        self.demand_window = demand_window
+        self.interval = interval
+        self.log = log
+        self._executor = ThreadPoolExecutor(2)
+        self._demand = {}
+        self._templates = {}
+        self._pods = {}
+        self._claimed = set()
+        self._reconciling = None
+        self._callback = None
+
+    @staticmethod
+    def key_label(key):
+        return hashlib.sha1(('%s|%s' % key).encode('utf-8')).hexdigest()[:16]
+
+    def start(self):
+        if self._callback is None:
+            self._callback = PeriodicCallback(self.reconcile, self.interval * 1000)
+            self._callback.start()
+
+    def _run(self, fn, *args, **kwargs):
+        return IOLoop.current().run_in_executor(self._executor, lambda: fn(*args, **kwargs))
+
+    def record(self, key, image, template):
+        """Note a spawn for key; template(name) builds a placeholder pod running image."""
+        demand = self._demand.setdefault(key, deque())
+        demand.append(time.monotonic())
+        self._templates[key] = (image, template)
+
+    def wanted(self, key):
+        demand = self._demand.get(key)
+        if not demand:
+            return 0
+        cutoff = time.monotonic() - self.demand_window
+        while demand and demand[0] < cutoff:
+            demand.popleft()
+        return min(self.max_size, len(demand))
+
+    @gen.coroutine
+    def claim(self, key, image):
+        """Delete a running placeholder of key and return its node name, or None."""
+        for pod in list(self._pods.get(key, ())):
+            name = pod.metadata.name
+            if (name in self._claimed or pod.status is None or pod.status.phase != 'Running'
+                    or pod.spec.containers[0].image != image):
+                continue
+            self._claimed.add(name)
+            try:
+                yield self._run(self.api.delete_namespaced_pod, name, self.namespace,
+                                body=V1DeleteOptions(grace_period_seconds=0))
+            except Exception as e:
+                if self.log:
+                    self.log.info("Could not claim warm pod %s: %s" % (name, e))
+                continue
+            self._pods[key] = [p for p in self._pods[key] if p.metadata.name != name]
+            return pod.spec.node_name
+        return None
+
+    @gen.coroutine
+    def reconcile(self):
+        if self._reconciling is None:
+            self._reconciling = self._reconcile()
+        try:
+            yield self._reconciling
+        finally:
+            self._reconciling = None
+
+    @gen.coroutine
+    def _reconcile(self):
+        try:
+            listed = yield self._run(self.api.list_namespaced_pod, self.namespace,
+                                     label_selector=WARM_POOL_LABEL, _request_timeout=60)
+        except Exception as e:
+            if self.log:
+                self.log.warn("Could not list warm pods: %s" % (e,))
+            return
+        by_label = dict((self.key_label(k), k) for k in self._templates)
+        pods = {}
+        stale = []
+        for pod in listed.items:
+            if pod.metadata.deletion_timestamp or pod.metadata.name in self._claimed:
+                continue
+            key = by_label.get(pod.metadata.labels.get(WARM_POOL_LABEL))
+            if key is None or pod.status.phase in ('Succeeded', 'Failed'):
+                stale.append(pod)
+                continue
+            if pod.spec.containers[0].image != self._templates[key][0]:
+                # the tag now resolves to another digest
+                stale.append(pod)
+                continue
+            pods.setdefault(key, []).append(pod)
+        self._claimed.intersection_update(p.metadata.name for p in listed.items)
+
+        for key in list(self._templates):
+            have = pods.get(key, [])
+            want = self.wanted(key)
+            # surplus: drop the ones still pending first
+            have.sort(key=lambda p: p.status.phase == 'Running', reverse=True)
+            stale += have[want:]
+            pods[key] = have[:want]
+            for i in range(want - len(have)):
+                name = 'warm-%s-%s' % (self.key_label(key), os.urandom(4).hex())
+                try:
+                    yield self._run(self.api.create_namespaced_pod, self.namespace, self._templates[key][1](name))
+                except Exception as e:
+                    if self.log:
+                        self.log.warn("Could not create warm pod for %s: %s" % (key, e))
+                    break
+            for phase in ('Running', 'Pending'):
+                WARM_POOL_SIZE.labels(key.image, key.rule, phase).set(
+                    len([p for p in pods[key] if (p.status.phase == 'Running') == (phase == 'Running')]))
+            if not want and not pods[key]:
+                self._templates.pop(key, None)
+                self._demand.pop(key, None)
+        self._pods = pods
+
+        for pod in stale:
+            try:
+                yield self._run(self.api.delete_namespaced_pod, pod.metadata.name, self.namespace,
+                                body=V1DeleteOptions(grace_period_seconds=0))
+            except Exception as e:
+                if self.log:
+                    self.log.debug("Could not delete warm pod %s: %s" % (pod.metadata.name, e))
+
+    def stats(self):
+        return dict(('%s %s' % key, (len(pods), self.wanted(key))) for key, pods in self._pods.items())
+
+
+class AdmissionTicket(object):
+    """A spawn's place in the SpawnAdmission queue."""
+
+    def __init__(self, user, keys, seq):
+        self.user = user
+        self.keys = keys
+        self.seq = seq
+        self.queued = time.monotonic()
+        self.future = gen.Future()
+        self.released = False
+
+
+class SpawnAdmission(object):
+    """Lets spawns start, at most limit of them at a time per key, shared by all spawners.
+
+    A spawn holds a key per node selector rule and per image (e.g. ('rule',
+    'lsst') and ('image', 'lsstsqre/sciplat-lab:w_2019_13')) from admission until
+    its pod is running, so that a burst of spawns does not schedule onto the
+    same nodes and pull the same image all at once. Waiting spawns are ordered
+    by how many spawns of the same user are already admitted, then by arrival,
+    and the first one whose keys all have room is admitted; a spawn blocked on
+    one key does not hold up spawns for other keys.
+    """
+
+    def __init__(self):
+        self._active = {}
+        self._active_users = {}
+        self._waiting = []
+        self._seq = 0
+        self.changed = Condition()
+
+    def _order(self, ticket):
+        return (self._active_users.get(ticket.user, 0), ticket.seq)
+
+    def _fits(self, ticket):
+        return all(limit <= 0 or self._active.get(key, 0) < limit for key, limit in ticket.keys)
+
+    def _admit(self, ticket):
+        for key, _ in ticket.keys:
+            self._active[key] = self._active.get(key, 0) + 1
+        self._active_users[ticket.user] = self._active_users.get(ticket.user, 0) + 1
+        ticket.future.set_result(ticket)
+
+    def _dispatch(self):
+        self._waiting.sort(key=self._order)
+        for ticket in list(self._waiting):
+            if self._fits(ticket):
+                self._waiting.remove(ticket)
+                self._admit(ticket)
+        SPAWN_QUEUE_WAITING.set(len(self._waiting))
+        SPAWN_QUEUE_ADMITTED.set(sum(self._active_users.values()))
+        self.changed.notify_all()
+
+    def enqueue(self, user, keys):
+        """Queue a spawn for [(key, limit)]; its future resolves when it is admitted."""
+        self._seq += 1
+        ticket = AdmissionTicket(user, keys, self._seq)
+        self._waiting.append(ticket)
+        self._dispatch()
+        return ticket
+
+    def release(self, ticket):
+        """Leave the queue, or give back the keys of an admitted spawn; only the first call counts."""
+        if ticket.released:
+            return
+        ticket.released = True
+        if ticket in self._waiting:
+            self._waiting.remove(ticket)
+        elif ticket.future.done():
+            for key, _ in ticket.keys:
+                self._active[key] -= 1
+            self._active_users[ticket.user] -= 1
+            if not self._active_users[ticket.user]:
+                del self._active_users[ticket.user]
+        self._dispatch()
+
+    def position(self, ticket):
+        """(position of ticket among the spawns waiting for any of its keys, how many those are)"""
+        keys = set(key for key, _ in ticket.keys)
+        ahead = total = 0
+        for other in self._waiting:
+            if keys.intersection(key for key, _ in other.keys):
+                total += 1
+                if other is not ticket and self._order(other) < self._order(ticket):
+                    ahead += 1
+        return ahead + 1, total
+
+    def stats(self):
+        return {
+            'waiting': len(self._waiting),
+            'admitted': sum(self._active_users.values()),
+            'active': dict((k, v) for k, v in self._active.items() if v),
+        }
+
+
+def label_value(value):
+    """value made valid as a kubernetes label value."""
+    return re.sub(r'[^A-Za-z0-9_.-]', '-', value)[:63].strip('-_.')
+
+
+def rightsized(samples, percentile, headroom, floor, limit):
+    """percentile of samples times headroom, no less than floor and no more than limit (if set)."""
+    samples = sorted(samples)
+    value = samples[min(len(samples) - 1, int(round(percentile / 100.0 * (len(samples) - 1))))] * headroom
+    value = max(value, floor or 0)
+    if limit:
+        value = min(value, limit)
+    return value
+
+
+class UsageHistory(object):
+    """Peak cpu (cores) and memory (bytes) of the last `size` sessions per (user, image).
+
+    Optionally kept in a JSON file, so that it survives hub restarts.
+    """
+
+    def __init__(self, size=20, path=None, log=None):
+        self.size = size
+        self.path = path
+        self.log = log
+        self._sessions = {}
+        if path:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            if self.log and os.path.exists(self.path):
+                self.log.warn("Could not read usage history %s: %s" % (self.path, e))
+            return
+        for key, peaks in data.items():
+            user, image = key.split(' ', 1)
+            self._sessions[(user, image)] = deque((tuple(p) for p in peaks), maxlen=self.size)
+
+    def save(self):
+        if not self.path:
+            return
+        data = dict(('%s %s' % key, list(peaks)) for key, peaks in self._sessions.items())
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
+
+    def record(self, user, image, cpu, memory):
+        self._sessions.setdefault((user, image), deque(maxlen=self.size)).append((cpu, memory))
+
+    def sessions(self, user, image):
+        return list(self._sessions.get((user, image), ()))
+
+    def image_sessions(self, image):
+        """Sessions of image across all users."""
+        return [p for (_, i), peaks in self._sessions.items() if i == image for p in peaks]
+
+    def __len__(self):
+        return sum(len(peaks) for peaks in self._sessions.values())
+
+
+class MetricsServerSource(object):
+    """Current usage of the singleuser pods, from the metrics.k8s.io API (metrics-server)."""
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.core = shared_client('CoreV1Api')
+        self.custom = shared_client('CustomObjectsApi')
+
+    def sample(self):
+        """{pod name: (user, image, cpu cores, memory bytes)}"""
+        selector = 'component=singleuser-server'
+        pods = self.core.list_namespaced_pod(self.namespace, label_selector=selector, _request_timeout=60)
+        labels = dict((p.metadata.name, p.metadata.labels or {}) for p in pods.items)
+        metrics = self.custom.list_namespaced_custom_object('metrics.k8s.io', 'v1beta1', self.namespace, 'pods',
+                                                            label_selector=selector, _request_timeout=60)
+        usage = {}
+        for item in metrics.get('items', ()):
+            name = item['metadata']['name']
+            pod_labels = labels.get(name)
+            if not pod_labels or 'hub.jupyter.org/image' not in pod_labels:
+                continue
+            cpu = sum(parse_quantity(c['usage'].get('cpu', 0)) for c in item.get('containers', ()))
+            memory = sum(parse_quantity(c['usage'].get('memory', 0)) for c in item.get('containers', ()))
+            usage[name] = (pod_labels.get('hub.jupyter.org/username'), pod_labels['hub.jupyter.org/image'], cpu, memory)
+        return usage
+
+
+class FileUsageSource(object):
+    """Stand-in for MetricsServerSource: the same mapping read from a YAML (or JSON) file,
+    {pod name: {user, image, cpu, memory}}, with kubernetes quantities."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def sample(self):
+        with open(self.path) as f:
+            pods = yaml.safe_load(f) or {}
+        return dict((name, (p['user'], p['image'], parse_quantity(p['cpu']), parse_quantity(p['memory'])))
+                    for name, p in pods.items())
+
+
+class UsageSampler(object):
+    """Polls a usage source and records each pod's peak usage in a UsageHistory when the pod goes away."""
+
+    def __init__(self, source, history, interval=60, log=None):
+        self.source = source
+        self.history = history
+        self.interval = interval
+        self.log = log
+        self._peaks = {}
+        self._callback = None
+        self._executor = ThreadPoolExecutor(1)
+
+    def start(self):
+        if self._callback is None:
+            self._callback = PeriodicCallback(self.poll, self.interval * 1000)
+            self._callback.start()
+
+    @gen.coroutine
+    def poll(self):
+        try:
+            usage = yield IOLoop.current().run_in_executor(self._executor, self.source.sample)
+        except Exception as e:
+            if self.log:
+                self.log.warn("Could not sample pod usage: %s" % (e,))
+            return
+        self.update(usage)
+
+    def update(self, usage):
+        for name, (user, image, cpu, memory) in usage.items():
+            peak = self._peaks.get(name)
+            if peak is None:
+                self._peaks[name] = (user, image, cpu, memory)
+            else:
+                self._peaks[name] = (user, image, max(peak[2], cpu), max(peak[3], memory))
+        ended = [name for name in self._peaks if name not in usage]
+        for name in ended:
+            user, image, cpu, memory = self._peaks.pop(name)
+            self.history.record(user, image, cpu, memory)
+        if ended:
+            try:
+                self.history.save()
+            except OSError as e:
+                if self.log:
+                    self.log.warn("Could not save usage history %s: %s" % (self.history.path, e))
+
+
 class SLACSpawner(kubespawner.KubeSpawner):
     """Spawner to use our custom environment settings as reflected through auth_state."""
 
@@ -51,39 +1134,567 @@ class SLACSpawner(kubespawner.KubeSpawner):
         """,
         default='/opt/jupyterhub/config/images.d/',
     )
-    
+
+    images_config_check_interval = Float(
+        config=True,
+        default_value=5.0,
+        help="""
+        Minimum number of seconds between checks of images_config_d for changed files.
+        """,
+    )
+
+    node_selector_check_interval = Float(
+        config=True,
+        default_value=5.0,
+        help="""
+        Minimum number of seconds between checks of node_selector_config_file for changes.
+        """,
+    )
+
+    image_locality_enabled = Bool(
+        config=True,
+        default_value=False,
+        help="""
+        Prefer nodes that already hold the chosen image, among the nodes allowed by the matched
+        node selector. Needs permission to list and watch nodes.
+        """,
+    )
+
+    image_locality_weight = Int(
+        config=True,
+        default_value=100,
+        help="""
+        Weight (1-100) of the preferred node affinity towards nodes holding the image.
+        """,
+    )
+
+    image_digest_enabled = Bool(
+        config=True,
+        default_value=False,
+        help="""
+        Launch pods by the digest the chosen tag currently resolves to, with image pull policy
+        IfNotPresent, instead of by tag with the configured pull policy (Always). Falls back to the
+        tag when the registry cannot be reached.
+        """,
+    )
+
+    image_digest_ttl = Float(
+        config=True,
+        default_value=300.0,
+        help="""
+        Seconds a resolved tag digest is used before it is looked up again.
+        """,
+    )
+
+    image_digest_max_stale = Float(
+        config=True,
+        default_value=86400.0,
+        help="""
+        Seconds past image_digest_ttl during which the old digest is used while it is refreshed
+        in the background.
+        """,
+    )
+
+    image_digest_timeout = Float(
+        config=True,
+        default_value=5.0,
+        help="""
+        Timeout, in seconds, of each registry request made to resolve a digest.
+        """,
+    )
+
+    image_registry_urls = Dict(
+        config=True,
+        help="""
+        Base URLs to use for registries, e.g. {'registry-1.docker.io': 'http://localhost:5000'}.
+        """,
+    )
+
+    warm_pool_enabled = Bool(
+        config=True,
+        default_value=False,
+        help="""
+        Keep placeholder pods running per (image, node selector rule) and send spawns to the
+        node of one of them, which already has the image, volumes and room for the pod.
+        """,
+    )
+
+    warm_pool_max_size = Int(
+        config=True,
+        default_value=5,
+        help="""
+        Most placeholder pods kept for one (image, node selector rule).
+        """,
+    )
+
+    warm_pool_demand_window = Float(
+        config=True,
+        default_value=600.0,
+        help="""
+        Each (image, node selector rule) keeps as many placeholder pods as it had spawns in this
+        many seconds, up to warm_pool_max_size.
+        """,
+    )
+
+    warm_pool_interval = Float(
+        config=True,
+        default_value=30.0,
+        help="""
+        Seconds between resizing the warm pools.
+        """,
+    )
+
+    admission_enabled = Bool(
+        config=True,
+        default_value=False,
+        help="""
+        Queue spawns so that at most admission_rule_limits spawns per node selector rule and
+        admission_image_limit spawns per image are starting at once.
+        """,
+    )
+
+    admission_rule_limits = Dict(
+        config=True,
+        help="""
+        Spawns starting at once per node selector rule name, e.g. {'lsst': 10, 'default': 20}.
+        Rules not listed use admission_default_rule_limit.
+        """,
+    )
+
+    admission_default_rule_limit = Int(
+        config=True,
+        default_value=0,
+        help="""
+        Spawns starting at once for node selector rules not in admission_rule_limits; 0 for no limit.
+        """,
+    )
+
+    admission_image_limit = Int(
+        config=True,
+        default_value=0,
+        help="""
+        Spawns starting at once per image (name and tag); 0 for no limit.
+        """,
+    )
+
+    admission_timeout = Float(
+        config=True,
+        default_value=0,
+        help="""
+        Longest a spawn waits in the admission queue, in seconds; 0 for half of start_timeout.
+        The hub's start_timeout covers the queue and the start together: the time spent queued
+        is taken from what is left for the pod to start, so keep this well below start_timeout.
+        """,
+    )
+
+    prefetch_enabled = Bool(
+        config=True,
+        default_value=True,
+        help="""
+        When the options form is rendered, start resolving the digest of the image the user
+        spawned last, so that get_pod_manifest usually finds it cached when they submit it.
+        """,
+    )
+
+    rightsizing_enabled = Bool(
+        config=True,
+        default_value=False,
+        help="""
+        Set cpu_guarantee and mem_guarantee from the peak usage of the user's past sessions of
+        the image (else of everybody's), at rightsizing_percentile times rightsizing_headroom,
+        never below the configured guarantees nor above the limits.
+        """,
+    )
+
+    rightsizing_percentile = Float(
+        config=True,
+        default_value=90.0,
+        help="""
+        Percentile of past session peaks to guarantee.
+        """,
+    )
+
+    rightsizing_headroom = Float(
+        config=True,
+        default_value=1.2,
+        help="""
+        Factor applied to the percentile of past session peaks.
+        """,
+    )
+
+    rightsizing_min_sessions = Int(
+        config=True,
+        default_value=3,
+        help="""
+        Past sessions needed before guarantees are derived from them.
+        """,
+    )
+
+    rightsizing_history_size = Int(
+        config=True,
+        default_value=20,
+        help="""
+        Sessions remembered per user and image.
+        """,
+    )
+
+    rightsizing_history_file = Unicode(
+        config=True,
+        default_value='',
+        help="""
+        JSON file keeping the session history across hub restarts; empty to keep it in memory only.
+        """,
+    )
+
+    rightsizing_usage_file = Unicode(
+        config=True,
+        default_value='',
+        help="""
+        Read pod usage from this YAML file instead of the metrics.k8s.io API, for testing.
+        """,
+    )
+
+    rightsizing_sample_interval = Float(
+        config=True,
+        default_value=60.0,
+        help="""
+        Seconds between samples of pod usage.
+        """,
+    )
+
+    capacity_check_enabled = Bool(
+        config=True,
+        default_value=False,
+        help="""
+        Before creating a pod, check that some node allowed by the matched node selector has the
+        cpu, memory and extra resources (e.g. nvidia.com/gpu) the pod requests free. If none has,
+        try the rule's `fallback` node selectors in order, and fail the spawn at once if none of
+        them fits either. Needs permission to list and watch nodes and pods in all namespaces.
+        """,
+    )
+
+    # shared by all spawners; started on first use
+    _node_watcher = None
+    _digest_resolver = None
+    _warm_pool = None
+    _pod_watcher = None
+    _admission = None
+    _admission_ticket = None
+    _usage_history = None
+
+    # image of the user's last spawn, kept in the spawner state
+    last_image = None
+
+    # (image family, node selector rule) of the current spawn, for metrics
+    _spawn_labels = ( '', 'default' )
+    # groups the last options form was filtered for, checked by options_from_form
+    _form_gnames = None
+    _spawn_pending = False
+    # set once start() has handed over to KubeSpawner.start, for progress()
+    _kube_started = None
+
+    # shared by all spawners; one catalog per images directory
+    _image_catalogs = {}
+    # shared by all spawners; one compiled rule set per node selector file
+    _node_selector_configs = {}
+
+    @property
+    def image_catalog(self):
+        catalog = self._image_catalogs.get(self.images_config_d)
+        if catalog is None:
+            catalog = ImageCatalog(self.images_config_d,
+                check_interval=self.images_config_check_interval, log=self.log)
+            self._image_catalogs[self.images_config_d] = catalog
+        return catalog
+
+    def image_label(self, image_spec):
+        """Image family of image_spec for metric labels and admission keys; 'other' unless it
+        is a catalog image (or LAB_IMAGE), so that clients can't create unlimited series."""
+        image_name = parse_image_spec( image_spec or '' )[0]
+        if image_name in self.image_catalog.image_names or image_spec == os.getenv("LAB_IMAGE"):
+            return image_name
+        return 'other'
+
+    @property
+    def node_selector_rules(self):
+        config = self._node_selector_configs.get(self.node_selector_config_file)
+        if config is None:
+            config = NodeSelectorConfig(self.node_selector_config_file,
+                check_interval=self.node_selector_check_interval, log=self.log)
+            self._node_selector_configs[self.node_selector_config_file] = config
+        return config
+
+    @property
+    def node_watcher(self):
+        if SLACSpawner._node_watcher is None:
+            SLACSpawner._node_watcher = NodeWatcher( shared_client('CoreV1Api'), log=self.log )
+            SLACSpawner._node_watcher.start()
+        return SLACSpawner._node_watcher
+
+    @property
+    def digest_resolver(self):
+        if SLACSpawner._digest_resolver is None:
+            SLACSpawner._digest_resolver = ImageDigestResolver( ttl=self.image_digest_ttl,
+                max_stale=self.image_digest_max_stale, timeout=self.image_digest_timeout,
+                registry_urls=self.image_registry_urls, log=self.log )
+        return SLACSpawner._digest_resolver
+
+    @property
+    def warm_pool(self):
+        if SLACSpawner._warm_pool is None:
+            SLACSpawner._warm_pool = WarmPool( shared_client('CoreV1Api'), self.namespace,
+                max_size=self.warm_pool_max_size, demand_window=self.warm_pool_demand_window,
+                interval=self.warm_pool_interval, log=self.log )
+            SLACSpawner._warm_pool.start()
+        return SLACSpawner._warm_pool
+
+    @property
+    def usage_history(self):
+        if SLACSpawner._usage_history is None:
+            history = UsageHistory( size=self.rightsizing_history_size,
+                path=self.rightsizing_history_file or None, log=self.log )
+            if self.rightsizing_usage_file:
+                source = FileUsageSource( self.rightsizing_usage_file )
+            else:
+                source = MetricsServerSource( self.namespace )
+            UsageSampler( source, history, interval=self.rightsizing_sample_interval, log=self.log ).start()
+            SLACSpawner._usage_history = history
+        return SLACSpawner._usage_history
+
+    def _rightsize(self, image_label):
+        """Raise the guarantees (set afresh for every spawn by SLACAuth.pre_spawn_start)
+        to what past sessions of the image needed."""
+        history = self.usage_history
+        sessions = history.sessions( escapism.escape(self.user.name), image_label )
+        if len(sessions) < self.rightsizing_min_sessions:
+            sessions = history.image_sessions( image_label )
+        if len(sessions) < self.rightsizing_min_sessions:
+            return
+        cpu_guarantee = rightsized( [cpu for cpu, _ in sessions], self.rightsizing_percentile,
+            self.rightsizing_headroom, self.cpu_guarantee, self.cpu_limit )
+        mem_guarantee = int( rightsized( [mem for _, mem in sessions], self.rightsizing_percentile,
+            self.rightsizing_headroom, self.mem_guarantee, self.mem_limit ) )
+        self.log.info("Right-sized guarantees of %s for %s from %d session(s): cpu %s -> %.2f, memory %s -> %d" % (
+            self.user.name, image_label, len(sessions), self.cpu_guarantee, cpu_guarantee, self.mem_guarantee, mem_guarantee))
+        self.cpu_guarantee = cpu_guarantee
+        self.mem_guarantee = mem_guarantee
+
+    @property
+    def admission(self):
+        if SLACSpawner._admission is None:
+            SLACSpawner._admission = SpawnAdmission()
+        return SLACSpawner._admission
+
+    def _admission_keys(self, image_spec, rule_name):
+        rule_limit = self.admission_rule_limits.get(rule_name, self.admission_default_rule_limit)
+        image_key = image_spec if self.image_label( image_spec ) != 'other' else 'other'
+        return [(('rule', rule_name), rule_limit), (('image', image_key), self.admission_image_limit)]
+
+    def _enqueue(self):
+        """Queue this spawn for its rule and image; returns its ticket."""
+        image_spec = self._image_spec()
+        gnames = [ i.split(':')[0] for i in self.user_gids ]
+        rule = self.node_selector_rules.rules.match( gnames, parse_image_spec( image_spec )[0] )
+        rule_name = rule.name if rule is not None else 'default'
+        self._spawn_labels = ( self._spawn_labels[0], rule_name )
+        ticket = self._admission_ticket = self.admission.enqueue(
+            self.user.name, self._admission_keys( image_spec, rule_name ))
+        if not ticket.future.done():
+            position, waiting = self.admission.position( ticket )
+            self.log.info("Queued spawn of %s for %s: %d of %d" % (image_spec, self.user.name, position, waiting))
+        return ticket
+
+    @gen.coroutine
+    def _admit(self, ticket):
+        """Wait for ticket to be admitted, at most admission_timeout seconds."""
+        timeout = self.admission_timeout or self.start_timeout / 2.0
+        try:
+            yield gen.with_timeout( timedelta( seconds=timeout ), ticket.future )
+        except gen.TimeoutError:
+            raise TimeoutError("Waited %ss for a slot to spawn %s" % (timeout, self._image_spec()))
+        SPAWN_QUEUE_DURATION.labels( *self._spawn_labels ).observe( time.monotonic() - ticket.queued )
+
+    def _release_admission(self, ticket=None):
+        """Give up the place or slot of ticket, by default the current spawn's."""
+        if ticket is None:
+            ticket = self._admission_ticket
+        if ticket is not None and ticket is self._admission_ticket:
+            self._admission_ticket = None
+        if ticket is not None:
+            self.admission.release( ticket )
+
+    async def progress(self):
+        ticket = self._admission_ticket
+        while ticket is not None and not ticket.future.done() and ticket is self._admission_ticket:
+            position, waiting = self.admission.position( ticket )
+            yield {
+                'progress': 0,
+                'message': 'Waiting to start: %d of %d in the queue for %s' % (
+                    position, waiting, self._spawn_labels[1]),
+            }
+            await self.admission.changed.wait( timeout=timedelta( seconds=10 ) )
+        # KubeSpawner.progress follows the start future, which only exists once start() got past the queue
+        kube_started = self._kube_started
+        while kube_started is not None and not kube_started.is_set():
+            if not self._spawn_pending:
+                return
+            try:
+                await kube_started.wait( timeout=timedelta( seconds=1 ) )
+            except gen.TimeoutError:
+                pass
+        async for event in super().progress():
+            yield event
+
+    @property
+    def pod_watcher(self):
+        if SLACSpawner._pod_watcher is None:
+            SLACSpawner._pod_watcher = PodRequestWatcher( shared_client('CoreV1Api'), log=self.log )
+            SLACSpawner._pod_watcher.start()
+        return SLACSpawner._pod_watcher
+
+    def _requests(self, spec):
+        """Resources the pod will request: the guarantees, else the limits (as kubernetes defaults them)."""
+        requests = {
+            'cpu': self.cpu_guarantee or self.cpu_limit or 0,
+            'memory': self.mem_guarantee or self.mem_limit or 0,
+        }
+        for k, v in spec.get('extra_resource_limits', {}).items():
+            requests[k] = parse_quantity(v)
+        return dict((k, v) for k, v in requests.items() if v)
+
+    def _place(self, selectors, requests):
+        """Index of the first node selector with a schedulable node that has requests free, or None.
+
+        Also returns, for the message of a refused spawn, the most free seen of each resource.
+        """
+        used = self.pod_watcher.used()
+        most_free = {}
+        for idx, selector in enumerate(selectors):
+            for node in self.node_watcher.select( selector ):
+                if not node.schedulable:
+                    continue
+                node_used = used.get( node.name, {} )
+                free = dict((k, node.allocatable.get(k, 0) - node_used.get(k, 0)) for k in requests)
+                for k, v in free.items():
+                    most_free[k] = max(most_free.get(k, v), v)
+                if all(free[k] >= v for k, v in requests.items()):
+                    return idx, most_free
+        return None, most_free
+
+    def _warm_pod_template(self, key, spawn_on, spec, pod_image):
+        """Builds placeholder pods for key: same node selector, guarantees and shared volumes as the spawn."""
+        # volumes naming the user ({username}, {userid}, ...) cannot be mounted ahead of time
+        volumes = [v for v in spec.get('volumes', []) if '{' not in json.dumps(v)]
+        names = set(v['name'] for v in volumes)
+        volume_mounts = [m for m in spec.get('volume_mounts', []) if m['name'] in names]
+        labels = {
+            'app': 'jupyterhub',
+            'component': 'warm-pool',
+            WARM_POOL_LABEL: WarmPool.key_label(key),
+        }
+        cpu_guarantee, mem_guarantee = self.cpu_guarantee, self.mem_guarantee
+        def template(name):
+            return make_pod(
+                name=name,
+                image=pod_image,
+                image_pull_policy='IfNotPresent',
+                image_pull_secret=self.image_pull_secrets,
+                port=self.port,
+                # cmd would become the container's args, appended to the image's entrypoint
+                cmd=None,
+                extra_container_config={'command': ['sleep', 'infinity']},
+                node_selector=spawn_on,
+                env={},
+                volumes=volumes,
+                volume_mounts=volume_mounts,
+                labels=labels,
+                cpu_guarantee=cpu_guarantee,
+                mem_guarantee=mem_guarantee,
+                extra_resource_limits=spec.get('extra_resource_limits', {}),
+                service_account=None,
+                extra_pod_config={'terminationGracePeriodSeconds': 0},
+            )
+        return template
+
+    def _image_affinity(self, image_refs, node_selector):
+        """Preferred node affinity towards the allowed nodes that already hold any of image_refs."""
+        nodes = self.node_watcher.select( node_selector )
+        refs = set( normalize_image(r) for r in image_refs )
+        cached = sorted( n.hostname for n in nodes if refs.intersection(n.images) )
+        if not cached or len(cached) == len(nodes):
+            # nothing to prefer: no node has it, or all of them do
+            return []
+        self.log.debug("%s is cached on %d of %d allowed nodes" % (image_refs[0], len(cached), len(nodes)))
+        return [{
+            'weight': self.image_locality_weight,
+            'preference': {
+                'matchExpressions': [{
+                    'key': 'kubernetes.io/hostname',
+                    'operator': 'In',
+                    'values': cached,
+                }],
+            },
+        }]
+
+    def _image_spec(self):
+        """Image chosen in the options form, else the configured or LAB_IMAGE one."""
+        if self.user_options and self.user_options.get('kernel_image'):
+            return self.user_options.get('kernel_image')
+        return self.image or os.getenv("LAB_IMAGE")
+
     @property
     def options_form(self):
+        return self.image_catalog.html
 
-        conf_files = glob.glob( self.images_config_d + '/*.yaml' )
-        #self.log.info("Loading Image Selector from %s" % (conf_files))
-        images = []
-        # for each file read yaml
-        for f in conf_files:
-            # self.log.info('  scanning file: %s' % (f,))
-            with open(f, 'r') as conf:
-                try:
-                    images.append( yaml.load(conf) )
-                except Exception:
-                    self.log.warn(" Could not parse image list %s" % f)
-           
-        optform = ''
-        for section in images:
-            if 'title' in section:
-                optform += '<h3>%s</h3><br/>\n' % section['title']
-            if 'updated' in section:
-                optform += "updated at %s<br>\n" % section['updated']
-            if 'images' in section:
-                for image in section['images']:
-                    optform += '<input type="radio" name="kernel_image" value="%s">%s<br>\n' % (image['image'], image['description'])
+    @gen.coroutine
+    def get_options_form(self):
+        """The options form with only the images the node selector rules allow for the user's groups."""
+        groups = self.user_gids
+        identity_cache = getattr(self.authenticator, 'identity_cache', None)
+        if not groups and identity_cache is not None:
+            try:
+                _, groups = yield identity_cache.get( self.user.name )
+            except Exception as e:
+                self.log.warn("Could not look up groups of %s, showing all images: %s" % (self.user.name, e))
+                self._form_gnames = None
+                return self.options_form
+        gnames = [ i.split(':')[0] for i in groups or () ]
+        self._form_gnames = gnames
+        if self.prefetch_enabled:
+            self._prefetch( gnames )
+        return self.image_catalog.filtered_html( self.node_selector_rules.rules, gnames )
+
+    def _prefetch(self, gnames):
+        """Start the slow parts of get_pod_manifest for the last image, without waiting for them."""
+        if not self.last_image or not self.image_digest_enabled:
+            return
+        image_name, _ = parse_image_spec( self.last_image )
+        if not self.node_selector_rules.rules.allows( gnames, image_name ):
+            return
+        def _done(f):
+            try:
+                f.result()
+            except Exception as e:
+                self.log.warn("Prefetching the digest of %s failed: %s" % (self.last_image, e))
+        self.digest_resolver.resolve( self.last_image ).add_done_callback( _done )
 
-        return optform
+    def get_state(self):
+        state = super().get_state()
+        if self.last_image:
+            state['last_image'] = self.last_image
+        return state
+
+    def load_state(self, state):
+        super().load_state(state)
+        if 'last_image' in state:
+            self.last_image = state['last_image']
 
     @gen.coroutine
     def get_pod_manifest(self):
         """
         Make a pod manifest that will spawn current user's notebook pod.
         """
+        manifest_start = time.perf_counter()
         uid = gen.maybe_future(self.uid(self)) if callable(self.uid) else self.uid
         fs_gid = gen.maybe_future(self.fs_gid(self)) if callable(self.fs_gid) else self.fs_gid
         real_cmd = self.cmd + self.get_args() if self.cmd else None
@@ -100,22 +1711,12 @@ class SLACSpawner(kubespawner.KubeSpawner):
         labels.update(self._expand_all(self.extra_labels))
 
         pod_name = self.pod_name
-        image_spec = (self.image or os.getenv("LAB_IMAGE") )
-        image_name = image_spec
-        if self.user_options:
-            if self.user_options.get('kernel_image'):
-                image_spec = self.user_options.get('kernel_image')
-                image_name = image_spec
-                self.log.info("Replacing image spec from options form: %s" % image_spec)
+        image_spec = self._image_spec()
+        if image_spec != self.image:
+            self.log.info("Replacing image spec from options form: %s" % image_spec)
         self.image = image_spec
-        s_idx = image_spec.find('/')
-        c_idx = image_spec.find(':')
-        tag = "latest"
-        if s_idx != -1:
-            image_name = image_spec[(s_idx + 1):]
-            if c_idx > 0:
-                image_name = image_spec[(s_idx + 1):c_idx]
-                tag = image_spec[(c_idx + 1):].replace('_','.')
+        self.last_image = image_spec
+        image_name, tag = parse_image_spec( image_spec )
         pn_template = image_name + "-{username}-" + tag
         # self.log.info('running image: %s' % (image_name,))
 
@@ -153,69 +1754,99 @@ class SLACSpawner(kubespawner.KubeSpawner):
         # determine which labels to schedule the jupyterlab pod on
         # get names of groups
         gnames = [ i.split(':')[0] for i in self.user_gids ]
-        
-        spawn_on = {}
-        volumes = []
-        volume_mounts = []
-        config = {}
-        spec = {}
-        with open( self.node_selector_config_file, 'r' ) as f:
-            config = yaml.safe_load(f)
-            if 'node_defaults' in config:
-                this = config['node_defaults']
-                if 'spawn_on' in this:
-                    spawn_on = this['spawn_on']
-                if 'spec' in this:
-                    spec = this['spec']
-                    
-        # self.log.info("node-selectors config: %s" % (config,))        
-        if 'node_selectors' in config:
-            for idx, item in enumerate(config['node_selectors']):
-                if 'filter' in item:
-                    this = item['filter']
-                    matching = []
-
-                    self.log.info("checking filter: %s" % (this,))
-                    for n in ( 'gnames', 'images', 'uid'):
-                        if n in this:
-                            a = []
-                            if n == 'gnames':
-                                a = gnames
-                            elif n == 'images':
-                                a = [ image_name, ]
-                            # TODO: hwo to get the uid?
-                            self.log.info("  %s against %s" % (n, a))
-                            if set( this[n] ).intersection( a ):
-                                matching.append( True )
-                            else:
-                                matching.append( False )
-                    self.log.info(" matching: %s" % (matching,))
-                    if False in matching:
-                        continue
-                    else:
-                        spawn_on = item['spawn_on']
-                        spec = item['spec']
-                        if 'cpu' in spec:
-                            self.cpu_limit = spec['cpu']
-                            #self.cpu_guarantee = spec['cpu']
-                        if 'memory' in spec:
-                            self.mem_limit = spec['memory']
-                            #self.mem_guarantee = spec['memory']
-                        if 'env' in spec:
-                            for k,v in spec['env'].items():
-                              pod_env[k] = str(v)
-                        self.log.info(" using spec: %s" % (spec,))
-                        break
+
+        rule_start = time.perf_counter()
+        rules = self.node_selector_rules.rules
+        spawn_on = rules.default_spawn_on
+        spec = rules.default_spec
+        fallback = rules.default_fallback
+        rule = rules.match( gnames, image_name )
+        self._spawn_labels = ( self.image_label( image_spec ), rule.name if rule is not None else 'default' )
+        NODE_SELECTOR_DURATION.labels( *self._spawn_labels ).observe( time.perf_counter() - rule_start )
+        # lets the culler apply the rule's idle_timeout, and usage be tracked per image
+        labels['hub.jupyter.org/node-selector-rule'] = self._spawn_labels[1]
+        labels['hub.jupyter.org/image'] = label_value( image_name )
+        if rule is not None:
+            spawn_on = rule.spawn_on
+            spec = rule.spec
+            fallback = rule.fallback
+            if 'cpu' in spec:
+                self.cpu_limit = spec['cpu']
+                #self.cpu_guarantee = spec['cpu']
+            if 'memory' in spec:
+                self.mem_limit = spec['memory']
+                #self.mem_guarantee = spec['memory']
+            if 'env' in spec:
+                for k,v in spec['env'].items():
+                  pod_env[k] = str(v)
+        self.log.debug("node selector rule for %s (groups %s): %s" % (image_name, gnames, rule))
+
+        # guarantee what this user's (else everybody's) past sessions of the image peaked at
+        if self.rightsizing_enabled:
+            self._rightsize( labels['hub.jupyter.org/image'] )
+
+        # launch by digest when we know it, so that cached images need no registry round trip
+        pod_image = self.image
+        image_pull_policy = self.image_pull_policy
+        if self.image_digest_enabled:
+            digest_ref = yield self.digest_resolver.resolve( self.image )
+            if digest_ref:
+                pod_image = digest_ref
+                image_pull_policy = 'IfNotPresent'
+
+        # take the node of a warm placeholder pod, if there is one
+        node = None
+        warm_affinity = []
+        if self.warm_pool_enabled and self._spawn_labels[0] != 'other':
+            key = WarmPoolKey( self.image, self._spawn_labels[1] )
+            self.warm_pool.record( key, pod_image, self._warm_pod_template( key, spawn_on, spec, pod_image ) )
+            claim_start = time.perf_counter()
+            node = yield self.warm_pool.claim( key, pod_image )
+            WARM_POOL_CLAIM_DURATION.labels( *self._spawn_labels ).observe( time.perf_counter() - claim_start )
+            WARM_POOL_CLAIMS.labels( *self._spawn_labels, 'hit' if node else 'miss' ).inc()
+            if node:
+                self.log.info("claimed warm node %s for %s" % (node, pod_name))
+                # only preferred: should another pod take the freed room first, the
+                # scheduler places this one elsewhere instead of leaving it pending
+                warm_affinity = [{
+                    'weight': 100,
+                    'preference': {
+                        'matchFields': [{ 'key': 'metadata.name', 'operator': 'In', 'values': [node] }],
+                    },
+                }]
+
+        # rather than leave the pod pending until start_timeout, go elsewhere or fail now
+        if self.capacity_check_enabled and node is None and \
+                self.node_watcher.first_load.is_set() and self.pod_watcher.first_load.is_set():
+            selectors = [spawn_on] + list(fallback)
+            requests = self._requests( spec )
+            idx, most_free = self._place( selectors, requests )
+            if idx is None:
+                SPAWN_PLACEMENTS.labels( *self._spawn_labels, 'full' ).inc()
+                raise SpawnCapacityError(
+                    "No room for %s: no node matching %s has %s free (at most %s free)" % (
+                        image_spec, ' or '.join(str(sel) for sel in selectors),
+                        ', '.join('%s=%g' % kv for kv in sorted(requests.items())),
+                        ', '.join('%s=%g' % kv for kv in sorted(most_free.items())) or 'no schedulable node'))
+            SPAWN_PLACEMENTS.labels( *self._spawn_labels, 'primary' if idx == 0 else 'fallback-%d' % idx ).inc()
+            if idx:
+                self.log.info("%s is full, using fallback node selector %s" % (spawn_on, selectors[idx]))
+                spawn_on = selectors[idx]
+
+        node_affinity_preferred = list( warm_affinity )
+        if self.image_locality_enabled:
+            node_affinity_preferred += self._image_affinity( [self.image, pod_image], spawn_on )
 
         self.log.info("spawning pod %s on %s, spec %s" % (pod_name,spawn_on,spec))
-        return make_pod(
+        pod = make_pod(
             name=self.pod_name,
-            image=self.image,
-            image_pull_policy=self.image_pull_policy,
+            image=pod_image,
+            image_pull_policy=image_pull_policy,
             image_pull_secret=self.image_pull_secrets,
             port=self.port,
             cmd=real_cmd,
             node_selector=spawn_on,
+            node_affinity_preferred=node_affinity_preferred,
             run_as_uid=uid,
             fs_gid=fs_gid,
             run_privileged=self.privileged,
@@ -236,12 +1867,74 @@ class SLACSpawner(kubespawner.KubeSpawner):
             # extra_container_config = { 'securityContext': { 'capabilities': { 'add': [ 'ALL',  ] }  } },
             extra_container_config=spec['extra_container_config'] if 'extra_container_config' in spec else {},
         )
+        POD_MANIFEST_DURATION.labels( *self._spawn_labels ).observe( time.perf_counter() - manifest_start )
+        return pod
+
+    @gen.coroutine
+    def start(self):
+        started = time.monotonic()
+        self._spawn_labels = ( self.image_label( self._image_spec() ), 'default' )
+        self._spawn_pending = True
+        kube_started = self._kube_started = Event()
+        IOLoop.current().spawn_callback( self._observe_scheduled, started )
+        # a start that finishes late (after a timeout and a new spawn) must only release its own ticket
+        ticket = None
+        start_timeout = self.start_timeout
+        try:
+            if self.admission_enabled:
+                ticket = self._enqueue()
+                yield self._admit( ticket )
+                # the hub's start_timeout also runs while queued; KubeSpawner.start gets what is left
+                self.start_timeout = max( 1, start_timeout - (time.monotonic() - started) )
+            start_future = super().start()
+            kube_started.set()
+            result = yield start_future
+        except Exception:
+            SPAWN_FAILURES.labels( *self._spawn_labels ).inc()
+            raise
+        finally:
+            self.start_timeout = start_timeout
+            if self._kube_started in (kube_started, None):
+                self._spawn_pending = False
+            if ticket is not None:
+                self._release_admission( ticket )
+        SPAWN_READY_DURATION.labels( *self._spawn_labels ).observe( time.monotonic() - started )
+        return result
+
+    @gen.coroutine
+    def _observe_scheduled(self, started):
+        """Record when the pod of the current spawn gets its PodScheduled condition."""
+        while self._spawn_pending:
+            pod = self.pod_reflector.pods.get( self.pod_name )
+            if pod is not None and pod.status is not None:
+                for condition in pod.status.conditions or ():
+                    if condition.type == 'PodScheduled' and condition.status == 'True':
+                        SPAWN_SCHEDULED_DURATION.labels( *self._spawn_labels ).observe( time.monotonic() - started )
+                        return
+            yield gen.sleep( 0.5 )
+
+    @gen.coroutine
+    def stop(self, now=False):
+        # a spawn cancelled while queued gives up its place
+        self._release_admission()
+        self._kube_started = None
+        result = yield super().stop( now=now )
+        return result
 
     def options_from_form(self, formdata=None):
         options = {}
         if (formdata and 'kernel_image' in formdata and
                 formdata['kernel_image']):
-            options['kernel_image'] = formdata['kernel_image'][0]
+            image_spec = formdata['kernel_image'][0]
+            # only what the form offered: images of the catalog the rules allow for the user's groups
+            if image_spec not in self.image_catalog.images:
+                raise ValueError("%s is not in the image catalog" % image_spec)
+            gnames = self._form_gnames
+            if gnames is None and self.user_gids:
+                gnames = [ i.split(':')[0] for i in self.user_gids ]
+            if gnames is not None and not self.node_selector_rules.rules.allows( gnames, parse_image_spec( image_spec )[0] ):
+                raise ValueError("%s is not available to %s" % (image_spec, self.user.name))
+            options['kernel_image'] = image_spec
         return options
 
 
@@ -250,6 +1943,19 @@ c.JupyterHub.spawner_class = SLACSpawner
 c.SLACSpawner.node_selector_config_file = '/opt/jupyterhub/config/node-selectors.yaml'
 c.SLACSpawner.images_config_d = '/opt/jupyterhub/config/images.d/'
 
+c.SLACSpawner.image_locality_enabled = True
+c.SLACSpawner.image_digest_enabled = True
+c.SLACSpawner.capacity_check_enabled = True
+
+# at most 10 pods pulling/starting the same image at once
+c.SLACSpawner.admission_enabled = True
+c.SLACSpawner.admission_image_limit = 10
+#c.SLACSpawner.warm_pool_enabled = True
+
+# guarantees from past usage (needs metrics-server); the history is kept on the hub-data volume
+#c.SLACSpawner.rightsizing_enabled = True
+c.SLACSpawner.rightsizing_history_file = '/home/jupyter/usage-history.json'
+
 c.SLACSpawner.start_timeout = 60
 c.SLACSpawner.http_timeout = 60
 
@@ -0,0 +1,68 @@
+"""
+Utilities from utils/ run as hub managed services. Each runs unless its
+environment variable says otherwise:
+
+prepuller          catalog-prepuller.py pulls the images offered in images.d
+                   onto the nodes they can be spawned on as soon as the
+                   ConfigMap changes, rather than once a night.
+                   Disable with PREPULLER_DISABLED.
+
+catalog-refresher  catalog-refresher.py keeps the images.d files in the
+                   hub-config ConfigMap following the registries instead of
+                   being edited by hand. Off unless CATALOG_REFRESHER_ENABLED
+                   is set, as it patches the ConfigMap the hub is deployed from.
+
+culler             hub-culler.py stops servers idle for longer than their node
+                   selector rule's idle_timeout (LAB_IDLE_TIMEOUT if it sets
+                   none), whether or not the image honours
+                   JUPYTERLAB_IDLE_TIMEOUT. Disable with CULLER_DISABLED.
+
+config.d files do not share a namespace, so the services are all declared
+here with managed_service().
+"""
+import os
+import sys
+
+
+def managed_service(name, script, args, admin=False):
+    """Run script (from JUPYTERHUB_BIN) with args as the managed service name, if it is installed."""
+    path = os.path.join(os.getenv('JUPYTERHUB_BIN') or '/opt/jupyterhub', script)
+    if not os.path.exists(path):
+        return
+    service = {
+        'name': name,
+        'command': [sys.executable, path] + list(args),
+        # managed services only inherit a few variables; the kubernetes client needs these
+        'environment': dict((k, os.environ[k]) for k in (
+            'KUBERNETES_SERVICE_HOST', 'KUBERNETES_SERVICE_PORT') if k in os.environ),
+    }
+    if admin:
+        service['admin'] = True
+    c.JupyterHub.services.append(service)
+
+
+if not os.getenv('PREPULLER_DISABLED'):
+    managed_service('prepuller', 'catalog-prepuller.py', [
+        '--watch',
+        '--images-d', '/opt/jupyterhub/config/images.d/',
+        '--node-selectors', '/opt/jupyterhub/config/node-selectors.yaml',
+        '--max-parallel', os.getenv('PREPULLER_MAX_PARALLEL') or '10',
+        '--per-node', os.getenv('PREPULLER_PER_NODE') or '1',
+    ])
+
+if os.getenv('CATALOG_REFRESHER_ENABLED'):
+    managed_service('catalog-refresher', 'catalog-refresher.py', [
+        '--watch',
+        '--config', '/opt/jupyterhub/config/catalogs.yaml',
+        '--configmap', os.getenv('CATALOG_REFRESHER_CONFIGMAP') or 'hub-config',
+        '--interval', os.getenv('CATALOG_REFRESHER_INTERVAL') or '3600',
+        '--cache-dir', '/tmp/catalog-refresher',
+    ])
+
+if not os.getenv('CULLER_DISABLED'):
+    managed_service('culler', 'hub-culler.py', [
+        '--node-selectors', '/opt/jupyterhub/config/node-selectors.yaml',
+        '--timeout', os.getenv('LAB_IDLE_TIMEOUT') or '43200',
+        '--interval', os.getenv('CULLER_INTERVAL') or '300',
+        '--concurrency', os.getenv('CULLER_CONCURRENCY') or '10',
+    ], admin=True)
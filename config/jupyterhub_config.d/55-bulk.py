@@ -0,0 +1,229 @@
+"""
+Admin API to spawn or stop the servers of many users at once, e.g. a
+workshop roster (see utils/hub-bulk.py):
+
+    POST /hub/api/slac/bulk        {"action": "spawn", "users": [...], "image": "...", "concurrency": 20}
+    GET  /hub/api/slac/bulk/<id>   progress of each user of the job
+    GET  /hub/api/slac/bulk        all recent jobs
+
+A spawn job first resolves the uid and groups of all its users through the
+authenticator's identity cache (and the image's digest), concurrently, so
+that pre_spawn_start and get_pod_manifest find them cached; users that can't
+be resolved fail, and are not added to the hub. Then at most `concurrency`
+servers are spawned (or stopped) at a time, each slot held until its server
+is ready (or gone). A spawn the hub refuses with 429 because other users'
+spawns fill concurrent_spawn_limit is shown as throttled and retried for up
+to BULK_THROTTLE_TIMEOUT seconds.
+"""
+import json
+import os
+import time
+import uuid
+from collections import OrderedDict
+
+from jupyterhub.apihandlers.base import APIHandler
+from jupyterhub.utils import admin_only
+from tornado import gen, web
+from tornado.ioloop import IOLoop
+from tornado.locks import Semaphore
+
+BULK_CONCURRENCY = int(os.getenv('BULK_CONCURRENCY') or 10)
+BULK_JOBS_KEPT = 20
+# how long a spawn refused by the hub's concurrent_spawn_limit keeps retrying
+BULK_THROTTLE_TIMEOUT = int(os.getenv('BULK_THROTTLE_TIMEOUT') or 600)
+BULK_THROTTLE_RETRY = 5
+
+
+class BulkJob(object):
+    """Progress of one bulk spawn or stop."""
+
+    def __init__(self, action, users, image=None, concurrency=BULK_CONCURRENCY):
+        self.id = uuid.uuid4().hex[:12]
+        self.action = action
+        self.image = image
+        self.concurrency = concurrency
+        self.created = time.time()
+        self.finished = None
+        self.users = OrderedDict((name, {'state': 'queued', 'message': '', 'elapsed': None}) for name in users)
+
+    def update(self, name, state, message='', started=None):
+        progress = self.users[name]
+        progress['state'] = state
+        progress['message'] = message
+        if started is not None:
+            progress['elapsed'] = round(time.monotonic() - started, 1)
+
+    def model(self, users=True):
+        counts = {}
+        for progress in self.users.values():
+            counts[progress['state']] = counts.get(progress['state'], 0) + 1
+        model = {
+            'id': self.id,
+            'action': self.action,
+            'image': self.image,
+            'concurrency': self.concurrency,
+            'created': self.created,
+            'finished': self.finished,
+            'counts': counts,
+        }
+        if users:
+            model['users'] = self.users
+        return model
+
+
+class BulkAPIHandler(APIHandler):
+    """Start bulk jobs, and report their progress."""
+
+    jobs = OrderedDict()
+
+    @admin_only
+    def get(self, job_id=None):
+        if job_id is None:
+            self.write(json.dumps([job.model(users=False) for job in self.jobs.values()]))
+            return
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise web.HTTPError(404, "No bulk job %s" % job_id)
+        self.write(json.dumps(job.model()))
+
+    @admin_only
+    def post(self, job_id=None):
+        if job_id is not None:
+            raise web.HTTPError(405)
+        body = self.get_json_body() or {}
+        action = body.get('action')
+        users = body.get('users')
+        if action not in ('spawn', 'stop'):
+            raise web.HTTPError(400, "action must be spawn or stop")
+        if not users or not isinstance(users, list) or not all(isinstance(u, str) for u in users):
+            raise web.HTTPError(400, "users must be a list of user names")
+        concurrency = body.get('concurrency') or BULK_CONCURRENCY
+        if not isinstance(concurrency, int) or isinstance(concurrency, bool) or concurrency < 1:
+            raise web.HTTPError(400, "concurrency must be a positive integer")
+        # above the hub's limit spawns would be refused with 429
+        if self.concurrent_spawn_limit:
+            concurrency = min(concurrency, self.concurrent_spawn_limit)
+        job = BulkJob(action, list(OrderedDict.fromkeys(users)), body.get('image'), max(1, concurrency))
+        self.jobs[job.id] = job
+        while len(self.jobs) > BULK_JOBS_KEPT:
+            self.jobs.popitem(last=False)
+        self.log.info("Bulk %s of %d user(s) (image %s, %d at a time) as job %s requested by %s",
+                      action, len(job.users), job.image, job.concurrency, job.id, self.current_user.name)
+        IOLoop.current().spawn_callback(self.run_job, job)
+        self.set_status(202)
+        self.write(json.dumps(job.model()))
+
+    @gen.coroutine
+    def run_job(self, job):
+        try:
+            if job.action == 'spawn':
+                yield self._resolve(job)
+            slots = Semaphore(job.concurrency)
+            run_one = self._spawn if job.action == 'spawn' else self._stop
+
+            @gen.coroutine
+            def one(name):
+                with (yield slots.acquire()):
+                    started = time.monotonic()
+                    try:
+                        yield run_one(job, name, started)
+                    except Exception as e:
+                        self.log.warning("Bulk %s of %s failed: %s", job.action, name, e)
+                        job.update(name, 'failed', str(e), started)
+
+            yield [one(name) for name, progress in job.users.items() if progress['state'] == 'queued']
+        finally:
+            job.finished = time.time()
+            self.log.info("Bulk job %s done: %s", job.id, job.model(users=False)['counts'])
+
+    @gen.coroutine
+    def _resolve(self, job):
+        """Look up every user's identity, then the image digest, before the first spawn.
+
+        Users are only added to the hub once their identity resolved, so that a typo in a
+        roster fails instead of creating a user. Without an identity cache only existing
+        users are spawned.
+        """
+        identity_cache = getattr(self.authenticator, 'identity_cache', None)
+        slots = Semaphore(job.concurrency)
+
+        @gen.coroutine
+        def one(name):
+            with (yield slots.acquire()):
+                if identity_cache is None:
+                    if self.find_user(name) is None:
+                        job.update(name, 'failed', "no such user")
+                    return
+                job.update(name, 'resolving')
+                try:
+                    yield identity_cache.get(name)
+                except Exception as e:
+                    job.update(name, 'failed', "identity lookup failed: %s" % e)
+                    return
+                if self.find_user(name) is None:
+                    self.user_from_username(name)
+                job.update(name, 'queued')
+
+        yield [one(name) for name in job.users]
+        resolved = [name for name, progress in job.users.items() if progress['state'] == 'queued']
+        if job.image and resolved:
+            spawner = self.find_user(resolved[0]).spawner
+            if getattr(spawner, 'image_digest_enabled', False):
+                yield spawner.digest_resolver.resolve(job.image)
+
+    @gen.coroutine
+    def _spawn(self, job, name, started):
+        user = self.find_user(name)
+        if user is None:
+            job.update(name, 'failed', 'no such user', started)
+            return
+        spawner = user.spawner
+        if spawner.active:
+            job.update(name, 'running', 'already running' if spawner.ready else 'already pending', started)
+            return
+        job.update(name, 'spawning')
+        deadline = time.monotonic() + BULK_THROTTLE_TIMEOUT
+        while True:
+            try:
+                yield self.spawn_single_user(user, options={'kernel_image': job.image} if job.image else None)
+                break
+            except web.HTTPError as e:
+                # other spawns fill the hub's concurrent_spawn_limit; wait for one to finish
+                if e.status_code != 429 or time.monotonic() > deadline:
+                    raise
+                job.update(name, 'throttled', e.log_message or 'too many spawns pending')
+                yield gen.sleep(BULK_THROTTLE_RETRY)
+                job.update(name, 'spawning')
+        # spawn_single_user returns after slow_spawn_timeout; keep the slot until the server is up
+        spawn_future = getattr(spawner, '_spawn_future', None)
+        if spawn_future is not None:
+            yield spawn_future
+        if spawner.ready:
+            job.update(name, 'running', '', started)
+        else:
+            job.update(name, 'failed', 'server did not start', started)
+
+    @gen.coroutine
+    def _stop(self, job, name, started):
+        user = self.find_user(name)
+        if user is None or not user.spawner.active:
+            job.update(name, 'stopped', 'not running', started)
+            return
+        spawner = user.spawner
+        job.update(name, 'stopping')
+        stop_future = yield self.stop_single_user(user)
+        # stop_single_user returns after slow_stop_timeout; keep the slot until the server is gone
+        if gen.is_future(stop_future):
+            yield stop_future
+        while getattr(spawner, '_stop_pending', False):
+            yield gen.sleep(1)
+        if spawner.active:
+            job.update(name, 'failed', 'server did not stop', started)
+        else:
+            job.update(name, 'stopped', '', started)
+
+
+c.JupyterHub.extra_handlers.extend([
+    (r'/api/slac/bulk', BulkAPIHandler),
+    (r'/api/slac/bulk/([^/]+)', BulkAPIHandler),
+])
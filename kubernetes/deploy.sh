@@ -52,6 +52,6 @@ gen_template "pvc.yaml" | kubectl  -n ${namespace} ${ACTION} -f -
 if [ "${ACTION}" == "replace" ]; then
   kubectl -n ${namespace} delete configmap hub-config
 fi
-kubectl -n ${namespace} create configmap hub-config  --from-file=../config/jupyterhub_config.py  --from-file=../config/node-selectors.yaml --from-file=../config/jupyterhub_config.d --from-file=../config/images.d
+kubectl -n ${namespace} create configmap hub-config  --from-file=../config/jupyterhub_config.py  --from-file=../config/node-selectors.yaml --from-file=../config/catalogs.yaml --from-file=../config/jupyterhub_config.d --from-file=../config/images.d
 
 gen_template "jupyterhub.yaml" | kubectl -n ${namespace} ${ACTION} -f -
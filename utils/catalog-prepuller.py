@@ -0,0 +1,235 @@
+#!/bin/env python
+"""Pre-pull the images offered in images.d onto the nodes they can be spawned on.
+
+Reads the same images.d catalog and node-selectors.yaml as the hub. For every
+image the target nodes are those carrying the spawn_on labels of the rules
+that name the image in their `images` filter; an image no rule names goes
+wherever a user without groups would be sent (the first unfiltered rule, else
+node_defaults). Rules are read with the spawner's own NodeSelectorRules (see
+hubconfig.py), so both always agree. Nodes whose status already lists the
+image, and nodes that are unschedulable or not Ready, are skipped.
+
+Each pull is a short-lived pod pinned to the node with nodeName. Pulls run in
+parallel, bounded cluster-wide by --max-parallel and per node by --per-node.
+With --watch a pass is run every --interval seconds, which also retries the
+pulls that failed or timed out.
+"""
+import argparse
+import glob
+import hashlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+from kubernetes import client, config
+from kubernetes.client.rest import ApiException
+
+from hubconfig import SPAWNER_CONFIG, load_spawner_config
+
+NAMESPACE_FILE = '/var/run/secrets/kubernetes.io/serviceaccount/namespace'
+
+
+class CatalogPrepuller(object):
+    """Pulls catalog images onto the nodes their node selector rules allow."""
+
+    def __init__(self, images_d, node_selectors, namespace,
+                 max_parallel=10, per_node=1, timeout=1800, dry_run=False, spawner_config=SPAWNER_CONFIG):
+        spawner = load_spawner_config(spawner_config)
+        self.NodeSelectorRules = spawner['NodeSelectorRules']
+        self.parse_image_spec = spawner['parse_image_spec']
+        self.normalize_image = spawner['normalize_image']
+        self.images_d = images_d
+        self.node_selectors = node_selectors
+        self.namespace = namespace
+        self.max_parallel = max_parallel
+        self.per_node = per_node
+        self.timeout = timeout
+        self.dry_run = dry_run
+        self.api = client.CoreV1Api()
+        self.log = logging.getLogger('prepuller')
+        self._node_slots = {}
+        self._lock = threading.Lock()
+
+    def images(self):
+        images = []
+        for path in sorted(glob.glob(os.path.join(self.images_d, '*.yaml'))):
+            with open(path) as f:
+                try:
+                    section = yaml.safe_load(f) or {}
+                except Exception:
+                    self.log.warning("Could not parse image list %s", path)
+                    continue
+            for image in section.get('images') or ():
+                if image.get('image') and image['image'] not in images:
+                    images.append(image['image'])
+        return images
+
+    def rules(self):
+        with open(self.node_selectors) as f:
+            return self.NodeSelectorRules(yaml.safe_load(f) or {})
+
+    def placements(self, rules, image_spec):
+        """spawn_on selectors the image can be scheduled with."""
+        return rules.placements(self.parse_image_spec(image_spec)[0])
+
+    def nodes(self):
+        nodes = {}
+        for node in self.api.list_node().items:
+            # a pull pod pinned to a NotReady node would only sit there until it times out
+            ready = any(c.type == 'Ready' and c.status == 'True' for c in node.status.conditions or ())
+            if node.spec.unschedulable or not ready:
+                continue
+            images = set()
+            for image in (node.status.images or ()):
+                images.update(self.normalize_image(n) for n in image.names or ())
+            nodes[node.metadata.name] = (node.metadata.labels or {}, images)
+        return nodes
+
+    def plan(self):
+        """[(node, image)] pulls still needed, interleaved across nodes."""
+        nodes = self.nodes()
+        rules = self.rules()
+        per_node = {}
+        for image in self.images():
+            wanted = set()
+            for selector in self.placements(rules, image):
+                for name, (labels, _) in nodes.items():
+                    if all(labels.get(k) == str(v) for k, v in selector.items()):
+                        wanted.add(name)
+            for name in sorted(wanted):
+                if self.normalize_image(image) not in nodes[name][1]:
+                    per_node.setdefault(name, []).append(image)
+        # round robin over nodes, so that per-node limits rarely hold up a worker
+        pulls = []
+        while per_node:
+            for name in sorted(per_node):
+                pulls.append((name, per_node[name].pop(0)))
+                if not per_node[name]:
+                    del per_node[name]
+        return pulls
+
+    def _slot(self, node):
+        with self._lock:
+            if node not in self._node_slots:
+                self._node_slots[node] = threading.BoundedSemaphore(self.per_node)
+            return self._node_slots[node]
+
+    def _delete(self, pod_name):
+        try:
+            self.api.delete_namespaced_pod(pod_name, self.namespace, body=client.V1DeleteOptions(grace_period_seconds=0))
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            return
+        # the name is only free once the pod is gone
+        for _ in range(60):
+            try:
+                self.api.read_namespaced_pod(pod_name, self.namespace)
+            except ApiException as e:
+                if e.status == 404:
+                    return
+                raise
+            time.sleep(1)
+
+    def pull(self, node, image):
+        """Run a no-op pod of image on node, which makes the kubelet pull it."""
+        pod_name = 'prepull-%s' % hashlib.sha1(('%s/%s' % (node, image)).encode()).hexdigest()[:16]
+        pod = client.V1Pod(
+            metadata=client.V1ObjectMeta(name=pod_name, labels={'app': 'catalog-prepuller'}),
+            spec=client.V1PodSpec(
+                node_name=node,
+                restart_policy='Never',
+                containers=[client.V1Container(
+                    name='prepull',
+                    image=image,
+                    image_pull_policy='IfNotPresent',
+                    command=['/bin/sh', '-c', 'exit 0'],
+                )],
+            ),
+        )
+        with self._slot(node):
+            start = time.monotonic()
+            self.log.info("Pulling %s onto %s", image, node)
+            phase = None
+            try:
+                # left over by a run that died mid-pull
+                self._delete(pod_name)
+                self.api.create_namespaced_pod(self.namespace, pod)
+                while time.monotonic() - start < self.timeout:
+                    status = self.api.read_namespaced_pod(pod_name, self.namespace).status
+                    phase = status.phase
+                    if phase in ('Succeeded', 'Failed'):
+                        break
+                    waiting = [c.state.waiting.reason for c in status.container_statuses or ()
+                               if c.state and c.state.waiting]
+                    if any(r in ('ErrImagePull', 'ImagePullBackOff', 'InvalidImageName') for r in waiting):
+                        phase = waiting[0]
+                        break
+                    time.sleep(5)
+            finally:
+                self._delete(pod_name)
+            self.log.info("Pulled %s onto %s: %s after %.0fs", image, node, phase, time.monotonic() - start)
+            return phase
+
+    def run(self):
+        pulls = self.plan()
+        self.log.info("%d pull(s) needed", len(pulls))
+        if self.dry_run:
+            for node, image in pulls:
+                self.log.info("would pull %s onto %s", image, node)
+            return pulls
+        with ThreadPoolExecutor(self.max_parallel) as pool:
+            futures = [pool.submit(self.pull, node, image) for node, image in pulls]
+            for f in futures:
+                try:
+                    f.result()
+                except Exception as e:
+                    self.log.warning("Pull failed: %s", e)
+        return pulls
+
+    def watch(self, interval=60):
+        # plan() skips the nodes that have the image, so a pass is cheap once the catalog is pulled
+        while True:
+            try:
+                self.run()
+            except Exception as e:
+                self.log.warning("Prepull pass failed: %s", e)
+            time.sleep(interval)
+
+
+if __name__ == '__main__':
+
+    namespace = 'default'
+    if os.path.exists(NAMESPACE_FILE):
+        with open(NAMESPACE_FILE) as f:
+            namespace = f.read().strip()
+
+    parser = argparse.ArgumentParser(description='Pre-pull the images.d catalog onto the nodes it can run on.')
+    parser.add_argument('--images-d', default='/opt/jupyterhub/config/images.d/')
+    parser.add_argument('--node-selectors', default='/opt/jupyterhub/config/node-selectors.yaml')
+    parser.add_argument('--namespace', default=namespace)
+    parser.add_argument('--max-parallel', type=int, default=10, help='pulls in flight across the cluster')
+    parser.add_argument('--per-node', type=int, default=1, help='pulls in flight per node')
+    parser.add_argument('--timeout', type=int, default=1800, help='seconds to wait for one pull')
+    parser.add_argument('--watch', action='store_true', help='keep running, pulling on catalog changes')
+    parser.add_argument('--interval', type=int, default=60, help='seconds between passes with --watch')
+    parser.add_argument('--spawner-config', default=SPAWNER_CONFIG, help='the hub\'s 20-spawner.py')
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    try:
+        config.load_incluster_config()
+    except config.ConfigException:
+        config.load_kube_config()
+
+    prepuller = CatalogPrepuller(args.images_d, args.node_selectors, args.namespace,
+                                 max_parallel=args.max_parallel, per_node=args.per_node,
+                                 timeout=args.timeout, dry_run=args.dry_run, spawner_config=args.spawner_config)
+    if args.watch:
+        prepuller.watch(args.interval)
+    else:
+        prepuller.run()
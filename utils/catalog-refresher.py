@@ -0,0 +1,230 @@
+#!/bin/env python
+"""Keep the images.d catalog files up to date from the image registries.
+
+Reads a catalogs.yaml listing, for every images.d file, the repositories it
+is built from and the retention policy of each (see config/catalogs.yaml).
+All repositories are scanned in parallel with ScanRepo from
+lsst-image-scanner.py. A file is only rewritten when its list of images
+changes, and then atomically: a new file is renamed over the old one in
+--output, and/or all changed keys of the --configmap are patched at once
+(the kubelet swaps the mounted images.d as a whole). If any repository of
+a catalog fails to scan, that catalog is left as it was.
+
+With --watch the scan is repeated every --interval seconds.
+"""
+import argparse
+import datetime
+import importlib.util
+import logging
+import os
+import re
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+NAMESPACE_FILE = '/var/run/secrets/kubernetes.io/serviceaccount/namespace'
+BUILD_TAG = re.compile(r'^(\d{8})\.(\d+)$')
+
+
+def load_scanner():
+    """ScanRepo lives next to this script, in a file python can't import by name."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    spec = importlib.util.spec_from_file_location(
+        'lsst_image_scanner', os.path.join(here, 'lsst-image-scanner.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.ScanRepo
+
+
+ScanRepo = load_scanner()
+
+
+class CatalogRefresher(object):
+    """Builds images.d catalogs from registry tags and writes the changed ones."""
+
+    def __init__(self, catalogs, output=None, configmap=None, namespace=None,
+                 workers=8, cache_dir=None):
+        self.catalogs = catalogs
+        self.output = output
+        self.configmap = configmap
+        self.namespace = namespace
+        self.workers = workers
+        self.cache_dir = cache_dir
+        self.log = logging.getLogger('catalog-refresher')
+        self.api = None
+        if configmap:
+            from kubernetes import client
+            self.api = client.CoreV1Api()
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        with open(path) as f:
+            conf = yaml.safe_load(f) or {}
+        return cls(conf.get('catalogs') or [], **kwargs)
+
+    def _scanner(self, repo):
+        owner, name = repo['repo'].split('/', 1)
+        return ScanRepo(host=repo.get('host', 'hub.docker.com'),
+                        owner=owner, name=name, insecure=repo.get('insecure', False),
+                        cache_dir=self.cache_dir)
+
+    def scan(self, repo):
+        """[(image, description)] kept by the repository's policy"""
+        policy = repo.get('policy', 'release')
+        template = repo.get('description', '{repo}:{tag}')
+        if policy == 'static':
+            tags = list(repo.get('tags') or ())
+        else:
+            with self._scanner(repo) as scanner:
+                if policy == 'lsst':
+                    scanner.dailies = repo.get('dailies', 3)
+                    scanner.weeklies = repo.get('weeklies', 2)
+                    scanner.releases = repo.get('releases', 1)
+                    scanner.scan()
+                    names, descs = scanner.extract_image_info()
+                    return list(zip(names, descs))
+                tags = self._select(policy, repo, scanner.tags())
+        owner, name = repo['repo'].split('/', 1)
+        return [('%s:%s' % (repo['repo'], tag),
+                 template.format(repo=repo['repo'], name=name, tag=tag))
+                for tag in tags]
+
+    def _select(self, policy, repo, results):
+        keep = repo.get('keep', 1)
+        if policy == 'build':
+            builds = []
+            for res in results:
+                m = BUILD_TAG.match(res['name'])
+                if m:
+                    builds.append(((m.group(1), int(m.group(2))), res['name']))
+            builds.sort(reverse=True)
+            return [tag for _, tag in builds[:keep]]
+        if policy == 'release':
+            match = re.compile(repo.get('match', '.'))
+            releases = [res for res in results if match.search(res['name'])]
+            releases.sort(key=lambda res: res['last_updated'], reverse=True)
+            return [res['name'] for res in releases[:keep]]
+        raise ValueError("Unknown policy %r for %s" % (policy, repo['repo']))
+
+    def build(self):
+        """{file: catalog} for every catalog whose repositories all scanned"""
+        repos = [repo for catalog in self.catalogs for repo in catalog.get('repositories') or ()]
+        with ThreadPoolExecutor(self.workers) as pool:
+            futures = dict((id(repo), pool.submit(self.scan, repo)) for repo in repos)
+        now = datetime.datetime.utcnow().ctime() + ' UTC'
+        built = {}
+        for catalog in self.catalogs:
+            images = []
+            try:
+                for repo in catalog.get('repositories') or ():
+                    for image, description in futures[id(repo)].result():
+                        images.append({'image': image, 'description': description})
+            except Exception as e:
+                self.log.warning("Not refreshing %s: %s", catalog['file'], e)
+                continue
+            if not images:
+                self.log.warning("Not refreshing %s: no images matched", catalog['file'])
+                continue
+            built[catalog['file']] = {'title': catalog.get('title', catalog['file']),
+                                      'updated': now, 'images': images}
+        return built
+
+    @staticmethod
+    def _same(old_text, new):
+        """Compare ignoring the `updated` stamp, so an unchanged scan writes nothing."""
+        try:
+            old = yaml.safe_load(old_text) or {}
+        except Exception:
+            return False
+        return (old.get('title'), old.get('images')) == (new['title'], new['images'])
+
+    @staticmethod
+    def _render(catalog):
+        return yaml.safe_dump(catalog, default_flow_style=False)
+
+    def write_files(self, built):
+        changed = []
+        for name, catalog in sorted(built.items()):
+            path = os.path.join(self.output, name)
+            try:
+                with open(path) as f:
+                    if self._same(f.read(), catalog):
+                        continue
+            except OSError:
+                pass
+            fd, tmp = tempfile.mkstemp(dir=self.output, prefix='.' + name)
+            with os.fdopen(fd, 'w') as f:
+                f.write(self._render(catalog))
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, path)
+            changed.append(name)
+        return changed
+
+    def write_configmap(self, built):
+        current = self.api.read_namespaced_config_map(self.configmap, self.namespace).data or {}
+        data = {}
+        for name, catalog in sorted(built.items()):
+            if name in current and self._same(current[name], catalog):
+                continue
+            data[name] = self._render(catalog)
+        if data:
+            self.api.patch_namespaced_config_map(self.configmap, self.namespace, {'data': data})
+        return sorted(data)
+
+    def refresh(self):
+        built = self.build()
+        if self.output:
+            changed = self.write_files(built)
+            self.log.info("%d of %d catalog file(s) changed in %s: %s",
+                          len(changed), len(built), self.output, ' '.join(changed))
+        if self.configmap:
+            changed = self.write_configmap(built)
+            self.log.info("%d of %d catalog file(s) changed in configmap %s: %s",
+                          len(changed), len(built), self.configmap, ' '.join(changed))
+
+    def watch(self, interval=3600):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                self.log.warning("Refresh failed: %s", e)
+            time.sleep(interval)
+
+
+if __name__ == '__main__':
+
+    namespace = 'default'
+    if os.path.exists(NAMESPACE_FILE):
+        with open(NAMESPACE_FILE) as f:
+            namespace = f.read().strip()
+
+    parser = argparse.ArgumentParser(description='Refresh the images.d catalog files from the image registries.')
+    parser.add_argument('--config', default='/opt/jupyterhub/config/catalogs.yaml')
+    parser.add_argument('--output', help='images.d directory to rewrite')
+    parser.add_argument('--configmap', help='configmap holding the images.d files to patch')
+    parser.add_argument('--namespace', default=namespace)
+    parser.add_argument('--workers', type=int, default=8, help='repositories scanned at once')
+    parser.add_argument('--cache-dir', help='keep registry responses here to revalidate them')
+    parser.add_argument('--watch', action='store_true', help='keep running, refreshing every --interval')
+    parser.add_argument('--interval', type=int, default=3600)
+    args = parser.parse_args()
+    if not args.output and not args.configmap:
+        parser.error('one of --output or --configmap is required')
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    if args.configmap:
+        from kubernetes import config
+        try:
+            config.load_incluster_config()
+        except config.ConfigException:
+            config.load_kube_config()
+
+    refresher = CatalogRefresher.from_file(args.config, output=args.output, configmap=args.configmap,
+                                           namespace=args.namespace, workers=args.workers,
+                                           cache_dir=args.cache_dir)
+    if args.watch:
+        refresher.watch(args.interval)
+    else:
+        refresher.refresh()
@@ -0,0 +1,101 @@
+#!/bin/env python
+"""Spawn or stop the servers of a list of users through the hub's bulk API.
+
+Posts one job to /hub/api/slac/bulk (config/jupyterhub_config.d/55-bulk.py)
+and follows its progress until every user is done, printing each user as
+their state changes. Users are given as arguments and/or read one per line
+from --file ('#' starts a comment). Needs an admin's API token, from
+--token or JUPYTERHUB_API_TOKEN. Exits non-zero if any user failed.
+
+    hub-bulk.py spawn --file roster.txt --image slaclab/slac-jupyterlab-gpu:20200101.0 --concurrency 20
+    hub-bulk.py stop --file roster.txt
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import urllib.request
+
+DONE = ('running', 'stopped', 'failed')
+
+
+def read_users(names, path):
+    users = list(names)
+    if path:
+        with open(path) as f:
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    users.append(line)
+    return users
+
+
+class BulkClient(object):
+
+    def __init__(self, api_url, api_token):
+        self.api_url = api_url.rstrip('/')
+        self.api_token = api_token
+
+    def _request(self, method, path, body=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        req = urllib.request.Request(self.api_url + path, data=data, method=method,
+                                     headers={'Authorization': 'token %s' % self.api_token,
+                                              'Content-Type': 'application/json'})
+        with urllib.request.urlopen(req, timeout=60) as resp:
+            return json.loads(resp.read().decode('utf-8'))
+
+    def submit(self, action, users, image=None, concurrency=None):
+        body = {'action': action, 'users': users}
+        if image:
+            body['image'] = image
+        if concurrency:
+            body['concurrency'] = concurrency
+        return self._request('POST', '/slac/bulk', body)
+
+    def job(self, job_id):
+        return self._request('GET', '/slac/bulk/%s' % job_id)
+
+    def follow(self, job, interval=2, out=sys.stdout):
+        """Poll the job until it finishes, printing users whose state changed; returns the last model."""
+        seen = {}
+        while True:
+            for name, progress in job['users'].items():
+                state = (progress['state'], progress['message'])
+                if seen.get(name) != state:
+                    seen[name] = state
+                    elapsed = '%6.1fs' % progress['elapsed'] if progress['elapsed'] is not None else ' ' * 7
+                    out.write('%s %-20s %-10s %s\n' % (elapsed, name, progress['state'], progress['message']))
+            out.flush()
+            if job['finished']:
+                return job
+            time.sleep(interval)
+            job = self.job(job['id'])
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Spawn or stop the servers of many users at once.')
+    parser.add_argument('action', choices=('spawn', 'stop'))
+    parser.add_argument('users', nargs='*', help='user names')
+    parser.add_argument('--file', help='file of user names, one per line')
+    parser.add_argument('--image', help='image to spawn (default: the spawner\'s)')
+    parser.add_argument('--concurrency', type=int, help='servers spawned or stopped at once (hub default: 10)')
+    parser.add_argument('--url', default=os.getenv('JUPYTERHUB_API_URL') or 'http://127.0.0.1:8081/hub/api')
+    parser.add_argument('--token', default=os.getenv('JUPYTERHUB_API_TOKEN'), help='admin API token')
+    parser.add_argument('--interval', type=float, default=2, help='seconds between progress checks')
+    args = parser.parse_args()
+
+    users = read_users(args.users, args.file)
+    if not users:
+        parser.error('no users given')
+    if not args.token:
+        parser.error('--token or JUPYTERHUB_API_TOKEN is required')
+
+    bulk = BulkClient(args.url, args.token)
+    start = time.monotonic()
+    job = bulk.follow(bulk.submit(args.action, users, args.image, args.concurrency), args.interval)
+    counts = job['counts']
+    print('%s of %d user(s) done in %.0fs: %s' % (args.action, len(users), time.monotonic() - start,
+                                                  ', '.join('%d %s' % (n, s) for s, n in sorted(counts.items()))))
+    sys.exit(1 if counts.get('failed') else 0)
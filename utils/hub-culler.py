@@ -0,0 +1,202 @@
+#!/bin/env python
+"""Stop notebook servers that have been idle for too long.
+
+Runs as a hub managed service. Each pass fetches every user and server from
+/hub/api/users in one request and the singleuser pods from kubernetes in
+another, then stops the idle servers through the hub API in parallel,
+--concurrency at a time.
+
+How long a server may idle depends on the node selector rule it was spawned
+with (the hub.jupyter.org/node-selector-rule label of its pod): a rule's
+`idle_timeout` in node-selectors.yaml (node_defaults' for the 'default'
+rule), else --timeout. Each pass logs the cpu, memory and GPUs that the
+stopped pods requested.
+"""
+import argparse
+import json
+import logging
+import os
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import escapism
+import yaml
+from dateutil.parser import parse as parse_date
+from kubernetes import client, config
+
+from hubconfig import SPAWNER_CONFIG, load_spawner_config
+
+NAMESPACE_FILE = '/var/run/secrets/kubernetes.io/serviceaccount/namespace'
+RULE_LABEL = 'hub.jupyter.org/node-selector-rule'
+
+def pod_resources(pod, parse_quantity):
+    """cpu, memory and extended resources requested by the containers of a pod (limits if no request)."""
+    total = {}
+    for container in pod.spec.containers or ():
+        resources = container.resources
+        requested = dict((resources.limits or {}) if resources else {})
+        requested.update((resources.requests or {}) if resources else {})
+        for k, v in requested.items():
+            total[k] = total.get(k, 0) + parse_quantity(v)
+    return total
+
+
+class HubCuller(object):
+    """Finds idle servers from one bulk user listing and stops them in parallel."""
+
+    def __init__(self, api_url, api_token, namespace, node_selectors, timeout=43200,
+                 concurrency=10, dry_run=False, spawner_config=SPAWNER_CONFIG):
+        self.api_url = api_url.rstrip('/')
+        self.api_token = api_token
+        self.namespace = namespace
+        self.node_selectors = node_selectors
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.dry_run = dry_run
+        self.k8s = client.CoreV1Api()
+        # quantities are read as the spawner reads them
+        self.parse_quantity = load_spawner_config(spawner_config)['parse_quantity']
+        self.log = logging.getLogger('culler')
+
+    def _request(self, method, path):
+        req = urllib.request.Request(self.api_url + path, method=method,
+                                     headers={'Authorization': 'token %s' % self.api_token})
+        with urllib.request.urlopen(req, timeout=60) as resp:
+            body = resp.read()
+        return json.loads(body.decode('utf-8')) if body else None
+
+    def policies(self):
+        """{rule name: seconds a server of that rule may idle}"""
+        try:
+            with open(self.node_selectors) as f:
+                conf = yaml.safe_load(f) or {}
+        except (OSError, yaml.YAMLError) as e:
+            self.log.warning("Could not read %s, using --timeout for every rule: %s", self.node_selectors, e)
+            return {}
+        policies = {}
+        defaults = conf.get('node_defaults') or {}
+        if 'idle_timeout' in defaults:
+            policies['default'] = defaults['idle_timeout']
+        for idx, item in enumerate(conf.get('node_selectors') or ()):
+            if 'idle_timeout' in item:
+                policies[item.get('name') or 'rule-%d' % idx] = item['idle_timeout']
+        return policies
+
+    def pods(self):
+        """{escaped user name: [pod]} of the running singleuser pods"""
+        pods = {}
+        for pod in self.k8s.list_namespaced_pod(self.namespace, label_selector='component=singleuser-server',
+                                                _request_timeout=60).items:
+            username = (pod.metadata.labels or {}).get('hub.jupyter.org/username')
+            if username:
+                pods.setdefault(username, []).append(pod)
+        return pods
+
+    def servers(self):
+        """(user name, server name, last activity) of every running server"""
+        for user in self._request('GET', '/users') or ():
+            servers = user.get('servers')
+            if servers is None:
+                # user model without named servers
+                servers = {}
+                if user.get('server') and not user.get('pending'):
+                    servers[''] = {'last_activity': user.get('last_activity'), 'pending': None}
+            for name, server in servers.items():
+                if server.get('pending') or not server.get('last_activity'):
+                    continue
+                yield user['name'], name, parse_date(server['last_activity'])
+
+    def stop(self, username, server_name):
+        quoted = urllib.parse.quote(username)
+        if server_name:
+            path = '/users/%s/servers/%s' % (quoted, urllib.parse.quote(server_name))
+        else:
+            path = '/users/%s/server' % quoted
+        if not self.dry_run:
+            self._request('DELETE', path)
+
+    def run(self):
+        start = time.monotonic()
+        policies = self.policies()
+        pods = self.pods()
+        now = datetime.now(timezone.utc)
+        idle = []
+        for username, server_name, last_activity in self.servers():
+            if last_activity.tzinfo is None:
+                last_activity = last_activity.replace(tzinfo=timezone.utc)
+            user_pods = pods.get(escapism.escape(username), [])
+            rules = set((p.metadata.labels or {}).get(RULE_LABEL, 'default') for p in user_pods)
+            # with several pods (named servers) be as patient as the most patient rule
+            timeout = max([policies.get(r, self.timeout) for r in rules] or [self.timeout])
+            age = (now - last_activity).total_seconds()
+            if age > timeout:
+                idle.append((username, server_name, age, user_pods))
+
+        reclaimed = {}
+        stopped = 0
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            futures = [(pool.submit(self.stop, u, s), u, s, a, p) for u, s, a, p in idle]
+            for future, username, server_name, age, user_pods in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    self.log.warning("Could not stop %s/%s: %s", username, server_name, e)
+                    continue
+                stopped += 1
+                self.log.info("Stopped %s/%s, idle for %.1fh", username, server_name, age / 3600)
+                for pod in user_pods:
+                    for k, v in pod_resources(pod, self.parse_quantity).items():
+                        reclaimed[k] = reclaimed.get(k, 0) + v
+
+        summary = ', '.join('%s=%s' % (k, ('%.1fGi' % (v / 2 ** 30)) if k == 'memory' else ('%g' % v))
+                            for k, v in sorted(reclaimed.items()))
+        self.log.info("%sStopped %d of %d idle server(s) in %.1fs, reclaiming %s",
+                      '[dry run] ' if self.dry_run else '', stopped, len(idle),
+                      time.monotonic() - start, summary or 'nothing')
+        return stopped, reclaimed
+
+    def watch(self, interval=300):
+        while True:
+            try:
+                self.run()
+            except Exception as e:
+                self.log.warning("Cull pass failed: %s", e)
+            time.sleep(interval)
+
+
+if __name__ == '__main__':
+
+    namespace = 'default'
+    if os.path.exists(NAMESPACE_FILE):
+        with open(NAMESPACE_FILE) as f:
+            namespace = f.read().strip()
+
+    parser = argparse.ArgumentParser(description='Stop notebook servers that have been idle for too long.')
+    parser.add_argument('--url', default=os.getenv('JUPYTERHUB_API_URL') or 'http://127.0.0.1:8081/hub/api')
+    parser.add_argument('--node-selectors', default='/opt/jupyterhub/config/node-selectors.yaml')
+    parser.add_argument('--namespace', default=namespace)
+    parser.add_argument('--timeout', type=int, default=int(os.getenv('LAB_IDLE_TIMEOUT') or 43200),
+                        help='seconds a server may idle when its rule sets no idle_timeout')
+    parser.add_argument('--concurrency', type=int, default=10, help='servers stopped at once')
+    parser.add_argument('--interval', type=int, default=300, help='seconds between passes')
+    parser.add_argument('--once', action='store_true', help='run one pass and exit')
+    parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--spawner-config', default=SPAWNER_CONFIG, help='the hub\'s 20-spawner.py')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    try:
+        config.load_incluster_config()
+    except config.ConfigException:
+        config.load_kube_config()
+
+    culler = HubCuller(args.url, os.environ['JUPYTERHUB_API_TOKEN'], args.namespace, args.node_selectors,
+                       timeout=args.timeout, concurrency=args.concurrency, dry_run=args.dry_run,
+                       spawner_config=args.spawner_config)
+    if args.once:
+        culler.run()
+    else:
+        culler.watch(args.interval)
@@ -0,0 +1,26 @@
+"""Definitions shared with the hub configuration.
+
+The utilities that run next to the hub (prepuller, culler) decide things the
+spawner also decides: which node selector rule an image goes to, how much a
+kubernetes quantity is. Rather than keep copies that drift, they take those
+definitions from the spawner's own config.d file, executed against an empty
+traitlets Config as jupyterhub would (see also benchmarks/ldapmock.py).
+"""
+import os
+
+from traitlets.config import Config
+
+SPAWNER_CONFIG = '/opt/jupyterhub/config/jupyterhub_config.d/20-spawner.py'
+
+
+def load_spawner_config(path=SPAWNER_CONFIG):
+    """Namespace of the spawner's config file: NodeSelectorRules, parse_image_spec, parse_quantity, ..."""
+    namespace = {
+        'c': Config(),
+        'load_subconfig': lambda f: None,
+        'get_config': lambda: namespace['c'],
+        '__file__': os.path.abspath(path),
+    }
+    with open(path) as f:
+        exec(compile(f.read(), path, 'exec'), namespace)
+    return namespace
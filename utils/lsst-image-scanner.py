@@ -2,9 +2,19 @@
 
 import json
 import datetime
+import email.utils
+import hashlib
+import heapq
+import http.client
+import math
+import os
+import tempfile
+import threading
+import time
 import urllib
 import urllib.parse
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from urllib.error import HTTPError
 
 import yaml
@@ -29,11 +39,21 @@ class ScanRepo(object):
     dailies = 3
     weeklies = 2
     releases = 1
+    page_size = 100
+    workers = 8
+    retries = 4
+    max_redirects = 5
+    backoff = 0.5
+    timeout = 30
+    cache_dir = None
+    streaming = True
 
     def __init__(self, host='', path='', owner='', name='',
                  dailies=3, weeklies=2, releases=1,
                  json=False,
-                 insecure=False, sort_field="", debug=False):
+                 insecure=False, sort_field="", debug=False,
+                 page_size=0, workers=0, retries=None, cache_dir=None,
+                 streaming=None):
         if host:
             self.host = host
         if path:
@@ -58,6 +78,22 @@ class ScanRepo(object):
             self.sort_field = sort_field
         if debug:
             self.debug = debug
+        if page_size:
+            self.page_size = page_size
+        if workers:
+            self.workers = workers
+        if retries is not None:
+            self.retries = retries
+        if streaming is not None:
+            self.streaming = streaming
+        if cache_dir:
+            self.cache_dir = cache_dir
+            os.makedirs(cache_dir, exist_ok=True)
+        self.protocol = protocol
+        self._local = threading.local()
+        self._conns = []
+        self._conns_lock = threading.Lock()
+        self.stats = {"requests": 0, "not_modified": 0, "retries": 0}
         if not self.path:
             self.path = ("/v2/repositories/" + self.owner + "/" +
                          self.name + "/tags")
@@ -70,9 +106,11 @@ class ScanRepo(object):
         self.close()
 
     def close(self):
-        """Close the session"""
-        if self._session:
-            self._session.close()
+        """Close the keep-alive connections"""
+        with self._conns_lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            conn.close()
 
     def extract_image_info(self):
         """Build image name list and image description list"""
@@ -82,7 +120,13 @@ class ScanRepo(object):
         ldescs = []
         for c in cs:
             tag = c["name"].split(":")[-1]
-            if tag[0] == "r":
+            if "_" in tag[1:2]:
+                # current style: w_2019_13, d_2019_04_01, r17_0_1
+                kind = {"r": "Release", "w": "Weekly", "d": "Daily"}[tag[0]]
+                ld = "%s %s" % (kind, tag[2:])
+            elif "_" in tag:
+                ld = "Release %s" % tag[1:]
+            elif tag[0] == "r":
                 rmaj = tag[1:3]
                 rmin = tag[3:]
                 ld = "Release %s.%s" % (rmaj, rmin)
@@ -116,68 +160,236 @@ class ScanRepo(object):
         """Return the tag data"""
         return self.data
 
+    def _connection(self, scheme, host):
+        """One persistent connection per thread and host, reused across pages"""
+        conns = getattr(self._local, "conns", None)
+        if conns is None:
+            conns = self._local.conns = {}
+        conn = conns.get((scheme, host))
+        if conn is None:
+            if scheme == "https":
+                conn = http.client.HTTPSConnection(host, timeout=self.timeout)
+            else:
+                conn = http.client.HTTPConnection(host, timeout=self.timeout)
+            conns[(scheme, host)] = conn
+            with self._conns_lock:
+                self._conns.append(conn)
+        return conn
+
+    def _drop_connection(self, scheme, host):
+        conn = getattr(self._local, "conns", {}).pop((scheme, host), None)
+        if conn is not None:
+            conn.close()
+            with self._conns_lock:
+                if conn in self._conns:
+                    self._conns.remove(conn)
+
+    def _count(self, key):
+        with self._conns_lock:
+            self.stats[key] += 1
+
+    def _cache_path(self, url):
+        key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def _cache_load(self, url):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._cache_path(url)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _cache_store(self, url, headers, body):
+        if not self.cache_dir:
+            return
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        if not etag and not last_modified:
+            return
+        entry = {"url": url, "etag": etag, "last_modified": last_modified,
+                 "body": body.decode("utf-8")}
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp, self._cache_path(url))
+
+    def _retry_delay(self, attempt, resp=None):
+        if resp is not None:
+            retry_after = resp.getheader("Retry-After")
+            if retry_after:
+                try:
+                    return float(retry_after)
+                except ValueError:
+                    when = email.utils.parsedate_to_datetime(retry_after)
+                    return max(0, when.timestamp() - time.time())
+        return self.backoff * (2 ** attempt)
+
     def _get_url(self, **kwargs):
-        params = None
-        resp = None
-        url = self.url
+        path = self.path
         if kwargs:
-            params = urllib.parse.urlencode(kwargs)
-            url += "?%s" % params
+            path += "?%s" % urllib.parse.urlencode(kwargs)
+        url = self.protocol + "://" + self.host + path
         headers = {"Accept": "application/json"}
-        req = urllib.request.Request(url, None, headers)
-        resp = urllib.request.urlopen(req)
-        page = resp.read()
-        return page
-
-    def scan(self):
-        url = self.url
-        results = []
-        page = 1
+        cached = self._cache_load(url)
+        if cached:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+        # the page is cached under the url asked for, wherever it redirects
+        target = url
+        redirects = 0
+        attempt = 0
         while True:
+            parts = urllib.parse.urlsplit(target)
+            scheme, host = parts.scheme, parts.netloc
+            path = urllib.parse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+            resp = None
             try:
-                resp_bytes = self._get_url(page=page)
-            except Exception as e:
-                raise ValueError("Failure retrieving %s: %s [ data: %s ]" %
-                                 (url, str(e),
-                                  str(resp_bytes.decode("utf-8"))))
-            resp_text = resp_bytes.decode("utf-8")
-            try:
-                j = json.loads(resp_text)
-            except ValueError:
-                raise ValueError("Could not decode '%s' -> '%s' as JSON" %
-                                 (url, str(resp_text)))
-            results.extend(j["results"])
-            if "next" not in j or not j["next"]:
-                break
-            page = page + 1
-        self._reduce_results(results)
+                conn = self._connection(scheme, host)
+                conn.request("GET", path, headers=headers)
+                resp = conn.getresponse()
+                body = resp.read()
+                self._count("requests")
+            except (OSError, http.client.HTTPException) as e:
+                # stale keep-alive connection or network trouble
+                self._drop_connection(scheme, host)
+                if attempt >= self.retries:
+                    raise
+                error = e
+            else:
+                if resp.getheader("Connection", "").lower() == "close":
+                    self._drop_connection(scheme, host)
+                if resp.status in (301, 302, 303, 307, 308) and resp.getheader("Location"):
+                    redirects += 1
+                    if redirects > self.max_redirects:
+                        raise HTTPError(target, resp.status, "Too many redirects",
+                                        resp.headers, None)
+                    target = urllib.parse.urljoin(target, resp.getheader("Location"))
+                    if self.debug:
+                        print("Redirected to %s" % target)
+                    continue
+                if resp.status == 304 and cached:
+                    self._count("not_modified")
+                    return cached["body"].encode("utf-8")
+                if resp.status == 200:
+                    self._cache_store(url, resp.headers, body)
+                    return body
+                error = HTTPError(target, resp.status, resp.reason, resp.headers, None)
+                if resp.status != 429 and resp.status < 500:
+                    raise error
+                if attempt >= self.retries:
+                    raise error
+            delay = self._retry_delay(attempt, resp)
+            if self.debug:
+                print("Retrying %s in %.1fs: %s" % (url, delay, error))
+            self._count("retries")
+            time.sleep(delay)
+            attempt += 1
+
+    def _get_page(self, page, **params):
+        try:
+            resp_bytes = self._get_url(page=page, page_size=self.page_size,
+                                       **params)
+        except Exception as e:
+            raise ValueError("Failure retrieving %s page %d: %s" %
+                             (self.url, page, str(e)))
+        resp_text = resp_bytes.decode("utf-8")
+        try:
+            return json.loads(resp_text)
+        except ValueError:
+            raise ValueError("Could not decode '%s' -> '%s' as JSON" %
+                             (self.url, str(resp_text)))
+
+    def scan(self):
+        """Fetch the tags and keep the newest of each kind"""
+        if self.streaming and self.sort_field == "comp_ts":
+            self._scan_streaming()
+            return
+        self._reduce_results(self.tags())
+
+    def tags(self):
+        """Every tag of the repository: the first page gives the count,
+        the rest are fetched concurrently (or by following `next`)"""
+        j = self._get_page(1)
+        results = list(j["results"])
+        if j.get("next"):
+            count = j.get("count")
+            per_page = len(j["results"])
+            if count and per_page:
+                pages = range(2, int(math.ceil(count / float(per_page))) + 1)
+                with ThreadPoolExecutor(self.workers) as pool:
+                    for page in pool.map(self._get_page, pages):
+                        results.extend(page["results"])
+                # tags pushed mid-scan shift the pages; drop the repeats
+                seen = set()
+                results = [r for r in results
+                           if r["name"] not in seen and not seen.add(r["name"])]
+            else:
+                page = 1
+                while j.get("next"):
+                    page = page + 1
+                    j = self._get_page(page)
+                    results.extend(j["results"])
+        return results
+
+    def _iter_pages(self, **params):
+        """Yield pages in order, fetching one page ahead"""
+        with ThreadPoolExecutor(1) as pool:
+            page = 1
+            pending = pool.submit(self._get_page, page, **params)
+            while pending is not None:
+                j = pending.result()
+                pending = None
+                if j.get("next"):
+                    page = page + 1
+                    pending = pool.submit(self._get_page, page, **params)
+                try:
+                    yield j
+                except GeneratorExit:
+                    if pending is not None:
+                        pending.cancel()
+                    raise
+
+    def _scan_streaming(self):
+        """Walk the tags newest first and stop once every kind is full:
+        no older tag can displace what has been kept. Falls back to a
+        full scan if the registry turns out not to order by last_updated"""
+        top = _TopK(self._limits(), self._convert_time)
+        pages = self._iter_pages(ordering="last_updated")
+        oldest = None
+        try:
+            for j in pages:
+                for res in j["results"]:
+                    ts = top.add(res)
+                    if ts is None:
+                        continue
+                    if oldest is not None and ts > oldest:
+                        # stopping early would miss newer tags further on
+                        if self.debug:
+                            print("%s is not ordered by last_updated, "
+                                  "scanning every page" % self.url)
+                        self._reduce_results(self.tags())
+                        return
+                    oldest = ts
+                if oldest is not None and top.settled(oldest):
+                    break
+        finally:
+            pages.close()
+        self.data = top.result()
+
+    def _limits(self):
+        return {"d": ("daily", self.dailies),
+                "w": ("weekly", self.weeklies),
+                "r": ("release", self.releases)}
 
     def _reduce_results(self, results):
-        sort_field = self.sort_field
-        r_candidates = []
-        w_candidates = []
-        d_candidates = []
+        top = _TopK(self._limits(), self._convert_time, self.sort_field)
         for res in results:
-            vname = res["name"]
-            fc = vname[0]
-            res["comp_ts"] = self._convert_time(res["last_updated"])
-            if fc == "r":
-                r_candidates.append(res)
-            if fc == "w":
-                w_candidates.append(res)
-            if fc == "d":
-                d_candidates.append(res)
-        r_candidates.sort(key=lambda x: x[sort_field], reverse=True)
-        w_candidates.sort(key=lambda x: x[sort_field], reverse=True)
-        d_candidates.sort(key=lambda x: x[sort_field], reverse=True)
-        r = {}
-        r["daily"] = d_candidates[:self.dailies]
-        r["weekly"] = w_candidates[:self.weeklies]
-        r["release"] = r_candidates[:self.releases]
-        for tp in r:
-            for v in r[tp]:
-                del(v["comp_ts"])
-        self.data = r
+            top.add(res)
+        self.data = top.result()
 
     def _convert_time(self, ts):
         f = '%Y-%m-%dT%H:%M:%S.%f%Z'
@@ -186,16 +398,68 @@ class ScanRepo(object):
         return datetime.datetime.strptime(ts, f)
 
 
+class _TopK(object):
+    """Bounded min-heaps keeping the newest tags of each kind.
+
+       Heap entries are (key, -seq, res) so that, as with a stable sort,
+       the first tag seen wins a tie. A repeated tag (pages shift when
+       tags are pushed mid-scan) is only worth checking against the kept
+       ones: if it lost before, it loses again."""
+
+    def __init__(self, limits, convert_time, sort_field="comp_ts"):
+        self.limits = limits
+        self.convert_time = convert_time
+        self.sort_field = sort_field
+        self.heaps = dict((fc, []) for fc in limits)
+        self.kept = set()
+        self.seq = 0
+
+    def add(self, res):
+        """Offer a tag; returns its timestamp when it is of a tracked kind"""
+        vname = res["name"]
+        heap = self.heaps.get(vname[:1])
+        if heap is None or vname in self.kept:
+            return None
+        ts = self.convert_time(res["last_updated"])
+        key = ts if self.sort_field == "comp_ts" else res[self.sort_field]
+        self.seq += 1
+        entry = (key, -self.seq, res)
+        limit = self.limits[vname[0]][1]
+        if len(heap) < limit:
+            heapq.heappush(heap, entry)
+            self.kept.add(vname)
+        elif limit and entry[:2] > heap[0][:2]:
+            self.kept.discard(heapq.heapreplace(heap, entry)[2]["name"])
+            self.kept.add(vname)
+        return ts
+
+    def settled(self, oldest):
+        """True when tags no newer than oldest cannot change the result"""
+        for fc, heap in self.heaps.items():
+            limit = self.limits[fc][1]
+            if limit and (len(heap) < limit or heap[0][0] < oldest):
+                return False
+        return True
+
+    def result(self):
+        r = {}
+        for fc, heap in self.heaps.items():
+            entries = sorted(heap, key=lambda e: e[:2], reverse=True)
+            r[self.limits[fc][0]] = [e[2] for e in entries]
+        return r
+
+
 
 if __name__ == '__main__':
     
-    scanner = ScanRepo(host="hub.docker.com",
-                   owner="lsstsqre",
-                   name="jld-lab",
-                   json=True,
-                   )
-    scanner.scan()
-    lnames, ldescs = scanner.extract_image_info()
+    with ScanRepo(host="hub.docker.com",
+                  owner="lsstsqre",
+                  name="jld-lab",
+                  json=True,
+                  cache_dir=os.environ.get("IMAGE_SCANNER_CACHE"),
+                  ) as scanner:
+        scanner.scan()
+        lnames, ldescs = scanner.extract_image_info()
     if not lnames or len(lnames) < 2:
         raise Exception("could not scan images at lsstsqre/jld-lab")
 